@@ -0,0 +1,66 @@
+"""
+Rows per second for recording activities, single-row commits against the batched
+write-behind buffer, with N concurrent producers.
+
+Run against a local stand-in, e.g. `make db_run` for a single cockroach node:
+
+    PYTHONPATH=src python benchmarks/bench_activity.py \\
+        --db-url "cockroachdb://root@localhost:26257/defaultdb?sslmode=disable" \\
+        --producers 50 --rows 40
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from telegram_bot_tts.db.db_manager import DBManager
+from telegram_bot_tts.db.migrations import upgrade
+
+USER_ID = 900_000_000
+
+
+async def run(args, write_behind: bool) -> float:
+    db_manager = DBManager(args.db_url, write_behind=write_behind)
+    await upgrade(db_manager.engine)
+    if not await db_manager.is_user_registered(USER_ID):
+        await db_manager.register_user(USER_ID, "bench", None, None)
+
+    async def producer():
+        for _ in range(args.rows):
+            await db_manager.add_text_to_speech_activity(USER_ID, 42, datetime.now())
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(producer() for _ in range(args.producers)))
+    enqueued = time.perf_counter() - t1
+
+    # closing drains the buffer, the rows are only counted once committed
+    await db_manager.close()
+    elapsed = time.perf_counter() - t1
+
+    if db_manager.activity_buffer is not None:
+        print(f"  buffer stats: {db_manager.activity_buffer.stats()}")
+        print(
+            f"  request path: {enqueued * 1000 / (args.producers * args.rows):.3f} ms/row"
+        )
+    return elapsed
+
+
+async def main(args):
+    rows = args.producers * args.rows
+    print(f"{args.producers} producers x {args.rows} rows = {rows} rows")
+
+    single = await run(args, write_behind=False)
+    print(f"single-row commits: {single:8.2f}s {rows / single:10.1f} rows/s")
+
+    batched = await run(args, write_behind=True)
+    print(f"batched flushes   : {batched:8.2f}s {rows / batched:10.1f} rows/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--producers", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=40)
+    asyncio.run(main(parser.parse_args()))
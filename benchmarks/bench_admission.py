@@ -0,0 +1,215 @@
+"""
+Group chat heavy traffic through the Application: most updates are group chatter
+the bot is not addressed in, with a few mentions, replies to the bot and commands
+for other bots. Compares the admission filters against the old wiring, where every
+text reached handle_text_message and the registration query ran before the mention
+check. Each db query holds one of --db-pool connections for --db-latency seconds.
+
+    PYTHONPATH=src python benchmarks/bench_admission.py --updates 20000
+    PYTHONPATH=src python benchmarks/bench_admission.py --updates 20000 --no-admission
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from telegram import Update
+from telegram.ext import Application, MessageHandler, TypeHandler, filters
+
+from telegram_bot_tts.components.admission import (
+    GROUP_CHATS,
+    text_admission,
+    voice_admission,
+)
+from telegram_bot_tts.components.concurrency import ChatOrderedUpdateProcessor
+from telegram_bot_tts.components.handlers import (
+    handle_text_message,
+    handle_voice_message,
+)
+from telegram_bot_tts.constants import BOT_USERNAME
+from telegram_bot_tts.fakes import (
+    FakeDBManager,
+    FakeOpenAI,
+    FakeTelegramServer,
+    make_text_update,
+)
+from telegram_bot_tts.metrics import ADMISSION_DROPPED
+
+logger = logging.getLogger("bench")
+
+WORDS = "so what do you think about the game last night it was great lol".split()
+
+
+class SlowDBManager(FakeDBManager):
+    # counts the registration queries, each holding a pooled connection a while
+    def __init__(self, latency: float, pool: int):
+        super().__init__()
+        self.latency = latency
+        self.pool = asyncio.Semaphore(pool)
+        self.queries = 0
+
+    async def is_user_registered(self, user_id):
+        self.queries += 1
+        async with self.pool:
+            await asyncio.sleep(self.latency)
+        return True
+
+
+def make_updates(args) -> list[dict]:
+    rng = random.Random(args.seed)
+    updates = []
+    for update_id in range(1, args.updates + 1):
+        user_id = rng.randrange(args.users) + 1
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 15)))
+        if rng.random() >= args.group_ratio:
+            updates.append(make_text_update(update_id, user_id, words))
+            continue
+        draw = rng.random()
+        if draw < args.addressed_ratio / 2:
+            text, reply_to_bot = f"{BOT_USERNAME} {words}", False
+        elif draw < args.addressed_ratio:
+            text, reply_to_bot = words, True
+        elif draw < args.addressed_ratio + args.command_ratio:
+            text, reply_to_bot = "/roll@dice_bot", False
+        else:
+            text, reply_to_bot = words, False
+        update = make_text_update(update_id, user_id, text, "supergroup", reply_to_bot)
+        # spread over --groups chats
+        update["message"]["chat"]["id"] = -1000 - user_id % args.groups
+        updates.append(update)
+    return updates
+
+
+async def run(args) -> dict:
+    telegram = FakeTelegramServer(port=args.port)
+    await telegram.start()
+    client = FakeOpenAI(args.tts_latency, args.stt_latency, seed=args.seed)
+    db_manager = SlowDBManager(args.db_latency, args.db_pool)
+
+    app = (
+        Application.builder()
+        .token("123:bench")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(args.max_concurrent_updates, args.updates)
+        )
+        .build()
+    )
+
+    async def text(update, context):
+        await handle_text_message(update, context, logger, client, db_manager)
+
+    async def legacy_text(update, context):
+        # the order before admission: the registration query, then the mention
+        await db_manager.is_user_registered(update.message.from_user.id)
+        message = update.message
+        if message.chat.type in GROUP_CHATS and BOT_USERNAME not in message.text:
+            return
+        await text(update, context)
+
+    async def voice(update, context):
+        await handle_voice_message(update, context, logger, client, db_manager)
+
+    if args.no_admission:
+        app.add_handler(MessageHandler(filters.TEXT, legacy_text))
+        app.add_handler(MessageHandler(filters.VOICE, voice))
+    else:
+        app.add_handler(MessageHandler(text_admission(), text))
+        app.add_handler(MessageHandler(voice_admission(), voice))
+
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(type(context.error).__name__)
+
+    app.add_error_handler(on_error)
+
+    # group 1 sees every update, whether a handler in group 0 took it or not
+    seen = 0
+    done = asyncio.Event()
+
+    async def count(update, context):
+        nonlocal seen
+        seen += 1
+        if seen == args.updates:
+            done.set()
+
+    app.add_handler(TypeHandler(Update, count), group=1)
+
+    updates = make_updates(args)
+    dropped_before = dropped()
+    async with app:
+        await app.start()
+        start = time.perf_counter()
+        for data in updates:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        elapsed = time.perf_counter() - start
+        await app.stop()
+    await telegram.stop()
+
+    return {
+        "elapsed": elapsed,
+        "throughput": args.updates / elapsed,
+        "db_queries": db_manager.queries,
+        "tts_calls": client.calls["tts"],
+        "errors": len(errors),
+        "dropped": {
+            stage: count - dropped_before.get(stage, 0)
+            for stage, count in dropped().items()
+            if count > dropped_before.get(stage, 0)
+        },
+    }
+
+
+def dropped() -> dict:
+    return {
+        sample.labels["stage"]: sample.value
+        for metric in ADMISSION_DROPPED.collect()
+        for sample in metric.samples
+        if sample.name.endswith("_total") and sample.labels["kind"] == "text"
+    }
+
+
+async def main(args):
+    result = await run(args)
+    name = "old wiring" if args.no_admission else "admission"
+    print(
+        f"{name}: {args.updates} updates in {result['elapsed']:.2f}s, "
+        f"{result['throughput']:.0f} updates/s"
+    )
+    print(
+        f"  db queries {result['db_queries']}, tts calls {result['tts_calls']}, "
+        f"errors {result['errors']}"
+    )
+    if result["dropped"]:
+        print(
+            "  dropped "
+            + ", ".join(f"{stage} {n:.0f}" for stage, n in result["dropped"].items())
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--group-ratio", type=float, default=0.9)
+    parser.add_argument("--addressed-ratio", type=float, default=0.05)
+    parser.add_argument("--command-ratio", type=float, default=0.02)
+    parser.add_argument("--db-latency", type=float, default=0.002)
+    parser.add_argument("--db-pool", type=int, default=15)
+    parser.add_argument("--tts-latency", type=float, default=0.05)
+    parser.add_argument("--stt-latency", type=float, default=0.5)
+    parser.add_argument("--max-concurrent-updates", type=int, default=64)
+    parser.add_argument("--no-admission", action="store_true")
+    parser.add_argument("--port", type=int, default=8083)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
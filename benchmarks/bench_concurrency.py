@@ -0,0 +1,157 @@
+"""
+Tail latency of the real handlers under a mixed tts/stt load, comparing the default
+one-at-a-time processing against ChatOrderedUpdateProcessor.
+
+OpenAI and Telegram are replaced by the fakes in telegram_bot_tts.fakes, with
+configurable api latency:
+
+    PYTHONPATH=src python benchmarks/bench_concurrency.py --users 50 --updates 400 \\
+        --tts-latency 0.5 --stt-latency 5 --voice-ratio 0.2
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    MessageHandler,
+    TypeHandler,
+    filters,
+)
+
+from telegram_bot_tts.components.concurrency import (
+    ApiLimits,
+    ChatOrderedUpdateProcessor,
+)
+from telegram_bot_tts.components.handlers import (
+    handle_text_message,
+    handle_voice_message,
+)
+
+from telegram_bot_tts.fakes import (
+    FakeDBManager,
+    FakeOpenAI,
+    FakeTelegramServer,
+    make_text_update,
+    make_voice_update,
+)
+
+logger = logging.getLogger("bench")
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def run(args, telegram: FakeTelegramServer, concurrent_updates) -> dict:
+    client = FakeOpenAI(args.tts_latency, args.stt_latency)
+    db_manager = FakeDBManager()
+    limits = ApiLimits(args.max_tts, args.max_stt)
+
+    app = (
+        Application.builder()
+        .token("123:bench")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.TEXT,
+            lambda update, context: handle_text_message(
+                update, context, logger, client, db_manager, limits=limits
+            ),
+        )
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.VOICE,
+            lambda update, context: handle_voice_message(
+                update, context, logger, client, db_manager, limits=limits
+            ),
+        )
+    )
+
+    # group 1 runs once the handler in group 0 is done with the update
+    enqueued = {}
+    latencies = {"text": [], "voice": []}
+    done = asyncio.Event()
+
+    async def record(update: Update, context):
+        kind = "voice" if update.message.voice else "text"
+        latencies[kind].append(time.perf_counter() - enqueued[update.update_id])
+        if sum(map(len, latencies.values())) == args.updates:
+            done.set()
+
+    app.add_handler(TypeHandler(Update, record), group=1)
+
+    rng = random.Random(42)
+    async with app:
+        await app.start()
+
+        t1 = time.perf_counter()
+        for i in range(args.updates):
+            user_id = rng.randrange(args.users) + 1
+            if rng.random() < args.voice_ratio:
+                data = make_voice_update(i, user_id, duration=30)
+            else:
+                data = make_text_update(i, user_id, "good morning, how are you?")
+            enqueued[i] = time.perf_counter()
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        elapsed = time.perf_counter() - t1
+        await app.stop()
+
+    result = {"elapsed": elapsed}
+    for kind, values in latencies.items():
+        if values:
+            result[kind] = {q: percentile(values, q) for q in (0.5, 0.95, 0.99)}
+    return result
+
+
+def report(name: str, result: dict, updates: int):
+    print(
+        f"{name}: {result['elapsed']:.2f}s, {updates / result['elapsed']:.1f} updates/s"
+    )
+    for kind in ("text", "voice"):
+        if kind in result:
+            p = result[kind]
+            print(
+                f"  {kind:5s} p50 {p[0.5]:7.2f}s  p95 {p[0.95]:7.2f}s  p99 {p[0.99]:7.2f}s"
+            )
+
+
+async def main(args):
+    telegram = FakeTelegramServer(port=args.port)
+    await telegram.start()
+
+    if not args.skip_sequential:
+        report("sequential", await run(args, telegram, False), args.updates)
+
+    processor = ChatOrderedUpdateProcessor(args.max_concurrent_updates)
+    report("chat ordered", await run(args, telegram, processor), args.updates)
+
+    await telegram.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--voice-ratio", type=float, default=0.2)
+    parser.add_argument("--tts-latency", type=float, default=0.5)
+    parser.add_argument("--stt-latency", type=float, default=5.0)
+    parser.add_argument("--max-concurrent-updates", type=int, default=64)
+    parser.add_argument("--max-tts", type=int, default=16)
+    parser.add_argument("--max-stt", type=int, default=8)
+    parser.add_argument("--skip-sequential", action="store_true")
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--port", type=int, default=8091)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,111 @@
+"""
+Update throughput of the db layer with N concurrent simulated users.
+
+Every simulated update runs the same db work as handle_text_message
+(is_user_registered + add_text_to_speech_activity). The sync run replays the
+old blocking DBManager behaviour on the event loop, the async run uses the
+asyncio DBManager with its connection pool.
+
+Start a local stand-in first, e.g. `make db_run` (cockroach single node) or
+the postgres image under postgres/, then:
+
+    PYTHONPATH=src python benchmarks/bench_db.py \\
+        --db-url "cockroachdb://root@localhost:26257/defaultdb?sslmode=disable" \\
+        --users 50 --messages 20
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+from telegram_bot_tts.db.db_manager import (
+    DBManager,
+    TextToSpeechActivity,
+    User,
+)
+from telegram_bot_tts.db.migrations import upgrade
+
+# the sync baseline talks to the same database through psycopg's blocking api
+SYNC_DRIVERS = {
+    "cockroachdb": "cockroachdb+psycopg",
+    "postgresql": "postgresql+psycopg",
+    "postgres": "postgresql+psycopg",
+}
+
+USER_ID_OFFSET = 900_000_000
+
+
+async def run_sync(db_url: str, users: int, messages: int) -> float:
+    url = make_url(db_url)
+    url = url.set(drivername=SYNC_DRIVERS.get(url.drivername, url.drivername))
+    engine = create_engine(url)
+    Session = sessionmaker(bind=engine)
+
+    async def simulated_user(user_id: int):
+        for _ in range(messages):
+            # the blocking calls the handlers used to make from coroutines
+            with Session() as session:
+                session.scalar(select(User.user_id).where(User.user_id == user_id))
+            with Session() as session:
+                session.add(
+                    TextToSpeechActivity(
+                        user_id=user_id,
+                        used_chars=42,
+                        cost=0.0,
+                        timestamp=datetime.now(),
+                    )
+                )
+                session.commit()
+            await asyncio.sleep(0)
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(simulated_user(USER_ID_OFFSET + i) for i in range(users)))
+    elapsed = time.perf_counter() - t1
+    engine.dispose()
+    return elapsed
+
+
+async def run_async(db_manager: DBManager, users: int, messages: int) -> float:
+    async def simulated_user(user_id: int):
+        for _ in range(messages):
+            await db_manager.is_user_registered(user_id)
+            await db_manager.add_text_to_speech_activity(user_id, 42, datetime.now())
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(simulated_user(USER_ID_OFFSET + i) for i in range(users)))
+    return time.perf_counter() - t1
+
+
+async def main(args):
+    db_manager = DBManager(args.db_url, pool_size=args.pool_size)
+    await upgrade(db_manager.engine)
+
+    for i in range(args.users):
+        if not await db_manager.is_user_registered(USER_ID_OFFSET + i):
+            await db_manager.register_user(USER_ID_OFFSET + i, "bench", None, None)
+
+    updates = args.users * args.messages
+    print(f"{args.users} users x {args.messages} messages = {updates} updates")
+
+    sync_elapsed = await run_sync(args.db_url, args.users, args.messages)
+    print(f"sync  : {sync_elapsed:8.2f}s {updates / sync_elapsed:10.1f} updates/s")
+
+    async_elapsed = await run_async(db_manager, args.users, args.messages)
+    print(f"async : {async_elapsed:8.2f}s {updates / async_elapsed:10.1f} updates/s")
+
+    await db_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--pool-size", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
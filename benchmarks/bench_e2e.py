@@ -0,0 +1,358 @@
+"""
+End to end load test: thousands of synthetic users drive handle_text_message and
+handle_voice_message through the Application, wired the way app.py wires it, with
+OpenAI and Telegram replaced by telegram_bot_tts.fakes.
+
+Reports throughput, p50/p95/p99 latency per kind of update, errors and memory, and
+saves them as json under --output-dir so runs can be compared:
+
+    PYTHONPATH=src python benchmarks/bench_e2e.py --users 2000 --updates 10000 \\
+        --tts-latency 0.5 --stt-latency 2 --jitter 0.5 --error-rate 0.01 \\
+        --name baseline
+    PYTHONPATH=src python benchmarks/bench_e2e.py ... --compare results/baseline.json
+
+With --replay the updates come from a file written with RECORD_UPDATES_PATH
+instead, played back at --speed times the recorded pace (0 for as fast as possible):
+
+    PYTHONPATH=src python benchmarks/bench_e2e.py --replay updates.jsonl --speed 10
+
+The OpenAI calls go through ApiGuards with an adaptive concurrency limit, or only
+the fixed --max-tts/--max-stt caps with --fixed-limit. --openai-capacity answers
+the calls beyond that many in flight with a 429, as a rate limited account would:
+
+    PYTHONPATH=src python benchmarks/bench_e2e.py --openai-capacity 8 --rate 40
+    PYTHONPATH=src python benchmarks/bench_e2e.py --openai-capacity 8 --rate 40 \\
+        --fixed-limit
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from telegram import Update
+from telegram.ext import Application, MessageHandler, TypeHandler, filters
+
+from telegram_bot_tts.components.cache import AudioCache, TranscriptCache
+from telegram_bot_tts.components.concurrency import (
+    AdaptiveLimit,
+    ApiLimits,
+    ChatOrderedUpdateProcessor,
+    FairScheduler,
+    percentile,
+)
+from telegram_bot_tts.components.handlers import (
+    BUSY_MESSAGE,
+    handle_text_message,
+    handle_voice_message,
+)
+from telegram_bot_tts.components.resilience import ApiGuard, ApiGuards
+from telegram_bot_tts.fakes import (
+    FakeDBManager,
+    FakeOpenAI,
+    FakeTelegramServer,
+    make_text_update,
+    make_voice_update,
+)
+from telegram_bot_tts.clients import InstrumentedHTTPXRequest
+from telegram_bot_tts.metrics import HTTP_POOL_WAIT
+from telegram_bot_tts.recording import read_recording, replay
+
+logger = logging.getLogger("bench")
+
+WORDS = "the quick brown fox jumps over a lazy dog while voices read it aloud".split()
+
+# high enough that the synthetic users are never rate limited
+UNLIMITED = {"tts": (1e9, 1e9), "stt": (1e9, 1e9)}
+
+
+def rss_mb() -> float:
+    # resident set size right now, from /proc, linux only
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def pool_wait_mean(client: str) -> float:
+    # mean seconds requests waited for a connection, from the histogram
+    samples = {
+        sample.name: sample.value
+        for metric in HTTP_POOL_WAIT.collect()
+        for sample in metric.samples
+        if sample.labels.get("client") == client
+    }
+    count = samples.get("http_pool_wait_seconds_count", 0)
+    return samples["http_pool_wait_seconds_sum"] / count if count else 0.0
+
+
+def make_updates(args) -> list[dict]:
+    rng = random.Random(args.seed)
+    updates = []
+    for update_id in range(args.updates):
+        user_id = rng.randrange(args.users) + 1
+        chat_type = "group" if rng.random() < args.group_ratio else "private"
+        if rng.random() < args.voice_ratio:
+            duration = int(rng.expovariate(1 / args.mean_voice_seconds)) + 1
+            updates.append(make_voice_update(update_id, user_id, duration, chat_type))
+        else:
+            words = int(rng.expovariate(1 / args.mean_words)) + 1
+            text = " ".join(rng.choice(WORDS) for _ in range(words))
+            if chat_type == "group":
+                text = f"@openaitts_bot {text}"
+            updates.append(make_text_update(update_id, user_id, text, chat_type))
+    return updates
+
+
+async def run(args) -> dict:
+    telegram = FakeTelegramServer(port=args.port, latency=args.telegram_latency)
+    await telegram.start()
+
+    client = FakeOpenAI(
+        args.tts_latency,
+        args.stt_latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        capacity=args.openai_capacity,
+    )
+    db_manager = FakeDBManager()
+    limits = ApiLimits(args.max_tts, args.max_stt)
+    guards = ApiGuards(
+        *(
+            ApiGuard(
+                api,
+                deadline,
+                limiter=(
+                    None
+                    if args.fixed_limit
+                    else AdaptiveLimit(
+                        api,
+                        initial=args.initial_limit,
+                        max_limit=max_limit,
+                        max_wait=args.max_queue_wait,
+                    )
+                ),
+            )
+            for api, deadline, max_limit in (
+                ("tts", 60, args.max_tts),
+                ("stt", 120, args.max_stt),
+            )
+        )
+    )
+    scheduler = FairScheduler(args.max_jobs, UNLIMITED, UNLIMITED, [])
+    audio_cache = AudioCache(Path(tempfile.mkdtemp()), 256 * 2**20, "ogg")
+    transcript_cache = TranscriptCache(10000, 3600)
+
+    app = (
+        Application.builder()
+        .token("123:bench")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .request(
+            InstrumentedHTTPXRequest(
+                "telegram",
+                connection_pool_size=args.telegram_pool_size,
+                pool_timeout=args.timeout,
+            )
+        )
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(args.max_concurrent_updates, args.updates)
+        )
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.TEXT,
+            lambda update, context: handle_text_message(
+                update,
+                context,
+                logger,
+                client,
+                db_manager,
+                audio_cache,
+                limits,
+                scheduler,
+                guards,
+            ),
+        )
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.VOICE,
+            lambda update, context: handle_voice_message(
+                update,
+                context,
+                logger,
+                client,
+                db_manager,
+                limits,
+                transcript_cache,
+                scheduler,
+                guards,
+            ),
+        )
+    )
+
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(type(context.error).__name__)
+
+    app.add_error_handler(on_error)
+
+    # group 1 runs once the handler in group 0 is done with the update
+    enqueued = {}
+    latencies = {"text": [], "voice": []}
+    done = asyncio.Event()
+
+    async def record(update: Update, context):
+        kind = "voice" if update.message.voice else "text"
+        latencies[kind].append(time.perf_counter() - enqueued[update.update_id])
+        if sum(map(len, latencies.values())) == args.updates:
+            done.set()
+
+    app.add_handler(TypeHandler(Update, record), group=1)
+
+    if args.replay:
+        records = read_recording(args.replay)
+        args.updates = len(records)
+    else:
+        records = [(0.0, data) for data in make_updates(args)]
+    rss_before = rss_mb()
+
+    async with app:
+        await app.start()
+
+        def on_put(update: Update):
+            enqueued[update.update_id] = time.perf_counter()
+
+        start = time.perf_counter()
+        if args.replay:
+            await replay(app, records, args.speed, on_put)
+        else:
+            for _, data in records:
+                update = Update.de_json(data, app.bot)
+                on_put(update)
+                await app.update_queue.put(update)
+                if args.rate:
+                    await asyncio.sleep(1 / args.rate)
+
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        elapsed = time.perf_counter() - start
+        rss_peak = rss_mb()
+        await app.stop()
+
+    await telegram.stop()
+
+    return {
+        "name": args.name,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "args": vars(args),
+        "elapsed": elapsed,
+        "throughput": args.updates / elapsed,
+        "latency": {
+            kind: {f"p{int(q * 100)}": percentile(values, q) for q in (0.5, 0.95, 0.99)}
+            for kind, values in latencies.items()
+            if values
+        },
+        "pool_wait_mean": pool_wait_mean("telegram"),
+        "errors": len(errors),
+        "error_types": dict(Counter(errors)),
+        "busy": sum(fields.get("text") == BUSY_MESSAGE for _, fields in telegram.sent),
+        "openai_calls": client.calls,
+        "rate_limited": client.rate_limited,
+        "limits": {
+            api: guard.limiter.stats()
+            for api, guard in (("tts", guards.tts), ("stt", guards.stt))
+            if guard.limiter is not None
+        },
+        "rss_mb": {"before": rss_before, "after": rss_peak},
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(result: dict, baseline: dict = None):
+    def delta(value, old):
+        return f" ({(value - old) / old:+.0%})" if old else ""
+
+    old = baseline or {}
+    print(
+        f"{result['name']}: {result['elapsed']:.2f}s, "
+        f"{result['throughput']:.1f} updates/s"
+        + delta(result["throughput"], old.get("throughput"))
+    )
+    for kind, quantiles in result["latency"].items():
+        old_quantiles = old.get("latency", {}).get(kind, {})
+        print(
+            f"  {kind:5s} "
+            + "  ".join(
+                f"{q} {value:6.2f}s{delta(value, old_quantiles.get(q))}"
+                for q, value in quantiles.items()
+            )
+        )
+    print(
+        f"  telegram pool wait {result['pool_wait_mean'] * 1000:.1f} ms, "
+        f"errors {result['errors']}, openai calls {result['openai_calls']}, "
+        f"rss {result['rss_mb']['before']:.0f} -> {result['rss_mb']['after']:.0f} MB"
+    )
+    print(
+        f"  errors by type {result['error_types']}, busy replies {result['busy']}, "
+        f"429s {result['rate_limited']}, limits "
+        + ", ".join(
+            f"{api} {stats['limit']:.1f} (shed {stats['shed']})"
+            for api, stats in result["limits"].items()
+        )
+    )
+
+
+async def main(args):
+    result = await run(args)
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    report(result, baseline)
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    path = output_dir / f"{args.name}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    path.write_text(json.dumps(result, indent=2))
+    print(f"saved to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", default="e2e")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=0, help="updates/s, 0 for max")
+    parser.add_argument("--voice-ratio", type=float, default=0.2)
+    parser.add_argument("--group-ratio", type=float, default=0.1)
+    parser.add_argument("--mean-words", type=float, default=20)
+    parser.add_argument("--mean-voice-seconds", type=float, default=20)
+    parser.add_argument("--tts-latency", type=float, default=0.5)
+    parser.add_argument("--stt-latency", type=float, default=2.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-pool-size", type=int, default=64)
+    parser.add_argument("--max-concurrent-updates", type=int, default=256)
+    parser.add_argument("--max-jobs", type=int, default=64)
+    parser.add_argument("--max-tts", type=int, default=32)
+    parser.add_argument("--max-stt", type=int, default=16)
+    parser.add_argument("--fixed-limit", action="store_true")
+    parser.add_argument("--initial-limit", type=int, default=8)
+    parser.add_argument("--max-queue-wait", type=float, default=10)
+    parser.add_argument("--openai-capacity", type=int, help="429 beyond, per api")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output-dir", default="benchmarks/results")
+    parser.add_argument("--compare", help="a saved result to compare against")
+    parser.add_argument("--replay", help="a recording to play instead")
+    parser.add_argument("--speed", type=float, default=1, help="0 for max")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+"""
+VIP latency while the free tier floods the bot, with and without the vip lane.
+
+Jobs go through FairScheduler the way the handlers use it and hold an openai slot
+of their lane for the simulated api latency:
+
+    PYTHONPATH=src python benchmarks/bench_lanes.py --free-users 50 \\
+        --free-jobs 20 --vip-rate 5 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import time
+
+from telegram_bot_tts.components.concurrency import (
+    ApiLimits,
+    FairScheduler,
+    percentile,
+)
+
+VIP_USER_ID = 0
+
+
+async def run(args, flood: bool, lanes: bool) -> list[float]:
+    free_limits = ApiLimits(args.max_tts, args.max_tts)
+    scheduler = FairScheduler(
+        args.max_jobs,
+        {},
+        {},
+        vip_user_ids=[VIP_USER_ID] if lanes else [],
+        lane_limits={
+            "vip": ApiLimits(args.vip_max_tts, args.vip_max_tts),
+            "free": free_limits,
+        },
+        vip_reserved=args.vip_reserved if lanes else 0,
+    )
+    latencies = []
+
+    async def job(user_id: int, record: bool):
+        start = time.perf_counter()
+        async with scheduler.turn(user_id) as limits:
+            async with limits.tts:
+                await asyncio.sleep(args.latency)
+        if record:
+            latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    if flood:
+        for user_id in range(1, args.free_users + 1):
+            tasks += [
+                asyncio.create_task(job(user_id, False)) for _ in range(args.free_jobs)
+            ]
+
+    for _ in range(int(args.duration * args.vip_rate)):
+        tasks.append(asyncio.create_task(job(VIP_USER_ID, True)))
+        await asyncio.sleep(1 / args.vip_rate)
+
+    await asyncio.gather(*tasks)
+    stats = scheduler.stats()
+    print(
+        f"  lanes={lanes!s:5} flood={flood!s:5}"
+        f" vip p50 {percentile(latencies, 0.5):6.2f}s"
+        f" p95 {percentile(latencies, 0.95):6.2f}s"
+        f" | free served {stats['free']['served']:5}"
+        f" wait p95 {stats['free']['wait_p95']:6.2f}s"
+    )
+    return latencies
+
+
+async def main(args):
+    for lanes in (False, True):
+        for flood in (False, True):
+            await run(args, flood, lanes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--free-users", type=int, default=50)
+    parser.add_argument("--free-jobs", type=int, default=20)
+    parser.add_argument("--vip-rate", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--max-jobs", type=int, default=16)
+    parser.add_argument("--max-tts", type=int, default=16)
+    parser.add_argument("--vip-max-tts", type=int, default=4)
+    parser.add_argument("--vip-reserved", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+"""
+Handler overhead with logging off, with a plain StreamHandler writing on the event
+loop, and with the queue based setup_logger (text, json, sampled debug lines).
+
+handle_text_message runs against in-process fakes with no api latency, and the log
+stream blocks for --write-latency milliseconds per write, like a container's
+stdout pipe under load:
+
+    PYTHONPATH=src python benchmarks/bench_logging.py --calls 2000 --write-latency 0.2
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import time
+from types import SimpleNamespace
+
+from telegram_bot_tts.components.handlers import handle_text_message
+from telegram_bot_tts.logger import setup_logger
+
+from telegram_bot_tts.fakes import FakeDBManager, FakeOpenAI
+
+
+class SlowStream(io.StringIO):
+    def __init__(self, write_latency: float):
+        super().__init__()
+        self.write_latency = write_latency
+
+    def write(self, text: str) -> int:
+        time.sleep(self.write_latency)
+        return len(text)
+
+
+class FakeMessage:
+    def __init__(self, user_id: int, text: str):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(type="private")
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return self
+
+    async def reply_voice(self, voice, **kwargs):
+        return SimpleNamespace(voice=SimpleNamespace(file_id="file"))
+
+
+async def run(logger: logging.Logger, calls: int) -> float:
+    client = FakeOpenAI(tts_latency=0, audio_bytes=1024)
+    db_manager = FakeDBManager()
+
+    start = time.perf_counter()
+    for i in range(calls):
+        update = SimpleNamespace(message=FakeMessage(i % 50, "good morning " * 20))
+        await handle_text_message(update, None, logger, client, db_manager)
+    return (time.perf_counter() - start) / calls
+
+
+async def main(args):
+    write_latency = args.write_latency / 1000
+
+    off = logging.getLogger("bench.off")
+    off.setLevel(logging.WARNING)
+
+    sync = logging.getLogger("bench.sync")
+    sync.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(SlowStream(write_latency))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    )
+    sync.addHandler(handler)
+
+    loggers = {
+        "off": off,
+        "stream handler": sync,
+        "queue, text": setup_logger(
+            "bench.queue", "dev", stream=SlowStream(write_latency)
+        ),
+        "queue, json": setup_logger(
+            "bench.json", "dev", json_output=True, stream=SlowStream(write_latency)
+        ),
+        "queue, json, 10% debug": setup_logger(
+            "bench.sampled",
+            "dev",
+            json_output=True,
+            debug_sample_rate=0.1,
+            stream=SlowStream(write_latency),
+        ),
+    }
+    for logger in loggers.values():
+        logger.propagate = False
+
+    baseline = None
+    for name, logger in loggers.items():
+        per_call = await run(logger, args.calls)
+        baseline = baseline or per_call
+        print(
+            f"{name:>24}: {per_call * 1e6:8.1f}us per handler call "
+            f"(+{(per_call - baseline) * 1e6:7.1f}us)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--write-latency", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,93 @@
+"""
+Time to first text for a long voice note, sending it to whisper in one piece
+against splitting it into segments that are transcribed concurrently.
+
+The segments are cut by size here, ffmpeg is not needed. The fake whisper latency
+grows with the size of the upload, and silence trimming is a sleep of
+--trim-seconds-per-minute of audio, either over the whole note before it is split or
+in each segment's task:
+
+    PYTHONPATH=src python benchmarks/bench_long_voice.py --minutes 30 \\
+        --segment-seconds 120 --seconds-per-mb 8 --trim-seconds-per-minute 0.2
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import time
+
+from telegram_bot_tts.components.handlers import stt_response, stt_segments_response
+
+from telegram_bot_tts.fakes import FakeOpenAI
+
+logger = logging.getLogger("bench")
+
+# opus voice notes are recorded at about 32 kbit/s
+BYTES_PER_SECOND = 4000
+
+
+async def main(args):
+    client = FakeOpenAI(
+        stt_latency=args.base_latency, stt_seconds_per_mb=args.seconds_per_mb
+    )
+    audio = b"\0" * int(args.minutes * 60 * BYTES_PER_SECOND)
+
+    start = time.perf_counter()
+    buf = io.BytesIO(audio)
+    buf.name = "voice.oga"
+    await stt_response(buf, client, logger=logger)
+    whole = time.perf_counter() - start
+    print(f"{'whole':>10}: first text {whole:7.2f}s, done {whole:7.2f}s")
+
+    size = int(args.segment_seconds * BYTES_PER_SECOND)
+    segments = [audio[i : i + size] for i in range(0, len(audio), size)]
+
+    async def trim(audio: bytes) -> bytes:
+        await asyncio.sleep(
+            len(audio) / BYTES_PER_SECOND / 60 * args.trim_seconds_per_minute
+        )
+        return audio
+
+    async def trim_segment(index: int, segment: bytes) -> bytes:
+        return await trim(segment)
+
+    for name, trim_first, prepare in (
+        ("segmented", False, None),
+        ("trim first", True, None),
+        ("trim each", False, trim_segment),
+    ):
+        first = None
+
+        async def on_progress(text: str):
+            nonlocal first
+            if first is None:
+                first = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if trim_first:
+            await trim(audio)
+        await stt_segments_response(
+            segments,
+            client,
+            logger=logger,
+            concurrency=args.concurrency,
+            on_progress=on_progress,
+            prepare=prepare,
+        )
+        done = time.perf_counter() - start
+        print(
+            f"{name:>10}: first text {first:7.2f}s, done {done:7.2f}s "
+            f"({len(segments)} segments, concurrency {args.concurrency})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=float, default=30)
+    parser.add_argument("--segment-seconds", type=float, default=120)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--base-latency", type=float, default=1.0)
+    parser.add_argument("--seconds-per-mb", type=float, default=8.0)
+    parser.add_argument("--trim-seconds-per-minute", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
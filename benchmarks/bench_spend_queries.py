@@ -0,0 +1,156 @@
+"""
+Latency of the month-to-date spend queries before and after the activity indexes.
+
+Loads synthetic activity rows into a local cockroach/postgres stand-in, then times
+the old DATE_TRUNC filter and the month-range filter, first with the activity
+indexes dropped and then with them in place:
+
+    PYTHONPATH=src python benchmarks/bench_spend_queries.py \\
+        --db-url "cockroachdb://root@localhost:26257/defaultdb?sslmode=disable" \\
+        --generate 2000000 --users 10000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text
+
+from telegram_bot_tts.db.db_manager import (
+    DBManager,
+    SpeechToTextActivity,
+    TextToSpeechActivity,
+    User,
+    month_start,
+    stt_cost,
+    tts_cost,
+)
+from telegram_bot_tts.db.migrations import upgrade
+
+USER_ID_OFFSET = 800_000_000
+BATCH_SIZE = 10_000
+
+OLD_QUERY = """
+    SELECT COALESCE(SUM(cost), 0) FROM {table}
+    WHERE DATE_TRUNC('month', timestamp) = DATE_TRUNC('month', CURRENT_DATE)
+"""
+
+
+async def generate(db_manager: DBManager, rows: int, users: int, months: int):
+    rng = random.Random(42)
+    now = datetime.now().astimezone()
+    span = timedelta(days=30 * months).total_seconds()
+
+    async with db_manager.Session() as session:
+        await session.execute(
+            db_manager._insert(User)
+            .values([{"user_id": USER_ID_OFFSET + i} for i in range(users)])
+            .on_conflict_do_nothing(index_elements=[User.user_id])
+        )
+        await session.commit()
+
+    t1 = time.perf_counter()
+    for start in range(0, rows, BATCH_SIZE):
+        tts_rows, stt_rows = [], []
+        for _ in range(min(BATCH_SIZE, rows - start)):
+            row = {
+                "user_id": USER_ID_OFFSET + rng.randrange(users),
+                "timestamp": now - timedelta(seconds=rng.uniform(0, span)),
+            }
+            if rng.random() < 0.7:
+                row["used_chars"] = rng.randint(5, 4000)
+                row["cost"] = tts_cost(row["used_chars"])
+                tts_rows.append(row)
+            else:
+                row["used_seconds"] = rng.randint(1, 600)
+                row["cost"] = stt_cost(row["used_seconds"])
+                stt_rows.append(row)
+
+        async with db_manager.Session() as session:
+            if tts_rows:
+                await session.execute(insert(TextToSpeechActivity), tts_rows)
+            if stt_rows:
+                await session.execute(insert(SpeechToTextActivity), stt_rows)
+            await session.commit()
+
+        done = start + BATCH_SIZE
+        print(f"\r  loaded {min(done, rows)}/{rows} rows", end="", flush=True)
+    print(f"\n  {rows / (time.perf_counter() - t1):.0f} rows/s")
+
+
+async def timed(query, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        await query()
+        samples.append(time.perf_counter() - t1)
+    return statistics.median(samples) * 1000
+
+
+async def measure(db_manager: DBManager, user_id: int, repeat: int) -> dict:
+    month = month_start(datetime.now())
+
+    async def old(user_id=None):
+        async with db_manager.Session() as session:
+            for table in ("text_to_speech_activity", "speech_to_text_activity"):
+                sql = OLD_QUERY.format(table=table)
+                if user_id is not None:
+                    sql += " AND user_id = :user_id"
+                await session.scalar(text(sql), {"user_id": user_id})
+
+    async def new(user_id=None):
+        async with db_manager.Session() as session:
+            await db_manager._sum_month_cost(session, month, user_id)
+
+    return {
+        "date_trunc global": await timed(old, repeat),
+        "date_trunc user": await timed(lambda: old(user_id), repeat),
+        "month range global": await timed(new, repeat),
+        "month range user": await timed(lambda: new(user_id), repeat),
+    }
+
+
+async def set_indexes(db_manager: DBManager, present: bool):
+    async with db_manager.engine.begin() as conn:
+        for table in (TextToSpeechActivity.__table__, SpeechToTextActivity.__table__):
+            for index in table.indexes:
+                if present:
+                    await conn.run_sync(index.create, checkfirst=True)
+                else:
+                    await conn.run_sync(index.drop, checkfirst=True)
+
+
+async def main(args):
+    db_manager = DBManager(args.db_url, write_behind=False)
+    await upgrade(db_manager.engine)
+
+    if args.generate:
+        # load without the indexes, then build them once
+        await set_indexes(db_manager, present=False)
+        print(f"generating {args.generate} activity rows for {args.users} users")
+        await generate(db_manager, args.generate, args.users, args.months)
+
+    results = {}
+    for present in (False, True):
+        await set_indexes(db_manager, present)
+        results[present] = await measure(db_manager, USER_ID_OFFSET, args.repeat)
+
+    print(f"{'query':20s} {'no indexes':>12s} {'indexed':>12s}   (median ms)")
+    for name in results[False]:
+        print(f"{name:20s} {results[False][name]:12.2f} {results[True][name]:12.2f}")
+
+    await db_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--generate", type=int, default=0)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,184 @@
+"""
+Cold start: the import time of telegram_bot_tts.app, and the time from starting a
+fresh interpreter to the first update answered, /start registering a user against a
+sqlite database (or --db-url), with Telegram replaced by the fake Bot API.
+
+Each measurement runs in a new process. --migrate-at-boot runs the table creation
+and column reflection in post_init the way the bot did before migrations became a
+separate step:
+
+    PYTHONPATH=src python benchmarks/bench_startup.py --runs 5
+    PYTHONPATH=src python benchmarks/bench_startup.py --runs 5 --migrate-at-boot
+"""
+
+# nothing from the bot is imported at the top, the child process is timed on it
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def child_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    env.setdefault("ENV", "prod")
+    return env
+
+
+def import_time() -> tuple[float, list[tuple[str, float]]]:
+    # seconds to import the app, and its heaviest direct imports
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import telegram_bot_tts.app"],
+        env=child_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0.0
+    children = []
+    for line in result.stderr.splitlines():
+        if not (match := IMPORT_LINE.match(line)):
+            continue
+        cumulative, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        if name == "telegram_bot_tts.app":
+            total = cumulative / 1e6
+        elif len(indent) == 3:
+            children.append((name, cumulative / 1e6))
+    return total, sorted(children, key=lambda child: -child[1])[:8]
+
+
+async def first_update(args, db_url: str) -> tuple[float, float]:
+    """
+    Starts the bot in a new process and returns the seconds until it answered the
+    first update, and the import time the child measured.
+    """
+    from telegram_bot_tts.fakes import FakeTelegramServer, make_text_update
+
+    telegram = FakeTelegramServer(port=args.port)
+    telegram.updates = [make_text_update(1, 1, "/start")]
+    await telegram.start()
+
+    command = [sys.executable, __file__, "--child", telegram.base_url, db_url]
+    if args.migrate_at_boot:
+        command.append("--migrate-at-boot")
+
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        env=child_env(),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        # the welcome message, then the one sent once the user is registered
+        while len(telegram.sent) < 2:
+            if time.perf_counter() - start > args.timeout:
+                raise TimeoutError("the bot did not answer")
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        stdout, _ = await process.communicate()
+        await telegram.stop()
+
+    return elapsed, json.loads(stdout.splitlines()[0])["import"]
+
+
+def child(base_url: str, db_url: str, migrate_at_boot: bool):
+    # runs the bot the way app.py does, polling the fake Bot API
+    start = time.perf_counter()
+    from telegram_bot_tts import app as bot
+
+    print(json.dumps({"import": time.perf_counter() - start}), flush=True)
+
+    from telegram.ext import Application, CommandHandler
+
+    from telegram_bot_tts.components.commands import start as start_command
+    from telegram_bot_tts.clients import openai_client
+    from telegram_bot_tts.components.ults import LazyClient
+    from telegram_bot_tts.db.db_manager import DBManager
+    from telegram_bot_tts.db.migrations import add_missing_columns, create_tables
+    from telegram_bot_tts.profiling import LoopLagMonitor
+    from telegram_bot_tts.server import BotServer
+
+    db_manager = DBManager(db_url)
+    client = LazyClient(openai_client)
+    loop_monitor = LoopLagMonitor()
+
+    async def post_init(application):
+        if migrate_at_boot:
+            async with db_manager.engine.begin() as conn:
+                await conn.run_sync(create_tables)
+                await conn.run_sync(add_missing_columns)
+        await bot.post_init(application, db_manager, server, loop_monitor, client)
+
+    application = (
+        Application.builder()
+        .token("123:bench")
+        .base_url(base_url)
+        .post_init(post_init)
+        .build()
+    )
+    server = BotServer(application, "127.0.0.1", 0)
+    application.add_handler(
+        CommandHandler(
+            "start",
+            lambda update, context: start_command(update, context, db_manager),
+        )
+    )
+    application.run_polling(poll_interval=0)
+
+
+async def main(args):
+    from telegram_bot_tts.db.db_manager import DBManager
+    from telegram_bot_tts.db.migrations import upgrade
+
+    imports = []
+    for _ in range(args.runs):
+        total, heaviest = import_time()
+        imports.append(total)
+    print(f"import telegram_bot_tts.app: median {statistics.median(imports):.3f}s")
+    for name, seconds in heaviest:
+        print(f"  {name:40s} {seconds:.3f}s")
+
+    firsts = []
+    child_imports = []
+    for _ in range(args.runs):
+        db_url = args.db_url
+        if db_url is None:
+            # a migrated database, as the separate migration step leaves it
+            db_url = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+            db_manager = DBManager(db_url, write_behind=False)
+            await upgrade(db_manager.engine)
+            await db_manager.close()
+        elapsed, imported = await first_update(args, db_url)
+        firsts.append(elapsed)
+        child_imports.append(imported)
+
+    print(
+        f"time to first update{' (migrating at boot)' * args.migrate_at_boot}: "
+        f"median {statistics.median(firsts):.3f}s, max {max(firsts):.3f}s, "
+        f"of which imports {statistics.median(child_imports):.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], "--migrate-at-boot" in sys.argv)
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--db-url", help="an already migrated database to use")
+    parser.add_argument("--migrate-at-boot", action="store_true")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,96 @@
+"""
+Bytes uploaded to whisper and the processing time of trim_silence, on synthetic
+voice notes of tones with silence injected before, between and after them.
+
+Needs ffmpeg on the PATH (or FFMPEG_BINARY) to build the audio and to trim it:
+
+    PYTHONPATH=src python benchmarks/bench_trim.py --notes 20 --speech 10 \\
+        --silence 4 --bitrate 32k
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from telegram_bot_tts.components.audio import run_ffmpeg, trim_silence
+from telegram_bot_tts.db.db_manager import stt_cost
+
+
+async def make_note(
+    speech: float, silence: float, bitrate: str, rng: random.Random
+) -> tuple[bytes, float]:
+    # tones separated by silent gaps, encoded like a telegram voice note
+    spans = [("anullsrc=r=48000:cl=mono", rng.uniform(0, silence))]
+    for _ in range(3):
+        spans.append((f"sine=f={rng.randint(200, 800)}", rng.uniform(1, speech)))
+        spans.append(("anullsrc=r=48000:cl=mono", rng.uniform(0, silence)))
+
+    inputs = []
+    for source, duration in spans:
+        inputs += ["-f", "lavfi", "-i", f"{source}:d={duration:.2f}"]
+    concat = "".join(f"[{i}]" for i in range(len(spans)))
+
+    audio, _ = await run_ffmpeg(
+        inputs
+        + [
+            "-filter_complex",
+            f"{concat}concat=n={len(spans)}:v=0:a=1",
+            "-ac",
+            "1",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            bitrate,
+            "-f",
+            "ogg",
+            "pipe:1",
+        ],
+        b"",
+    )
+    return audio, sum(duration for _, duration in spans)
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    notes = [
+        await make_note(args.speech, args.silence, args.bitrate, rng)
+        for _ in range(args.notes)
+    ]
+
+    original_bytes = trimmed_bytes = 0
+    original_seconds = trimmed_seconds = 0.0
+    elapsed = []
+    for audio, duration in notes:
+        start = time.perf_counter()
+        trimmed, seconds = await trim_silence(audio)
+        elapsed.append(time.perf_counter() - start)
+
+        original_bytes += len(audio)
+        trimmed_bytes += len(trimmed)
+        original_seconds += duration
+        trimmed_seconds += seconds
+
+    print(f"notes: {len(notes)}")
+    print(
+        f"bytes uploaded: {original_bytes} -> {trimmed_bytes} "
+        f"({trimmed_bytes / original_bytes:.0%})"
+    )
+    print(
+        f"seconds billed: {original_seconds:.0f} -> {trimmed_seconds:.0f} "
+        f"(${stt_cost(original_seconds):.4f} -> ${stt_cost(trimmed_seconds):.4f})"
+    )
+    print(
+        f"trim time: mean {sum(elapsed) / len(elapsed) * 1000:.0f}ms, "
+        f"max {max(elapsed) * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=20)
+    parser.add_argument("--speech", type=float, default=10)
+    parser.add_argument("--silence", type=float, default=4)
+    parser.add_argument("--bitrate", default="32k")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+"""
+Load test of the webhook server: POSTs synthetic Update JSON to the local BotServer
+and measures how many updates per second make it through the Application.
+
+Telegram is replaced by telegram_bot_tts.fakes, so nothing leaves the machine:
+
+    PYTHONPATH=src python benchmarks/bench_webhook.py --updates 5000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from telegram.ext import Application, MessageHandler, filters
+
+from telegram_bot_tts.server import BotServer, SECRET_TOKEN_HEADER
+
+from telegram_bot_tts.fakes import FakeTelegramServer, make_text_update
+
+SECRET_TOKEN = "bench-secret"
+
+
+async def main(args):
+    telegram = FakeTelegramServer(port=args.port + 1)
+    await telegram.start()
+
+    processed = 0
+    done = asyncio.Event()
+
+    async def count(update, context):
+        nonlocal processed
+        processed += 1
+        if processed == args.updates:
+            done.set()
+
+    app = (
+        Application.builder()
+        .token("123:bench")
+        .base_url(telegram.base_url)
+        .concurrent_updates(args.concurrency)
+        .build()
+    )
+    app.add_handler(MessageHandler(filters.TEXT, count))
+
+    server = BotServer(
+        app, "127.0.0.1", args.port, webhook_path="/telegram", secret_token=SECRET_TOKEN
+    )
+
+    async with app:
+        await app.start()
+        await server.start()
+
+        url = f"http://127.0.0.1:{args.port}/telegram"
+        headers = {SECRET_TOKEN_HEADER: SECRET_TOKEN}
+        latencies = []
+        queue = asyncio.Queue()
+        for i in range(args.updates):
+            queue.put_nowait(make_text_update(i, i % args.users, "hello there"))
+
+        async def client(session: aiohttp.ClientSession):
+            while not queue.empty():
+                payload = queue.get_nowait()
+                t1 = time.perf_counter()
+                async with session.post(url, json=payload, headers=headers) as resp:
+                    assert resp.status == 200, resp.status
+                latencies.append(time.perf_counter() - t1)
+
+        t1 = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+            accepted = time.perf_counter() - t1
+            await asyncio.wait_for(done.wait(), timeout=60)
+            elapsed = time.perf_counter() - t1
+
+            # a wrong secret token is rejected before the update is parsed
+            async with session.post(url, json={}, headers={}) as resp:
+                assert resp.status == 403
+
+        await server.stop()
+        await app.stop()
+
+    await telegram.stop()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{args.updates} updates, {args.concurrency} concurrent posters")
+    print(f"accepted : {args.updates / accepted:10.1f} updates/s")
+    print(f"processed: {args.updates / elapsed:10.1f} updates/s")
+    print(f"post latency p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8090)
+    asyncio.run(main(parser.parse_args()))
@@ -1,30 +1,204 @@
-from typing import Final
+import asyncio
+import re
+import sys
+from pathlib import Path
+from typing import Final, Optional
+from prometheus_client import REGISTRY
 from telegram import Update
 from telegram.ext import (
     MessageHandler,
-    filters,
     Application,
     CommandHandler,
 )
-from openai import AsyncOpenAI
 
 from telegram_bot_tts.logger import setup_logger
-from telegram_bot_tts.constants import TOKEN, ENV
-from telegram_bot_tts.components.ults import create_audio_folder
-from telegram_bot_tts.components.commands import start, help
+from telegram_bot_tts.constants import (
+    TOKEN,
+    ENV,
+    LOG_JSON,
+    LOG_DEBUG_SAMPLE_RATE,
+    RECORD_UPDATES_PATH,
+    RECORD_UPDATES_SALT,
+    AUDIO_FOLDER,
+    TTS_CACHE_MAX_BYTES,
+    TTS_FILE_EXTENSION,
+    BOT_MODE,
+    POLL_INTERVAL,
+    SERVER_HOST,
+    SERVER_PORT,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    MAX_CONCURRENT_UPDATES,
+    MAX_PENDING_UPDATES,
+    TELEGRAM_POOL_SIZE,
+    TELEGRAM_UPDATES_POOL_SIZE,
+    TELEGRAM_POOL_TIMEOUT,
+    TELEGRAM_KEEPALIVE_EXPIRY,
+    TELEGRAM_HTTP2,
+    TELEGRAM_WARM_CONNECTIONS,
+    OPENAI_WARM_CONNECTIONS,
+    OPENAI_TTS_DEADLINE,
+    OPENAI_STT_DEADLINE,
+    OPENAI_RETRIES,
+    OPENAI_RETRY_BACKOFF,
+    OPENAI_HEDGE_RATIO,
+    OPENAI_HEDGE_QUANTILE,
+    OPENAI_CIRCUIT_FAILURES,
+    OPENAI_CIRCUIT_RESET,
+    OPENAI_INITIAL_LIMIT,
+    OPENAI_LATENCY_TOLERANCE,
+    OPENAI_LIMIT_BACKOFF,
+    OPENAI_MAX_QUEUE_WAIT,
+    MAX_CONCURRENT_TTS,
+    MAX_CONCURRENT_STT,
+    MAX_CONCURRENT_JOBS,
+    VIP_RESERVED_JOBS,
+    VIP_MAX_CONCURRENT_TTS,
+    VIP_MAX_CONCURRENT_STT,
+    FREE_LANE_SHARE,
+    LOOP_LAG_INTERVAL,
+    LOOP_STALL_THRESHOLD,
+    PROFILE_FOLDER,
+    PROFILE_SAMPLE_INTERVAL,
+    RATE_LIMITS,
+    VIP_RATE_LIMITS,
+    VIP_USER_ID_LIST,
+    SPEND_RESYNC_INTERVAL,
+    TRANSCRIPT_CACHE_SIZE,
+    TRANSCRIPT_CACHE_TTL,
+    TRANSCRIPT_CACHE_PERSIST,
+)
+from telegram_bot_tts.components.ults import LazyClient, create_audio_folder
+from telegram_bot_tts.components.commands import start, balance, profile, help
 from telegram_bot_tts.components.handlers import (
     handle_text_message,
     handle_voice_message,
     error,
 )
+from telegram_bot_tts.components.admission import text_admission, voice_admission
+from telegram_bot_tts.components.cache import AudioCache, TranscriptCache
+from telegram_bot_tts.components.resilience import ApiGuard, ApiGuards, CircuitBreaker
+from telegram_bot_tts.components.concurrency import (
+    AdaptiveLimit,
+    ApiLimits,
+    ChatOrderedUpdateProcessor,
+    FairScheduler,
+)
+from telegram_bot_tts.clients import InstrumentedHTTPXRequest, openai_client, warm_up
 from telegram_bot_tts.db.db_manager import DBManager
+from telegram_bot_tts.db.migrations import LATEST_VERSION, current_version
+from telegram_bot_tts.metrics import StatsCollector
+from telegram_bot_tts.profiling import LoopLagMonitor, SamplingProfiler
+from telegram_bot_tts.recording import UpdateRecorder
+from telegram_bot_tts.server import BotServer, run_webhook
+
+
+logger = setup_logger("telegram_bot_tts", ENV, LOG_JSON, LOG_DEBUG_SAMPLE_RATE)
+
+
+async def warm_up_clients(app: Application, client: LazyClient):
+    # connections to both apis are opened before the first burst needs them, the
+    # openai client is built off the loop first
+    async def warm_up_openai():
+        await asyncio.to_thread(client.load)
+        await warm_up("openai", client.models.list, OPENAI_WARM_CONNECTIONS)
+
+    await asyncio.gather(
+        warm_up("telegram", app.bot.get_me, TELEGRAM_WARM_CONNECTIONS),
+        warm_up_openai(),
+    )
+
+
+async def post_init(
+    app: Application,
+    db_manager: DBManager,
+    server: BotServer,
+    loop_monitor: LoopLagMonitor,
+    client: LazyClient,
+):
+    # the schema is migrated by a separate step before deploying, here it's only
+    # checked, a bot on an older schema would fail on its first writes
+    schema_version = await current_version(db_manager.engine)
+    if schema_version < LATEST_VERSION:
+        raise RuntimeError(
+            f"database schema is at version {schema_version} of {LATEST_VERSION}, "
+            "run python -m telegram_bot_tts.db.migrations upgrade"
+        )
+
+    # event loop lag and stalls, from the start
+    loop_monitor.start()
+
+    # warm the http pools while the first updates come in, the task is kept so it
+    # isn't collected mid-way and can be cancelled on shutdown
+    app.bot_data["warm_up"] = asyncio.create_task(warm_up_clients(app, client))
+
+    # this month's spend for the quota checks
+    await db_manager.load_monthly_spend()
+    db_manager.start_monthly_spend_resync(SPEND_RESYNC_INTERVAL)
 
+    # health, readiness and (in webhook mode) the webhook route
+    await server.start()
 
-logger = setup_logger("telegram_bot_tts", ENV)
+
+async def post_shutdown(
+    app: Application,
+    db_manager: DBManager,
+    audio_cache: AudioCache,
+    transcript_cache: TranscriptCache,
+    scheduler: FairScheduler,
+    server: BotServer,
+    loop_monitor: LoopLagMonitor,
+    recorder: Optional[UpdateRecorder],
+):
+    logger.info(f"user cache stats: {db_manager.user_cache.stats()}")
+    logger.info(f"tts audio cache stats: {audio_cache.stats()}")
+    logger.info(f"transcript cache stats: {transcript_cache.stats()}")
+    logger.info(f"scheduler stats: {scheduler.stats()}")
+
+    # a bot stopped right after starting may still be warming up
+    warm_up_task = app.bot_data.pop("warm_up", None)
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+        try:
+            await warm_up_task
+        except asyncio.CancelledError:
+            pass
+
+    await server.stop()
+    await loop_monitor.stop()
+    if recorder is not None:
+        recorder.close()
+
+    # drain the buffered activities and release the pooled db connections
+    await db_manager.close()
+    if db_manager.activity_buffer is not None:
+        logger.info(f"activity buffer stats: {db_manager.activity_buffer.stats()}")
+
+
+def webhook_config_errors() -> list[str]:
+    # telegram only posts to https urls, and without the secret token anyone who
+    # finds the route can post fake updates to it
+    errors = []
+    if not WEBHOOK_URL:
+        errors.append("WEBHOOK_URL is not set")
+    elif not WEBHOOK_URL.startswith("https://"):
+        errors.append(f"WEBHOOK_URL {WEBHOOK_URL!r} is not an https url")
+    if not WEBHOOK_SECRET_TOKEN:
+        errors.append("WEBHOOK_SECRET_TOKEN is not set")
+    elif not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET_TOKEN):
+        errors.append(
+            "WEBHOOK_SECRET_TOKEN must be 1-256 characters of A-Z, a-z, 0-9, _ and -"
+        )
+    return errors
 
 
 if __name__ == "__main__":
 
+    # a misconfigured webhook fails here, before anything is started
+    if BOT_MODE == "webhook" and (errors := webhook_config_errors()):
+        sys.exit("BOT_MODE is webhook but " + ", ".join(errors))
+
     # the timeout varibles will be set here
     READ_TIMEOUT = 180
     WRITE_TIMEOUT = 180
@@ -32,21 +206,157 @@ if __name__ == "__main__":
     # create the audio folder
     create_audio_folder()
 
-    # create the openai client
-    client = AsyncOpenAI()
+    # the openai client is built on first use, not at import
+    client = LazyClient(openai_client)
+
+    # create the tts audio cache, it survives restarts on the audio volume
+    audio_cache = AudioCache(
+        Path(AUDIO_FOLDER) / "cache", TTS_CACHE_MAX_BYTES, TTS_FILE_EXTENSION
+    )
+
+    # deadlines, retries, hedging, a circuit breaker and an adaptive concurrency
+    # limit around the openai calls
+    guards = ApiGuards(
+        *(
+            ApiGuard(
+                api,
+                deadline,
+                retries=OPENAI_RETRIES,
+                backoff=OPENAI_RETRY_BACKOFF,
+                hedge_ratio=OPENAI_HEDGE_RATIO,
+                hedge_quantile=OPENAI_HEDGE_QUANTILE,
+                breaker=CircuitBreaker(
+                    api, OPENAI_CIRCUIT_FAILURES, OPENAI_CIRCUIT_RESET
+                ),
+                limiter=AdaptiveLimit(
+                    api,
+                    initial=OPENAI_INITIAL_LIMIT,
+                    max_limit=max_limit,
+                    max_wait=OPENAI_MAX_QUEUE_WAIT,
+                    backoff=OPENAI_LIMIT_BACKOFF,
+                    tolerance=OPENAI_LATENCY_TOLERANCE,
+                ),
+            )
+            for api, deadline, max_limit in (
+                (
+                    "tts",
+                    OPENAI_TTS_DEADLINE,
+                    MAX_CONCURRENT_TTS + VIP_MAX_CONCURRENT_TTS,
+                ),
+                (
+                    "stt",
+                    OPENAI_STT_DEADLINE,
+                    MAX_CONCURRENT_STT + VIP_MAX_CONCURRENT_STT,
+                ),
+            )
+        )
+    )
+
+    # cap the in-flight openai calls
+    limits = ApiLimits(MAX_CONCURRENT_TTS, MAX_CONCURRENT_STT)
+
+    # per-user rate limits, admitted work is served round-robin across users with
+    # the vip users in a lane of their own
+    scheduler = FairScheduler(
+        MAX_CONCURRENT_JOBS,
+        RATE_LIMITS,
+        VIP_RATE_LIMITS,
+        VIP_USER_ID_LIST,
+        lane_limits={
+            "vip": ApiLimits(VIP_MAX_CONCURRENT_TTS, VIP_MAX_CONCURRENT_STT),
+            "free": limits,
+        },
+        vip_reserved=VIP_RESERVED_JOBS,
+        free_share=FREE_LANE_SHARE,
+    )
 
     # create the db manager
     db_manager = DBManager()
 
+    # transcripts of forwarded voice notes, optionally persisted in the db
+    transcript_cache = TranscriptCache(
+        TRANSCRIPT_CACHE_SIZE,
+        TRANSCRIPT_CACHE_TTL,
+        db_manager if TRANSCRIPT_CACHE_PERSIST else None,
+    )
+
+    # loop lag is always on, the profiler only runs on /profile
+    loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
+    profiler = SamplingProfiler(PROFILE_FOLDER, PROFILE_SAMPLE_INTERVAL)
+
+    # opt-in, anonymized recording of the incoming traffic for load tests
+    recorder = None
+    if RECORD_UPDATES_PATH:
+        recorder = UpdateRecorder(RECORD_UPDATES_PATH, RECORD_UPDATES_SALT)
+        logger.info(f"recording updates to {RECORD_UPDATES_PATH}")
+
     logger.info("starting bot...")
     app = (
         Application.builder()
         .token(TOKEN)
-        .read_timeout(READ_TIMEOUT)
-        .write_timeout(WRITE_TIMEOUT)
+        .request(
+            InstrumentedHTTPXRequest(
+                "telegram",
+                connection_pool_size=TELEGRAM_POOL_SIZE,
+                read_timeout=READ_TIMEOUT,
+                write_timeout=WRITE_TIMEOUT,
+                media_write_timeout=WRITE_TIMEOUT,
+                pool_timeout=TELEGRAM_POOL_TIMEOUT,
+                http_version="2" if TELEGRAM_HTTP2 else "1.1",
+                keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+            )
+        )
+        # the long poll holds its connection, it gets a pool of its own
+        .get_updates_request(
+            InstrumentedHTTPXRequest(
+                "telegram_updates",
+                connection_pool_size=TELEGRAM_UPDATES_POOL_SIZE,
+                pool_timeout=TELEGRAM_POOL_TIMEOUT,
+                http_version="2" if TELEGRAM_HTTP2 else "1.1",
+                keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+            )
+        )
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(
+                MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES, recorder
+            )
+        )
+        .post_init(lambda app: post_init(app, db_manager, server, loop_monitor, client))
+        .post_shutdown(
+            lambda app: post_shutdown(
+                app,
+                db_manager,
+                audio_cache,
+                transcript_cache,
+                scheduler,
+                server,
+                loop_monitor,
+                recorder,
+            )
+        )
         .build()
     )
 
+    # queue depths, cache and buffer stats are read when /metrics is scraped
+    REGISTRY.register(
+        StatsCollector(
+            scheduler,
+            db_manager,
+            user=db_manager.user_cache,
+            tts_audio=audio_cache,
+            transcript=transcript_cache,
+        )
+    )
+
+    # create the local http server
+    server = BotServer(
+        app,
+        SERVER_HOST,
+        SERVER_PORT,
+        webhook_path=WEBHOOK_PATH if BOT_MODE == "webhook" else None,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+    )
+
     # Commands
 
     app.add_handler(
@@ -55,16 +365,36 @@ if __name__ == "__main__":
         )
     )
 
+    app.add_handler(
+        CommandHandler(
+            "balance", lambda update, context: balance(update, context, db_manager)
+        )
+    )
+
+    app.add_handler(
+        CommandHandler(
+            "profile", lambda update, context: profile(update, context, profiler)
+        )
+    )
+
     app.add_handler(
         CommandHandler("help", lambda update, context: help(update, context))
     )
 
-    # text Messages
+    # text Messages, the ones the bot won't answer are dropped before any work
     app.add_handler(
         MessageHandler(
-            filters.TEXT,
+            text_admission(),
             lambda update, context: handle_text_message(
-                update, context, logger, client, db_manager
+                update,
+                context,
+                logger,
+                client,
+                db_manager,
+                audio_cache,
+                limits,
+                scheduler,
+                guards,
             ),
         )
     )
@@ -72,9 +402,17 @@ if __name__ == "__main__":
     # add voice message handler
     app.add_handler(
         MessageHandler(
-            filters.VOICE,
+            voice_admission(),
             lambda update, context: handle_voice_message(
-                update, context, logger, client, db_manager
+                update,
+                context,
+                logger,
+                client,
+                db_manager,
+                limits,
+                transcript_cache,
+                scheduler,
+                guards,
             ),
         )
     )
@@ -82,7 +420,12 @@ if __name__ == "__main__":
     # Error
     app.add_error_handler(lambda update, context: error(update, context, logger))
 
-    # polls the bot
-    logger.info("Polling...")
+    if BOT_MODE == "webhook":
+        # telegram pushes the updates to the local server
+        logger.info("Serving webhook...")
+        asyncio.run(run_webhook(app, WEBHOOK_URL + WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN))
+    else:
+        # polls the bot
+        logger.info("Polling...")
 
-    app.run_polling(poll_interval=3)
+        app.run_polling(poll_interval=POLL_INTERVAL)
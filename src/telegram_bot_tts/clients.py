@@ -0,0 +1,121 @@
+"""
+The http clients of the bot: the pools for the Bot API and the OpenAI api, the
+pool wait instrumentation shared by both, and the connection warm-up at startup.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import httpx
+from telegram.request import HTTPXRequest
+
+from telegram_bot_tts.constants import (
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_HTTP2,
+)
+from telegram_bot_tts.metrics import HTTP_CONNECTIONS, HTTP_POOL_WAIT
+
+logger = logging.getLogger(__name__)
+
+# the first thing httpcore does once a request has a connection, either opening it
+# or sending on one that is already open
+CONNECTION_EVENTS = (
+    "connection.connect_tcp.started",
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+)
+
+
+def pool_wait_hook(name: str):
+    """
+    An httpx request event hook recording how long every request waits for a
+    connection from the pool into the pool wait histogram, and the connections
+    opened. Whatever the request takes beyond that is the upstream's.
+    """
+
+    async def on_request(request: httpx.Request):
+        start = time.perf_counter()
+
+        async def trace(event: str, info: dict):
+            nonlocal start
+            if start is None or event not in CONNECTION_EVENTS:
+                return
+            HTTP_POOL_WAIT.labels(name).observe(time.perf_counter() - start)
+            if event.startswith("connection."):
+                HTTP_CONNECTIONS.labels(name).inc()
+            start = None
+
+        request.extensions["trace"] = trace
+
+    return on_request
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """
+    PTB's HTTPXRequest with a keepalive expiry and the pool wait of its requests
+    recorded under `name`.
+    """
+
+    def __init__(self, name: str, *args, keepalive_expiry: float = 5.0, **kwargs):
+        # read by _build_client, which the parent's __init__ calls
+        self.name = name
+        self.keepalive_expiry = keepalive_expiry
+        super().__init__(*args, **kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        return httpx.AsyncClient(
+            **{
+                **self._client_kwargs,
+                "limits": httpx.Limits(
+                    max_connections=limits.max_connections,
+                    max_keepalive_connections=limits.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+            },
+            event_hooks={"request": [pool_wait_hook(self.name)]},
+        )
+
+
+def openai_client():
+    # importing openai is a good part of the bot's import time, so it's done here
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    # retries are left to the ApiGuards, which also know when to stop
+    return AsyncOpenAI(
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            http2=OPENAI_HTTP2,
+            event_hooks={"request": [pool_wait_hook("openai")]},
+        ),
+    )
+
+
+async def warm_up(name: str, call: Callable[[], Awaitable], connections: int) -> int:
+    """
+    Opens `connections` connections ahead of the first updates, by making that many
+    cheap `call`s at once. Returns how many succeeded, failures are only logged.
+    """
+    if connections <= 0:
+        return 0
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(call() for _ in range(connections)), return_exceptions=True
+    )
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        logger.warning(f"{name} warm-up: {len(failed)} calls failed: {failed[0]}")
+    logger.info(
+        f"{name} warm-up: {connections - len(failed)} connections in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    return connections - len(failed)
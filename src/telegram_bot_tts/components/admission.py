@@ -0,0 +1,128 @@
+"""
+The admission pipeline in front of the message handlers: checks on the update alone,
+run by the dispatcher before a handler is picked, so the messages the bot won't
+answer never cost a db query or a request.
+
+Each stage is a filter that counts the messages it drops. Filters combined with `&`
+stop at the first one that fails, so every message is counted once, by the first
+stage that turned it away.
+"""
+
+from typing import Callable
+
+from telegram import Message, MessageEntity, Update
+from telegram.ext import filters
+
+from telegram_bot_tts.constants import (
+    ALLOWED_CHAT_TYPES,
+    BOT_USERNAME,
+    MAX_INPUT_CHARS,
+    MAX_VOICE_BYTES,
+)
+from telegram_bot_tts.metrics import ADMISSION_DROPPED
+
+GROUP_CHATS = ("group", "supergroup")
+
+
+class Stage(filters.UpdateFilter):
+    """Lets the updates through that `check` accepts, counts the others as dropped."""
+
+    def __init__(self, kind: str, stage: str, check: Callable[[Update], bool]):
+        super().__init__(name=f"{kind}:{stage}")
+        self.kind = kind
+        self.stage = stage
+        self.check = check
+
+    def filter(self, update: Update) -> bool:
+        if self.check(update):
+            return True
+        ADMISSION_DROPPED.labels(self.kind, self.stage).inc()
+        return False
+
+
+def is_new_message(update: Update) -> bool:
+    # edits and channel posts are not answered
+    return update.message is not None and update.message.from_user is not None
+
+
+def is_allowed_chat(update: Update) -> bool:
+    return update.message.chat.type in ALLOWED_CHAT_TYPES
+
+
+def is_command(message: Message) -> bool:
+    # the commands the bot knows are handled before, the rest are no speech
+    entities = message.entities
+    return bool(entities) and (
+        entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0
+    )
+
+
+def bot_mentions(message: Message) -> list[MessageEntity]:
+    # usernames are case-insensitive, @OpenAITTS_bot mentions the bot too
+    return [
+        entity
+        for entity, mention in message.parse_entities([MessageEntity.MENTION]).items()
+        if mention.lower() == BOT_USERNAME.lower()
+    ]
+
+
+def is_addressed(message: Message) -> bool:
+    """
+    Whether a message is meant for the bot: any message in a private chat, in a
+    group one that mentions the bot or replies to it.
+    """
+    if message.chat.type not in GROUP_CHATS:
+        return True
+    if bot_mentions(message):
+        return True
+    replied = message.reply_to_message
+    return (
+        replied is not None
+        and replied.from_user is not None
+        and replied.from_user.is_bot
+        and f"@{replied.from_user.username}".lower() == BOT_USERNAME.lower()
+    )
+
+
+def spoken_text(message: Message) -> str:
+    """
+    What would be read out: a group message without the mentions of the bot that
+    addressed it. Entity offsets count utf-16 code units, so they're cut there.
+    """
+    if message.chat.type not in GROUP_CHATS:
+        return message.text.strip()
+    text = message.text.encode("utf-16-le")
+    for entity in sorted(bot_mentions(message), key=lambda e: e.offset, reverse=True):
+        text = text[: 2 * entity.offset] + text[2 * (entity.offset + entity.length) :]
+    return text.decode("utf-16-le").strip()
+
+
+def text_admission() -> filters.BaseFilter:
+    def stage(name: str, check: Callable[[Update], bool]) -> Stage:
+        return Stage("text", name, check)
+
+    return (
+        filters.TEXT
+        & stage("update_type", is_new_message)
+        & stage("chat_type", is_allowed_chat)
+        & stage("command", lambda update: not is_command(update.message))
+        & stage("not_addressed", lambda update: is_addressed(update.message))
+        & stage("empty", lambda update: bool(spoken_text(update.message)))
+        & stage("oversized", lambda update: len(update.message.text) <= MAX_INPUT_CHARS)
+    )
+
+
+def voice_admission() -> filters.BaseFilter:
+    def stage(name: str, check: Callable[[Update], bool]) -> Stage:
+        return Stage("voice", name, check)
+
+    # bots can't download larger files, the size is known from the update
+    return (
+        filters.VOICE
+        & stage("update_type", is_new_message)
+        & stage("chat_type", is_allowed_chat)
+        & stage(
+            "oversized",
+            lambda update: (update.message.voice.file_size or 0) <= MAX_VOICE_BYTES,
+        )
+    )
@@ -0,0 +1,187 @@
+import asyncio
+import re
+import shutil
+
+from telegram_bot_tts.constants import (
+    FFMPEG_BINARY,
+    STT_SILENCE_THRESHOLD_DB,
+    STT_MIN_SILENCE,
+    STT_KEEP_SILENCE,
+    STT_UPLOAD_BITRATE,
+)
+
+
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+PROGRESS_TIME = re.compile(r"time=(\d+):(\d+):([\d.]+)")
+
+
+def ffmpeg_available() -> bool:
+    # ffmpeg is an optional system dependency, without it long notes go in one piece
+    return shutil.which(FFMPEG_BINARY) is not None
+
+
+async def run_ffmpeg(args: list[str], audio: bytes) -> tuple[bytes, bytes]:
+    # feed the audio on stdin, returns (stdout, stderr)
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY,
+        "-hide_banner",
+        *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate(audio)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"ffmpeg exited with {process.returncode}: {stderr.decode()[-500:]}"
+        )
+    return stdout, stderr
+
+
+def parse_silences(log: str) -> list[tuple[float, float]]:
+    """
+    Reads the (start, end) pairs printed by ffmpeg's silencedetect filter. A
+    silence running to the end of the audio has no end line and is dropped.
+    """
+    silences = []
+    start = None
+    for line in log.splitlines():
+        if match := SILENCE_START.search(line):
+            start = max(float(match.group(1)), 0.0)
+        elif (match := SILENCE_END.search(line)) and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    return silences
+
+
+async def detect_silences(
+    audio: bytes,
+    threshold_db: float = STT_SILENCE_THRESHOLD_DB,
+    min_silence: float = STT_MIN_SILENCE,
+) -> list[tuple[float, float]]:
+    # decode the whole note once, nothing is written out
+    _, stderr = await run_ffmpeg(
+        [
+            "-i",
+            "pipe:0",
+            "-af",
+            f"silencedetect=noise={threshold_db}dB:d={min_silence}",
+            "-f",
+            "null",
+            "-",
+        ],
+        audio,
+    )
+    return parse_silences(stderr.decode(errors="replace"))
+
+
+def parse_duration(log: str) -> float:
+    # the last progress line of an ffmpeg run has the length of the output
+    matches = PROGRESS_TIME.findall(log)
+    if not matches:
+        raise ValueError("no progress line in the ffmpeg output")
+    hours, minutes, seconds = matches[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+async def trim_silence(
+    audio: bytes,
+    threshold_db: float = STT_SILENCE_THRESHOLD_DB,
+    min_silence: float = STT_MIN_SILENCE,
+    keep_silence: float = STT_KEEP_SILENCE,
+    bitrate: str = STT_UPLOAD_BITRATE,
+) -> tuple[bytes, float]:
+    """
+    Cuts the leading silence and every pause longer than `min_silence` down to
+    `keep_silence`, and re-encodes the voice note as mono 16 kHz opus at `bitrate`.
+
+    Returns the trimmed audio and its duration in seconds.
+    """
+    stdout, stderr = await run_ffmpeg(
+        [
+            "-i",
+            "pipe:0",
+            "-af",
+            f"silenceremove=start_periods=1:start_threshold={threshold_db}dB"
+            f":stop_periods=-1:stop_duration={min_silence}"
+            f":stop_threshold={threshold_db}dB:stop_silence={keep_silence}",
+            "-ac",
+            "1",
+            "-ar",
+            "16000",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            bitrate,
+            "-application",
+            "voip",
+            "-f",
+            "ogg",
+            "pipe:1",
+        ],
+        audio,
+    )
+    return stdout, parse_duration(stderr.decode(errors="replace"))
+
+
+def plan_segments(
+    silences: list[tuple[float, float]], duration: float, max_seconds: float
+) -> list[tuple[float, float]]:
+    """
+    Cuts [0, duration] into (start, end) segments of at most `max_seconds`, at the
+    middle of the last silence that fits, or hard at the limit when none does.
+    """
+    cuts = sorted((start + end) / 2 for start, end in silences)
+
+    segments = []
+    cursor = 0.0
+    while duration - cursor > max_seconds:
+        fitting = [cut for cut in cuts if cursor < cut <= cursor + max_seconds]
+        end = fitting[-1] if fitting else cursor + max_seconds
+        segments.append((cursor, end))
+        cursor = end
+
+    segments.append((cursor, duration))
+    return segments
+
+
+async def cut_segment(audio: bytes, start: float, end: float) -> bytes:
+    # copy the opus packets as they are, no re-encoding
+    stdout, _ = await run_ffmpeg(
+        [
+            "-i",
+            "pipe:0",
+            "-ss",
+            f"{start:.3f}",
+            "-to",
+            f"{end:.3f}",
+            "-c:a",
+            "copy",
+            "-f",
+            "ogg",
+            "pipe:1",
+        ],
+        audio,
+    )
+    return stdout
+
+
+async def split_on_silence(
+    audio: bytes, duration: float, max_seconds: float
+) -> list[tuple[bytes, float]]:
+    """
+    Splits an ogg/opus voice note at silence gaps into ogg segments of at most
+    `max_seconds` each.
+
+    Returns (segment, seconds) pairs in order.
+    """
+    silences = await detect_silences(audio)
+    segments = plan_segments(silences, duration, max_seconds)
+    if len(segments) == 1:
+        return [(audio, duration)]
+
+    cuts = await asyncio.gather(
+        *(cut_segment(audio, start, end) for start, end in segments)
+    )
+    return [(cut, end - start) for cut, (start, end) in zip(cuts, segments)]
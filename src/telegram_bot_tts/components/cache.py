@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded in-memory LRU cache where every entry expires after a ttl.
+
+    `get` returns None on a miss, so None can't be stored as a value. `peek` looks
+    without counting a hit or a miss or refreshing the entry.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        # evict the least recently used entries
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class AudioCache:
+    """
+    Content-addressed cache of synthesized speech.
+
+    Audio is stored on disk as `<sha256 of text, model and voice>.<ext>` and evicted
+    least recently used first once the folder grows over `max_bytes`. After the first
+    upload the Telegram file_id is remembered, so a repeat is answered without an
+    OpenAI call or a re-upload.
+
+    New audio is written to a `temp_path()` and moved into place by `store()`, so a
+    cached file is never seen half written and replacing it doesn't disturb an
+    upload reading the old one.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int, extension: str = "mp3"):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.total_bytes = 0
+        # key -> [size, file_id], in least recently used order
+        self._entries: OrderedDict[str, list] = OrderedDict()
+
+        self.folder.mkdir(exist_ok=True, parents=True)
+
+        # audio still being written when the previous run stopped
+        for path in self.folder.glob("*.part"):
+            path.unlink(missing_ok=True)
+
+        # pick up the audio left over from the previous run, oldest first
+        files = sorted(
+            self.folder.glob(f"*.{self.extension}"), key=lambda p: p.stat().st_mtime
+        )
+        for path in files:
+            self._entries[path.stem] = [path.stat().st_size, None]
+            self.total_bytes += path.stat().st_size
+        self._evict()
+
+    @staticmethod
+    def key(text: str, model: str, voice: str) -> str:
+        return hashlib.sha256(f"{model}\0{voice}\0{text}".encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.folder / f"{key}.{self.extension}"
+
+    def get(self, key: str) -> Optional[tuple[Path, Optional[str]]]:
+        """Returns (path, file_id) of a cached entry, file_id is None until uploaded."""
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += entry[0]
+        return self.path(key), entry[1]
+
+    def temp_path(self) -> Path:
+        # a private file in the cache folder, on the same filesystem for store()
+        fd, name = tempfile.mkstemp(dir=self.folder, suffix=".part")
+        os.close(fd)
+        return Path(name)
+
+    def store(self, key: str, source: Path):
+        """Moves the audio written to `source` into the cache in one step."""
+        os.replace(source, self.path(key))
+        self.add(key)
+
+    def add(self, key: str):
+        """Registers the audio written to `path(key)`."""
+        size = self.path(key).stat().st_size
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= previous[0]
+
+        self._entries[key] = [size, None]
+        self.total_bytes += size
+        self._evict()
+
+    def set_file_id(self, key: str, file_id: str):
+        if key in self._entries:
+            self._entries[key][1] = file_id
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, (size, _) = self._entries.popitem(last=False)
+            self.path(key).unlink(missing_ok=True)
+            self.total_bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class TranscriptCache:
+    """
+    Transcripts keyed on Telegram's file_unique_id, with a sha256 of the audio as a
+    fallback for the same recording uploaded as a different file. Concurrent
+    requests for the same file share one in-flight transcription.
+
+    Entries live in a bounded in-memory cache and, when `db_manager` is given, are
+    persisted in the transcripts table so they survive restarts.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, db_manager=None):
+        self.db_manager = db_manager
+        self.shared = 0
+        self._by_file = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._by_hash = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def content_hash(audio: bytes) -> str:
+        return hashlib.sha256(audio).hexdigest()
+
+    def get(self, file_unique_id: str) -> Optional[str]:
+        return self._by_file.get(file_unique_id)
+
+    def peek(self, file_unique_id: str) -> Optional[str]:
+        # for a check ahead of get_or_transcribe, which counts the lookup
+        return self._by_file.peek(file_unique_id)
+
+    async def get_or_transcribe(
+        self,
+        file_unique_id: str,
+        download: Callable[[], Awaitable[bytes]],
+        transcribe: Callable[[bytes], Awaitable[str]],
+    ) -> tuple[str, bool]:
+        """
+        Returns (text, transcribed), where transcribed is True only for the caller
+        whose request actually went to the transcription api. If the caller that
+        started a transcription is cancelled, the ones waiting on it start over.
+        """
+        text = self._by_file.get(file_unique_id)
+        if text is not None:
+            return text, False
+
+        shared = self._in_flight.get(file_unique_id)
+        if shared is not None:
+            try:
+                text = await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                # cancelled with the update that started it, not this one
+                if not shared.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                return await self.get_or_transcribe(
+                    file_unique_id, download, transcribe
+                )
+            self.shared += 1
+            return text, False
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[file_unique_id] = future
+        try:
+            text, transcribed = await self._lookup_or_transcribe(
+                file_unique_id, download, transcribe
+            )
+            future.set_result(text)
+            return text, transcribed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved, it is re-raised here and to every waiter
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[file_unique_id]
+
+    async def _lookup_or_transcribe(self, file_unique_id, download, transcribe):
+        if self.db_manager is not None:
+            text = await self.db_manager.get_transcript(file_unique_id=file_unique_id)
+            if text is not None:
+                self._by_file.set(file_unique_id, text)
+                return text, False
+
+        audio = await download()
+        content_hash = self.content_hash(audio)
+
+        text = self._by_hash.get(content_hash)
+        if text is None and self.db_manager is not None:
+            text = await self.db_manager.get_transcript(content_hash=content_hash)
+
+        transcribed = text is None
+        if transcribed:
+            text = await transcribe(audio)
+            if self.db_manager is not None:
+                await self.db_manager.save_transcript(
+                    file_unique_id, content_hash, text
+                )
+
+        self._by_file.set(file_unique_id, text)
+        self._by_hash.set(content_hash, text)
+        return text, transcribed
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._by_file),
+            "file_hits": self._by_file.hits,
+            "file_misses": self._by_file.misses,
+            "hash_hits": self._by_hash.hits,
+            "misses": self._by_hash.misses,
+            "shared": self.shared,
+        }
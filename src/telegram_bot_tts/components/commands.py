@@ -1,7 +1,13 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
+from telegram_bot_tts.constants import (
+    FREE_MONTHLY_QUOTA,
+    ADMIN_USER_ID_LIST,
+    PROFILE_MAX_SECONDS,
+)
 from telegram_bot_tts.db.db_manager import DBManager
+from telegram_bot_tts.profiling import SamplingProfiler, top_functions
 
 
 # commands
@@ -19,10 +25,10 @@ async def start(
     )
 
     # check if the user is already registered
-    if not db_manager.is_user_registered(update.message.from_user.id):
+    if not await db_manager.is_user_registered(update.message.from_user.id):
 
         # register the user
-        if db_manager.register_user(
+        if await db_manager.register_user(
             update.message.from_user.id,
             username=update.message.from_user.username,
             first_name=update.message.from_user.first_name,
@@ -53,7 +59,56 @@ async def subscribe(
 async def balance(
     update: Update, context: ContextTypes.DEFAULT_TYPE, db_manager: DBManager
 ):
-    pass
+    user_id = update.message.from_user.id
+
+    if not await db_manager.is_user_registered(user_id):
+        await update.message.reply_text("Please use /start cmd to register first.")
+        return
+
+    balance = await db_manager.get_balance(user_id)
+
+    if balance is None:
+        await update.message.reply_text(
+            "Error getting your balance. Please try again later."
+        )
+        return
+
+    remaining = max(FREE_MONTHLY_QUOTA - balance["total"], 0)
+    await update.message.reply_text(
+        "Usage this month: \n\n"
+        f"You: ${balance['user']:.4f}\n"
+        f"All users: ${balance['total']:.4f}\n"
+        f"Shared quota left: ${remaining:.4f} of ${FREE_MONTHLY_QUOTA:.2f}"
+    )
+
+
+async def profile(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, profiler: SamplingProfiler
+):
+    # admins only, everyone else gets no hint that the command exists
+    if update.message.from_user.id not in ADMIN_USER_ID_LIST:
+        return
+
+    try:
+        seconds = float(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+    if profiler.running:
+        await update.message.reply_text("A profile is already running.")
+        return
+
+    await update.message.reply_text(f"Profiling the event loop for {seconds:g}s...")
+    path, stacks = await profiler.profile(seconds)
+
+    top = "\n".join(
+        f"{share:6.1%} {name}" for name, share in top_functions(stacks, limit=10)
+    )
+    await update.message.reply_text(
+        f"{sum(stacks.values())} samples written to {path}\n\n{top}"
+    )
 
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -63,5 +118,6 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Here are the commands you can use: \n\n"
         "/start - Register for a free usage, and get a description of the bot\n"
+        "/balance - Show this month's usage and the shared quota left\n"
         "/help - Get help with the bot\n\n"
     )
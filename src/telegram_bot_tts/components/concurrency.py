@@ -0,0 +1,477 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from telegram_bot_tts.logger import correlation_id
+from telegram_bot_tts.metrics import OPENAI_CONCURRENCY_LIMIT, OPENAI_SHED
+
+
+class ApiLimits:
+    """
+    Caps on in-flight OpenAI calls, separate for tts and stt so a burst of long
+    transcriptions can't take every slot from speech synthesis.
+    """
+
+    def __init__(self, max_tts: int, max_stt: int):
+        self.tts = asyncio.Semaphore(max_tts)
+        self.stt = asyncio.Semaphore(max_stt)
+
+
+class OverloadedError(Exception):
+    """Raised instead of queueing work that would wait longer than allowed."""
+
+
+def ewma(mean: Optional[float], value: float, weight: float = 0.1) -> float:
+    return value if mean is None else (1 - weight) * mean + weight * value
+
+
+# the limiter whose backlog the running work was admitted to
+admitted_to: contextvars.ContextVar = contextvars.ContextVar(
+    "admitted_to", default=None
+)
+
+
+class AdaptiveLimit:
+    """
+    A limit on the calls in flight to an api, found by additive increase,
+    multiplicative decrease: every call that comes back quickly while the limit is
+    in use raises it by 1/limit, about one per round trip, and a 429, a timeout or
+    a call `tolerance` times slower than the fastest recent calls of its size cuts
+    it to `backoff` of itself, at most once per round trip.
+
+    Calls over the limit queue in order. New work is shed once the wait it would
+    have, estimated from the backlog, the limit and how long slots are held
+    (retries and their backoff included), is longer than `max_wait`. The backlog
+    counts the work held `admitted()` as well, so work queued for its turn
+    elsewhere before its first call is not overlooked, and the calls of admitted
+    work are never shed.
+    """
+
+    # latencies kept per size bucket for the baseline, and needed before using it
+    WINDOW = 100
+    MIN_SAMPLES = 5
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        max_wait: float = 10.0,
+        backoff: float = 0.7,
+        tolerance: float = 2.0,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.pending = 0
+        self.shed = 0
+        # mean seconds a slot is held, and a call takes
+        self.latency = None
+        self.rtt = None
+        self._decreased_at = float("-inf")
+        self._baselines: dict[int, deque] = {}
+        self._waiters: deque[asyncio.Future] = deque()
+        OPENAI_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    def estimated_wait(self) -> float:
+        backlog = max(self.pending, self.in_flight + len(self._waiters))
+        if backlog < int(self.limit):
+            return 0.0
+        # nothing is known before the first call, let it queue
+        if self.latency is None:
+            return 0.0
+        return (backlog - int(self.limit) + 1) * self.latency / self.limit
+
+    def admit(self) -> bool:
+        """
+        Whether new work should go ahead, the work turned away is counted as shed.
+        """
+        if self.estimated_wait() <= self.max_wait:
+            return True
+        self.shed += 1
+        OPENAI_SHED.labels(self.name).inc()
+        return False
+
+    @asynccontextmanager
+    async def admitted(self):
+        # counts the work in the backlog from its admission until it's done
+        self.pending += 1
+        token = admitted_to.set(self)
+        try:
+            yield
+        finally:
+            admitted_to.reset(token)
+            self.pending -= 1
+
+    async def acquire(self):
+        if admitted_to.get() is not self and not self.admit():
+            raise OverloadedError(f"the {self.name} api is busy, try again later")
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the cancel, pass it on
+                self.release()
+            elif future in self._waiters:
+                # unless _wake already dropped it as cancelled
+                self._waiters.remove(future)
+            raise
+
+    def release(self, held: float = None):
+        if held is not None:
+            self.latency = ewma(self.latency, held)
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        # the slot is taken for the waiter, it only has to run
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def record(self, latency: float, size: float = 1):
+        # a call that succeeded, reported while its slot is still held
+        self.rtt = ewma(self.rtt, latency)
+        bucket = int(size).bit_length()
+        baseline = self._baselines.setdefault(bucket, deque(maxlen=self.WINDOW))
+        slow = len(baseline) >= self.MIN_SAMPLES and latency > self.tolerance * min(
+            baseline
+        )
+        baseline.append(latency)
+
+        if slow:
+            self.record_overload()
+        elif self.in_flight >= int(self.limit):
+            # only a limit in use has shown it could be higher
+            self._set(min(self.max_limit, self.limit + 1 / self.limit))
+
+    def record_overload(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        # the calls in flight when the limit was cut report the same congestion
+        if now - self._decreased_at < (self.rtt or 0.0):
+            return
+        self._decreased_at = now
+        self._set(max(self.min_limit, self.limit * self.backoff))
+
+    def _set(self, limit: float):
+        self.limit = limit
+        OPENAI_CONCURRENCY_LIMIT.labels(self.name).set(limit)
+        self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "pending": self.pending,
+            "waiting": len(self._waiters),
+            "shed": self.shed,
+        }
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently while updates from the same
+    chat run one at a time, in the order they arrived.
+
+    At most `max_concurrent_updates` updates run at once, and updates waiting behind
+    an earlier one from their chat don't take a slot. At most `max_pending_updates`
+    updates are inside the processor at once, running or waiting for their chat or a
+    slot. This is not back-pressure: ptb's update fetcher starts a task for every
+    update it takes off the queue, so the updates past the limit wait in those tasks,
+    unbounded, and polling carries on.
+
+    With a `recorder`, every update is recorded once it's inside the processor,
+    before it waits for its chat or a slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_updates: int,
+        max_pending_updates: int = 1024,
+        recorder=None,
+    ):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.recorder = recorder
+        self._budget = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks: dict[Hashable, asyncio.Lock] = {}
+        self._chat_waiters: dict[Hashable, int] = {}
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[Hashable]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        # every record logged while handling the update carries its id
+        if isinstance(update, Update):
+            correlation_id.set(update.update_id)
+        if self.recorder is not None:
+            self.recorder.record(update)
+
+        key = self.chat_key(update)
+
+        if key is None:
+            async with self._budget:
+                await coroutine
+            return
+
+        # asyncio.Lock wakes its waiters first in, first out, which keeps chat order
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._budget:
+                    await coroutine
+        finally:
+            # drop the lock once the chat has nothing queued, to keep the dict bounded
+            self._chat_waiters[key] -= 1
+            if self._chat_waiters[key] == 0:
+                del self._chat_waiters[key]
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class TokenBucket:
+    """
+    Refills at `rate` tokens a second up to `capacity`. A request larger than the
+    capacity passes on a full bucket and leaves it in debt, so it can't be locked
+    out for good.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float, now: float = None) -> float:
+        """
+        Takes `amount` tokens and returns 0, or returns the seconds to wait before
+        the request would pass and takes nothing.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class FairScheduler:
+    """
+    Rate limits every user with a token bucket per kind of work, weighted in
+    characters for tts and seconds for stt, and serves the admitted work round-robin
+    across users, at most `max_concurrent` jobs at a time.
+
+    VIP users have a lane of their own that goes first. `vip_reserved` of the slots
+    are kept for it, and when both lanes wait every `free_share`-th slot goes to the
+    free lane so it is never starved. Each lane has its own caps on openai calls.
+
+    `limits` and `vip_limits` map the kind of work to (tokens per minute, burst).
+    """
+
+    LANES = ("vip", "free")
+
+    # buckets that refilled completely are dropped once there are this many
+    MAX_BUCKETS = 10000
+
+    # wait times kept per lane for the percentiles
+    WAIT_SAMPLES = 1000
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        limits: dict[str, tuple[float, float]],
+        vip_limits: dict[str, tuple[float, float]],
+        vip_user_ids: list[int],
+        lane_limits: dict[str, ApiLimits] = None,
+        vip_reserved: int = 0,
+        free_share: int = 4,
+    ):
+        self.max_concurrent = max_concurrent
+        self.limits = limits
+        self.vip_limits = vip_limits
+        self.vip_user_ids = set(vip_user_ids)
+        self.lane_limits = lane_limits or {}
+        self.vip_reserved = min(vip_reserved, max_concurrent - 1)
+        self.free_share = free_share
+        self.rejected = 0
+
+        self._buckets: dict[tuple[int, str], TokenBucket] = {}
+        self._vip_streak = 0
+        self._active = {lane: 0 for lane in self.LANES}
+        self._served = {lane: 0 for lane in self.LANES}
+        self._waits = {lane: deque(maxlen=self.WAIT_SAMPLES) for lane in self.LANES}
+        # per lane, the users with queued work, the first one is served next
+        self._waiting: dict[str, OrderedDict[int, deque]] = {
+            lane: OrderedDict() for lane in self.LANES
+        }
+
+    def lane(self, user_id: int) -> str:
+        return "vip" if user_id in self.vip_user_ids else "free"
+
+    def admit(self, user_id: int, kind: str, amount: float) -> float:
+        """
+        Returns 0 when the user may go ahead, or the seconds to wait otherwise.
+        """
+        bucket = self._buckets.get((user_id, kind))
+        if bucket is None:
+            limits = self.vip_limits if self.lane(user_id) == "vip" else self.limits
+            per_minute, burst = limits[kind]
+            bucket = TokenBucket(per_minute / 60, burst)
+            self._prune()
+            self._buckets[(user_id, kind)] = bucket
+
+        retry_after = bucket.take(amount)
+        if retry_after:
+            self.rejected += 1
+        return retry_after
+
+    def _prune(self):
+        if len(self._buckets) < self.MAX_BUCKETS:
+            return
+        now = time.monotonic()
+        for key in [
+            key for key, bucket in self._buckets.items() if bucket.is_full(now)
+        ]:
+            del self._buckets[key]
+
+    @asynccontextmanager
+    async def turn(self, user_id: int):
+        """
+        Waits for the user's turn and yields the openai limits of their lane, or None
+        when the lanes share the caller's limits.
+        """
+        lane = self.lane(user_id)
+        await self._acquire(lane, user_id)
+        try:
+            yield self.lane_limits.get(lane)
+        finally:
+            self._release(lane)
+
+    def _can_start(self, lane: str) -> bool:
+        if sum(self._active.values()) >= self.max_concurrent:
+            return False
+        if lane == "free":
+            return self._active["free"] < self.max_concurrent - self.vip_reserved
+        return True
+
+    def _start(self, lane: str, queued_at: float):
+        self._active[lane] += 1
+        self._served[lane] += 1
+        self._waits[lane].append(time.monotonic() - queued_at)
+
+    async def _acquire(self, lane: str, user_id: int):
+        queued_at = time.monotonic()
+        if self._can_start(lane) and not self._waiting[lane]:
+            self._start(lane, queued_at)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[lane].setdefault(user_id, deque()).append((future, queued_at))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the cancel, pass it on
+                self._release(lane)
+            else:
+                queue = self._waiting[lane].get(user_id)
+                if queue is not None:
+                    for item in queue:
+                        if item[0] is future:
+                            queue.remove(item)
+                            break
+                    if not queue:
+                        del self._waiting[lane][user_id]
+            raise
+
+    def _next_lane(self) -> Optional[str]:
+        ready = [
+            lane for lane in self.LANES if self._waiting[lane] and self._can_start(lane)
+        ]
+        if not ready:
+            return None
+        if len(ready) == 1 or self._vip_streak < self.free_share - 1:
+            lane = ready[0]
+        else:
+            lane = "free"
+        # count the vip slots handed out in a row while the free lane waits
+        self._vip_streak = (
+            self._vip_streak + 1 if lane == "vip" and self._waiting["free"] else 0
+        )
+        return lane
+
+    def _release(self, lane: str):
+        self._active[lane] -= 1
+
+        # hand the free slots out, the user served goes to the back of their lane
+        while (next_lane := self._next_lane()) is not None:
+            waiting = self._waiting[next_lane]
+            user_id, queue = next(iter(waiting.items()))
+            future, queued_at = queue.popleft()
+            if queue:
+                waiting.move_to_end(user_id)
+            else:
+                del waiting[user_id]
+            if not future.done():
+                self._start(next_lane, queued_at)
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        stats = {"rejected": self.rejected}
+        for lane in self.LANES:
+            waits = self._waits[lane]
+            stats[lane] = {
+                "active": self._active[lane],
+                "waiting": sum(len(queue) for queue in self._waiting[lane].values()),
+                "served": self._served[lane],
+                "wait_p50": percentile(waits, 0.5),
+                "wait_p95": percentile(waits, 0.95),
+            }
+        return stats
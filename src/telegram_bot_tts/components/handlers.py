@@ -1,21 +1,129 @@
+import asyncio
 import logging
+import math
+import os
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, Awaitable, Callable, Union
 import io
+import shutil
+import tempfile
 
-from telegram import Update
+from telegram import InputFile, Message, Update
+from telegram.constants import MessageLimit
 from telegram.ext import ContextTypes
-from openai import AsyncOpenAI
+
+# only for the annotations, the client is built lazily by app.py
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
 from telegram_bot_tts.constants import (
-    BOT_USERNAME,
     AUDIO_FOLDER,
+    TTS_MODEL,
+    TTS_VOICE,
+    TTS_RESPONSE_FORMAT,
+    TTS_FILE_EXTENSION,
+    TTS_STREAMING,
+    TTS_SPOOL_MAX_BYTES,
+    TTS_SEGMENT_CONCURRENCY,
+    TTS_MAX_VOICE_BYTES,
+    STT_MAX_FILE_BYTES,
+    STT_SEGMENT_SECONDS,
+    STT_SEGMENT_CONCURRENCY,
+    STT_TRIM_SILENCE,
 )
 
 from telegram_bot_tts.db.db_manager import DBManager
+from telegram_bot_tts.components.admission import spoken_text
+from telegram_bot_tts.components.cache import AudioCache, TranscriptCache
+from telegram_bot_tts.components.segmenter import split_text, group_audio
+from telegram_bot_tts.components.concurrency import (
+    ApiLimits,
+    FairScheduler,
+    OverloadedError,
+)
+from telegram_bot_tts.components.audio import (
+    ffmpeg_available,
+    split_on_silence,
+    trim_silence,
+)
+from telegram_bot_tts.components.resilience import (
+    ApiGuard,
+    ApiGuards,
+    CircuitOpenError,
+    guarded,
+)
+
+from telegram_bot_tts.metrics import (
+    HANDLER_LATENCY,
+    HANDLERS_IN_FLIGHT,
+    OPENAI_IN_FLIGHT,
+    OPENAI_LATENCY,
+    TELEGRAM_LATENCY,
+    observe,
+    timed,
+)
 
 from datetime import datetime
 
+QUOTA_EXCEEDED_MESSAGE = (
+    "The free quota shared by all users is used up for this month. "
+    "Please try again next month."
+)
+
+SLOW_DOWN_MESSAGE = (
+    "You are sending messages too quickly, please slow down and try again in "
+    "{seconds} seconds."
+)
+
+SERVICE_UNAVAILABLE_MESSAGE = (
+    "The speech service is having trouble right now, please try again in a few "
+    "minutes."
+)
+
+BUSY_MESSAGE = "The bot is busy right now, please try again in a minute."
+
+
+def split_reply(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    # break into chunks of 4096 characters, ensuring breaks at word boundaries
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    i = 0
+    while i < len(text):
+        end = i + limit
+        if end < len(text):
+            # find the last space within the limit, force a break if there is none
+            space = text.rfind(" ", i, end)
+            if space > i:
+                end = space
+        chunks.append(text[i:end].strip())
+        i = end
+    return chunks
+
+
+class ProgressiveReply:
+    """
+    A reply whose text grows over time. The sent messages are edited in place
+    and a new message is added whenever the text outgrows the last one.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent: list[tuple[Message, str]] = []
+
+    async def update(self, text: str):
+        for i, chunk in enumerate(split_reply(text)):
+            if i >= len(self.sent):
+                sent = await self.message.reply_text(chunk, quote=True)
+                self.sent.append((sent, chunk))
+            elif self.sent[i][1] != chunk:
+                await self.sent[i][0].edit_text(chunk)
+                self.sent[i] = (self.sent[i][0], chunk)
+
+
 # Responses
 
 
@@ -25,66 +133,201 @@ def text_response(text: str) -> str:
 
 async def tts_response(
     text: str,
-    client: AsyncOpenAI,
+    client: "AsyncOpenAI",
     logger: logging.Logger,
     audio_path: str = None,
+    limits: ApiLimits = None,
+    guard: ApiGuard = None,
 ) -> str:
-    audio_file_name = str(text[:10].replace(" ", "_"))
-    speech_file_path = (
-        Path(AUDIO_FOLDER) / f"{audio_file_name}.mp3"
-        if audio_path is None
-        else audio_path
-    )
+    async with limits.tts if limits is not None else nullcontext():
+        with OPENAI_IN_FLIGHT.labels("tts").track_inprogress():
+            t1 = time.perf_counter()
+            response = await guarded(
+                guard,
+                lambda: client.audio.speech.create(
+                    model=TTS_MODEL,
+                    voice=TTS_VOICE,
+                    input=text,
+                    response_format=TTS_RESPONSE_FORMAT,
+                ),
+                len(text),
+            )
+            api_response_time = time.perf_counter() - t1
 
-    t1 = datetime.now()
+    OPENAI_LATENCY.labels("tts").observe(api_response_time)
+    logger.debug("TTS API response time: %.2f seconds", api_response_time)
 
-    logger.debug(f"t1: Starting TTS API request at {t1}")
-    response = await client.audio.speech.create(model="tts-1", voice="nova", input=text)
+    # a file of its own unless given one, concurrent requests for the same text
+    # never write to the same path
+    if audio_path is None:
+        fd, audio_path = tempfile.mkstemp(
+            dir=AUDIO_FOLDER, suffix=f".{TTS_FILE_EXTENSION}"
+        )
+        os.close(fd)
 
-    t2 = datetime.now()
-    logger.debug(f"t2: Finished TTS API request at {t2}")
+    # write in a worker thread, not on the event loop
+    await asyncio.to_thread(response.write_to_file, audio_path)
+    return audio_path
 
-    api_response_time = (t2 - t1).total_seconds()
 
-    with open(speech_file_path, "wb") as file:
-        for chunk in response.iter_bytes():
-            file.write(chunk)
+async def tts_stream_response(
+    text: str,
+    client: "AsyncOpenAI",
+    logger: logging.Logger,
+    max_memory_bytes: int = TTS_SPOOL_MAX_BYTES,
+    limits: ApiLimits = None,
+    guard: ApiGuard = None,
+) -> tempfile.SpooledTemporaryFile:
+
+    async def synthesize() -> tempfile.SpooledTemporaryFile:
+        # audio is kept in memory and only spills to a temp file above
+        # max_memory_bytes, a file per attempt so retries and hedges don't mix
+        audio = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+        try:
+            async with client.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=text,
+                response_format=TTS_RESPONSE_FORMAT,
+            ) as response:
+                async for chunk in response.iter_bytes():
+                    audio.write(chunk)
+        except BaseException:
+            audio.close()
+            raise
+        return audio
+
+    async with limits.tts if limits is not None else nullcontext():
+        with OPENAI_IN_FLIGHT.labels("tts").track_inprogress():
+            t1 = time.perf_counter()
+            audio = await guarded(guard, synthesize, len(text))
+            api_response_time = time.perf_counter() - t1
+
+    OPENAI_LATENCY.labels("tts").observe(api_response_time)
+    logger.debug("TTS streaming response time: %.2f seconds", api_response_time)
+
+    audio.seek(0)
+    return audio
+
+
+def copy_to_file(source, path: Path):
+    with open(path, "wb") as file:
+        shutil.copyfileobj(source, file)
+
+
+async def tts_segments_response(
+    segments: list[str],
+    client: "AsyncOpenAI",
+    logger: logging.Logger,
+    concurrency: int = TTS_SEGMENT_CONCURRENCY,
+    limits: ApiLimits = None,
+    guard: ApiGuard = None,
+) -> list[bytes]:
+    # synthesize the segments concurrently, gather keeps them in order
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def synthesize(segment: str) -> bytes:
+        async with semaphore:
+            audio = await tts_stream_response(
+                segment, client, logger=logger, limits=limits, guard=guard
+            )
+        with audio:
+            return audio.read()
 
-    logger.debug(f"TTS API response time: {api_response_time:.2f} seconds")
-    return speech_file_path
+    logger.debug("Synthesizing %d segments, concurrency %d", len(segments), concurrency)
+    return await asyncio.gather(*(synthesize(segment) for segment in segments))
 
 
 async def stt_response(
-    audio: Union[bytes, str], client: AsyncOpenAI, logger: logging.Logger
+    audio: Union[bytes, io.BytesIO, str],
+    client: "AsyncOpenAI",
+    logger: logging.Logger,
+    limits: ApiLimits = None,
+    guard: ApiGuard = None,
 ) -> str:
+    # read the audio once, every attempt uploads it from the start
     if isinstance(audio, str):
-        audio_file = open(audio, "rb")
-    elif isinstance(audio, Union[bytes, io.BytesIO]):
-        audio_file = audio
+        name = Path(audio).name
+        content = await asyncio.to_thread(Path(audio).read_bytes)
+    elif isinstance(audio, io.BytesIO):
+        name = getattr(audio, "name", "voice.oga")
+        content = audio.getvalue()
+    elif isinstance(audio, bytes):
+        name, content = "voice.oga", audio
     else:
         raise ValueError("Invalid audio type")
 
-    t1 = datetime.now()
-    logger.debug(f"t1: Starting STT API request at {t1}")
+    async with limits.stt if limits is not None else nullcontext():
+        with OPENAI_IN_FLIGHT.labels("stt").track_inprogress():
+            t1 = time.perf_counter()
+            transcript = await guarded(
+                guard,
+                lambda: client.audio.transcriptions.create(
+                    model="whisper-1", file=(name, content)
+                ),
+                len(content),
+            )
+            api_response_time = time.perf_counter() - t1
+
+    OPENAI_LATENCY.labels("stt").observe(api_response_time)
+    logger.debug("STT API response time: %.2f seconds", api_response_time)
+    return transcript.text
 
-    transcript = await client.audio.transcriptions.create(
-        model="whisper-1", file=audio_file
-    )
 
-    t2 = datetime.now()
-    logger.debug(f"t2: Finished STT API request at {t2}")
+async def stt_segments_response(
+    segments: list[bytes],
+    client: "AsyncOpenAI",
+    logger: logging.Logger,
+    concurrency: int = STT_SEGMENT_CONCURRENCY,
+    limits: ApiLimits = None,
+    on_progress: Callable[[str], Awaitable[None]] = None,
+    guard: ApiGuard = None,
+    prepare: Callable[[int, bytes], Awaitable[bytes]] = None,
+) -> str:
+    # transcribe the segments concurrently, report the text as the prefix grows.
+    # prepare(index, segment) runs in the segment's task, before its upload
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def transcribe(index: int, segment: bytes) -> str:
+        async with semaphore:
+            if prepare is not None:
+                segment = await prepare(index, segment)
+            buf = io.BytesIO(segment)
+            buf.name = f"segment{index}.ogg"  # file extension is required
+            return await stt_response(
+                buf, client, logger=logger, limits=limits, guard=guard
+            )
+
+    logger.debug("Transcribing %d segments, concurrency %d", len(segments), concurrency)
+    tasks = [
+        asyncio.create_task(transcribe(index, segment))
+        for index, segment in enumerate(segments)
+    ]
 
-    api_response_time = (t2 - t1).total_seconds()
-    logger.debug(f"STT API response time: {api_response_time:.2f} seconds")
-    return transcript.text
+    texts = []
+    try:
+        for task in tasks:
+            texts.append((await task).strip())
+            if on_progress is not None:
+                await on_progress(" ".join(texts))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return " ".join(texts)
 
 
+@timed(HANDLER_LATENCY, "text", in_flight=HANDLERS_IN_FLIGHT)
 async def handle_text_message(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     logger: logging.Logger,
-    client: AsyncOpenAI,
+    client: "AsyncOpenAI",
     db_manager: DBManager,
+    audio_cache: AudioCache = None,
+    limits: ApiLimits = None,
+    scheduler: FairScheduler = None,
+    guards: ApiGuards = None,
 ):
 
     user_id: int = update.message.from_user.id
@@ -92,88 +335,326 @@ async def handle_text_message(
     user_id: int = update.message.from_user.id
     text: str = update.message.text
 
-    logger.debug(f'User ({user_id}) in {massage_type}: "{text}"')
+    logger.debug('User (%s) in %s: "%s"', user_id, massage_type, text)
 
     # checking if the user have registered
-    if not db_manager.is_user_registered(user_id):
+    if not await db_manager.is_user_registered(user_id):
         await update.message.reply_text("Please use /start cmd to register first.")
         return
 
-    if massage_type in ("group", "supergroup"):
-        if BOT_USERNAME in text:
-            new_text: str = text.replace(BOT_USERNAME, "")
-            response: str = text_response(new_text)
-            text = new_text
-        else:
-            return
-    else:
-        response: str = text_response(text)
+    # admission only lets the group messages through that mention or reply to the bot
+    response: str = text_response(spoken_text(update.message))
+
+    if audio_cache is not None:
+        cache_key = audio_cache.key(response, TTS_MODEL, TTS_VOICE)
+        cached = audio_cache.get(cache_key)
+
+        if cached is not None:
+            # resend the telegram file_id if we have one, otherwise upload from disk
+            audio_path, file_id = cached
+            logger.debug("TTS cache hit %s, file_id: %s", cache_key, file_id)
+            try:
+                # an open file is unaffected by an eviction or a replacement
+                voice = nullcontext(file_id) if file_id else open(audio_path, "rb")
+            except FileNotFoundError:
+                # evicted since the lookup, synthesize it again
+                voice = None
+
+            if voice is not None:
+                with voice as voice_file:
+                    message = await update.message.reply_voice(
+                        voice=voice_file,
+                        filename=f"voice.{TTS_FILE_EXTENSION}",
+                        quote=True,
+                    )
+                audio_cache.set_file_id(cache_key, message.voice.file_id)
+
+                # nothing was synthesized, so there is no tts cost to record
+                return
+
+    # cached replies cost nothing, so the shared quota only gates new synthesis
+    if not await db_manager.check_user_eligibility(user_id):
+        await update.message.reply_text(QUOTA_EXCEEDED_MESSAGE)
+        return
+
+    # while openai is failing, say so right away instead of queueing the work
+    tts_guard = guards.tts if guards is not None else None
+    if tts_guard is not None and not tts_guard.available():
+        await update.message.reply_text(SERVICE_UNAVAILABLE_MESSAGE)
+        return
+
+    # and when it is slower than the work would wait for, shed the work early
+    if tts_guard is not None and not tts_guard.admit():
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
 
-    # return the audio file
-    audio_path = await tts_response(response, client, logger=logger)
+    # too much text in a short time is turned away instead of queued
+    if scheduler is not None:
+        retry_after = scheduler.admit(user_id, "tts", len(response))
+        if retry_after:
+            await update.message.reply_text(
+                SLOW_DOWN_MESSAGE.format(seconds=math.ceil(retry_after))
+            )
+            return
 
-    await update.message.reply_voice(voice=audio_path, quote=True)
+    turn = scheduler.turn(user_id) if scheduler is not None else nullcontext()
+    admitted = tts_guard.admitted() if tts_guard is not None else nullcontext()
+    async with admitted, turn as lane_limits:
+        # each lane has openai slots of its own
+        limits = lane_limits or limits
+        segments = split_text(response)
+        message = None
+
+        if len(segments) > 1:
+            # long texts are synthesized per segment and joined without decoding, into
+            # a numbered series if one voice message would get too large
+            parts = await tts_segments_response(
+                segments, client, logger=logger, limits=limits, guard=tts_guard
+            )
+            voices = group_audio(parts, TTS_MAX_VOICE_BYTES)
+            for i, voice in enumerate(voices, start=1):
+                with observe(TELEGRAM_LATENCY, "upload"):
+                    await update.message.reply_voice(
+                        voice=voice,
+                        filename=f"voice.{TTS_FILE_EXTENSION}",
+                        caption=f"{i}/{len(voices)}" if len(voices) > 1 else None,
+                        quote=True,
+                    )
+        elif TTS_STREAMING:
+            # the spool bounds memory while the audio streams in, ptb then reads the
+            # whole clip into memory for the upload. Spooled files carry no name,
+            # so ptb gets the bytes and an explicit filename
+            audio = await tts_stream_response(
+                response, client, logger=logger, limits=limits, guard=tts_guard
+            )
+            with audio:
+                with observe(TELEGRAM_LATENCY, "upload"):
+                    message = await update.message.reply_voice(
+                        voice=InputFile(
+                            audio.read(), filename=f"voice.{TTS_FILE_EXTENSION}"
+                        ),
+                        quote=True,
+                    )
+
+                if audio_cache is not None:
+                    # a disk copy off the reply path, in case the file_id needs a
+                    # re-upload, copied from the spool in a worker thread
+                    audio.seek(0)
+                    cache_path = audio_cache.temp_path()
+                    await asyncio.to_thread(copy_to_file, audio, cache_path)
+                    audio_cache.store(cache_key, cache_path)
+        else:
+            # synthesized into a private file that is moved into the cache whole, a
+            # concurrent request for the same text or an eviction never touches the
+            # file being uploaded
+            audio_path = audio_cache.temp_path() if audio_cache else None
+            try:
+                audio_path = await tts_response(
+                    response,
+                    client,
+                    logger=logger,
+                    audio_path=audio_path,
+                    limits=limits,
+                    guard=tts_guard,
+                )
+            except BaseException:
+                if audio_path is not None:
+                    Path(audio_path).unlink(missing_ok=True)
+                raise
+
+            with open(audio_path, "rb") as voice:
+                if audio_cache is not None:
+                    audio_cache.store(cache_key, audio_path)
+                else:
+                    # nothing keeps the file, the open handle is enough to upload
+                    os.unlink(audio_path)
+                with observe(TELEGRAM_LATENCY, "upload"):
+                    message = await update.message.reply_voice(
+                        voice=voice, filename=f"voice.{TTS_FILE_EXTENSION}", quote=True
+                    )
+
+    if audio_cache is not None and message is not None:
+        audio_cache.set_file_id(cache_key, message.voice.file_id)
 
     # catch error
     try:
         # get the time of the audio file, using a function to estimate the time of the audio file using a step function
-        db_manager.add_text_to_speech_activity(user_id, len(text), datetime.now())
+        await db_manager.add_text_to_speech_activity(
+            user_id, len(response), datetime.now()
+        )
     except Exception as e:
         logger.error(f"Error adding tts activity: {str(e)}")
 
 
+@timed(HANDLER_LATENCY, "voice", in_flight=HANDLERS_IN_FLIGHT)
 async def handle_voice_message(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     logger: logging.Logger,
-    client: AsyncOpenAI,
+    client: "AsyncOpenAI",
     db_manager: DBManager,
+    limits: ApiLimits = None,
+    transcript_cache: TranscriptCache = None,
+    scheduler: FairScheduler = None,
+    guards: ApiGuards = None,
 ):
 
     # parse the voice message
     user_id: int = update.message.from_user.id
     massage_type: str = update.message.chat.type
     voice_file_id: str = update.message.voice.file_id
-    voice_file = await context.bot.get_file(voice_file_id)
+    voice_file_unique_id: str = update.message.voice.file_unique_id
     voice_file_duration: float = update.message.voice.duration
 
-    logger.debug(f'User ({user_id}) in {massage_type}: "{voice_file_id}"')
+    logger.debug('User (%s) in %s: "%s"', user_id, massage_type, voice_file_id)
 
     # checking if the user have registered
-    if not db_manager.is_user_registered(user_id):
+    if not await db_manager.is_user_registered(user_id):
         await update.message.reply_text("Please use /start cmd to register first.")
         return
 
-    # store file in memory, not on disk
-    buf = io.BytesIO()
-    await voice_file.download_to_memory(buf)
-    buf.name = "voice.oga"  # file extension is required
-    buf.seek(0)  # move cursor to the beginning of the buffer
-
-    # pass the audio to the stt model
-    text = await stt_response(buf, client, logger=logger)
-
-    # checking if the text is too long
-    if len(text) > 4096:
-        # break into chunks of 4096 characters, ensuring breaks at word boundaries
-        chunks = []
-        for i in range(0, len(text), 4096):
-            end = i + 4096
-            if end < len(text):
-                # Find the last space within the 4096 character limit
-                end = text.rfind(" ", i, end)
-                if end == -1:  # If no space found, force break at 4096
-                    end = i + 4096
-            chunks.append(text[i:end].strip())
-        for chunk in chunks:
-            await update.message.reply_text(chunk, quote=True)
+    async def download() -> bytes:
+        # store file in memory, not on disk
+        with observe(TELEGRAM_LATENCY, "download"):
+            voice_file = await context.bot.get_file(voice_file_id)
+            buf = io.BytesIO()
+            await voice_file.download_to_memory(buf)
+        return buf.getvalue()
+
+    reply = ProgressiveReply(update.message)
+
+    async def show_progress(text: str):
+        # best effort, the full transcript is sent at the end anyway
+        if not text:
+            return
+        try:
+            await reply.update(text)
+        except Exception as e:
+            logger.warning(f"Error updating the partial transcript: {str(e)}")
+
+    stt_guard = guards.stt if guards is not None else None
+
+    # the seconds sent to whisper, less than the note when its silences are trimmed
+    used_seconds = voice_file_duration
+
+    async def trim(audio: bytes, seconds: float) -> tuple[bytes, float]:
+        # the audio and its length, as they are when trimming is off or fails
+        if not STT_TRIM_SILENCE or not ffmpeg_available():
+            return audio, seconds
+        try:
+            trimmed, trimmed_seconds = await trim_silence(audio)
+        except Exception as e:
+            logger.warning(f"Error trimming the voice note: {str(e)}")
+            return audio, seconds
+        # audio that is all silence goes as is
+        if trimmed_seconds < 1:
+            return audio, seconds
+        logger.debug("Trimmed %.1fs to %.1fs", seconds, trimmed_seconds)
+        return trimmed, trimmed_seconds
+
+    async def transcribe(audio: bytes) -> str:
+        nonlocal used_seconds
+
+        # long notes are split at silences so the first text shows up early, and
+        # each segment is trimmed in its own task instead of the whole note first
+        is_long = (
+            voice_file_duration > STT_SEGMENT_SECONDS or len(audio) > STT_MAX_FILE_BYTES
+        )
+        if is_long and ffmpeg_available():
+            segments = await split_on_silence(
+                audio, voice_file_duration, STT_SEGMENT_SECONDS
+            )
+            if len(segments) > 1:
+                seconds = [length for _, length in segments]
+
+                async def prepare(index: int, segment: bytes) -> bytes:
+                    segment, seconds[index] = await trim(segment, seconds[index])
+                    return segment
+
+                text = await stt_segments_response(
+                    [segment for segment, _ in segments],
+                    client,
+                    logger=logger,
+                    limits=limits,
+                    on_progress=show_progress,
+                    guard=stt_guard,
+                    prepare=prepare,
+                )
+                used_seconds = sum(seconds)
+                return text
+
+        audio, used_seconds = await trim(audio, voice_file_duration)
+
+        buf = io.BytesIO(audio)
+        buf.name = "voice.oga"  # file extension is required
+
+        # pass the audio to the stt model
+        return await stt_response(
+            buf, client, logger=logger, limits=limits, guard=stt_guard
+        )
+
+    # a forwarded voice note that was transcribed before costs nothing, it's only
+    # peeked at here so get_or_transcribe counts the lookup once
+    cached = transcript_cache is not None and (
+        transcript_cache.peek(voice_file_unique_id) is not None
+    )
+
+    if not cached and not await db_manager.check_user_eligibility(user_id):
+        await update.message.reply_text(QUOTA_EXCEEDED_MESSAGE)
+        return
+
+    # while openai is failing, say so right away instead of queueing the work
+    if not cached and stt_guard is not None and not stt_guard.available():
+        await update.message.reply_text(SERVICE_UNAVAILABLE_MESSAGE)
+        return
+
+    # and when it is slower than the work would wait for, shed the work early
+    if not cached and stt_guard is not None and not stt_guard.admit():
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
+
+    if not cached and scheduler is not None:
+        # too many seconds of audio in a short time are turned away instead of queued
+        retry_after = scheduler.admit(user_id, "stt", voice_file_duration)
+        if retry_after:
+            await update.message.reply_text(
+                SLOW_DOWN_MESSAGE.format(seconds=math.ceil(retry_after))
+            )
+            return
+
+    if cached:
+        text, transcribed = await transcript_cache.get_or_transcribe(
+            voice_file_unique_id, download, transcribe
+        )
     else:
-        await update.message.reply_text(text, quote=True)
+        turn = scheduler.turn(user_id) if scheduler is not None else nullcontext()
+        admitted = stt_guard.admitted() if stt_guard is not None else nullcontext()
+        async with admitted, turn as lane_limits:
+            # each lane has openai slots of its own
+            limits = lane_limits or limits
+            if transcript_cache is not None:
+                text, transcribed = await transcript_cache.get_or_transcribe(
+                    voice_file_unique_id, download, transcribe
+                )
+            else:
+                text = await transcribe(await download())
+                transcribed = True
+
+    # sends the transcript, or completes the partial one of a long note
+    await reply.update(text)
+
+    # reused transcripts cost nothing
+    if not transcribed:
+        logger.debug("Reused the transcript of %s", voice_file_unique_id)
+        return
 
     # catch error
     try:
-        db_manager.add_speech_to_text_activity(
-            user_id, voice_file_duration, datetime.now()
+        await db_manager.add_speech_to_text_activity(
+            user_id,
+            round(used_seconds),
+            datetime.now(),
+            original_seconds=voice_file_duration,
         )
     except Exception as e:
         logger.error(f"Error adding stt activity: {str(e)}")
@@ -182,6 +663,20 @@ async def handle_voice_message(
 async def error(
     update: Update, context: ContextTypes.DEFAULT_TYPE, logger: logging.Logger
 ):
+    if isinstance(
+        context.error, (CircuitOpenError, OverloadedError, asyncio.TimeoutError)
+    ):
+        # openai is failing, busy or too slow, nothing to debug here
+        update_id = update.update_id if isinstance(update, Update) else None
+        logger.warning(f"Update ({update_id}) failed: {context.error!r}")
+        if update and update.effective_message:
+            await update.effective_message.reply_text(
+                BUSY_MESSAGE
+                if isinstance(context.error, OverloadedError)
+                else SERVICE_UNAVAILABLE_MESSAGE
+            )
+        return
+
     try:
         raise context.error
     except Exception as e:
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Awaitable, Callable, TypeVar
+
+from telegram_bot_tts.components.concurrency import AdaptiveLimit, percentile
+from telegram_bot_tts.metrics import (
+    CIRCUIT_OPEN,
+    OPENAI_HEDGES,
+    OPENAI_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# status codes worth another try, the same ones the openai sdk retries
+RETRYABLE_STATUS = (408, 409, 429)
+
+# status codes saying the api has more calls than it can take
+OVERLOAD_STATUS = (429, 503)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an api that has been failing."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    # openai is imported with the client, by the time anything failed it's loaded
+    import openai
+
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def is_overload(error: BaseException) -> bool:
+    import openai
+
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    return (
+        isinstance(error, openai.APIStatusError)
+        and error.status_code in OVERLOAD_STATUS
+    )
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` failures in a row and fails calls fast for
+    `reset_timeout` seconds, then lets a single trial call through: its success
+    closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def available(self, now: float = None) -> bool:
+        # whether a call would be let through, without taking the trial
+        if self.opened_at is None:
+            return True
+        now = time.monotonic() if now is None else now
+        return not self._trial and now - self.opened_at >= self.reset_timeout
+
+    def check(self, now: float = None) -> bool:
+        # returns whether the call is the trial, which has to end_trial() once done
+        if not self.available(now):
+            raise CircuitOpenError(f"the {self.name} api is failing, try again later")
+        if self.opened_at is not None:
+            self._trial = True
+            return True
+        return False
+
+    def end_trial(self):
+        # a trial that ended without telling, cancelled or answered with a 429, lets
+        # the next call try instead
+        self._trial = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"{self.name} circuit closed")
+            CIRCUIT_OPEN.labels(self.name).set(0)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self, now: float = None):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if not self._trial:
+                logger.warning(
+                    f"{self.name} circuit opened after {self.failures} failures"
+                )
+            self.opened_at = time.monotonic() if now is None else now
+            self._trial = False
+            CIRCUIT_OPEN.labels(self.name).set(1)
+
+
+class ApiGuard:
+    """
+    Calls an api with a deadline, retries the retryable failures with full jitter
+    backoff, stops calling it while the circuit breaker is open, and hedges slow
+    calls: once a call has run longer than the `hedge_quantile` of recent calls of
+    its size, a duplicate is sent and whichever finishes first wins. Hedges are
+    paid for from a budget of `hedge_ratio` of the calls.
+
+    With a `limiter`, the call holds one of its slots for all its attempts, and
+    their latencies and overloads adjust the limit.
+
+    Sizes (characters, bytes of audio) are bucketed by powers of two, a long text
+    is only compared with other long texts.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        deadline: float,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        hedge_ratio: float = 0.05,
+        hedge_quantile: float = 0.95,
+        min_samples: int = 20,
+        breaker: CircuitBreaker = None,
+        window: int = 200,
+        limiter: AdaptiveLimit = None,
+    ):
+        self.name = name
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_ratio = hedge_ratio
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.breaker = breaker or CircuitBreaker(name)
+        self.window = window
+        self.limiter = limiter
+        self._latencies: dict[int, deque] = {}
+        # start with one hedge in hand, earn hedge_ratio more per call
+        self._hedge_credit = 1.0
+
+    def available(self) -> bool:
+        return self.breaker.available()
+
+    def admit(self) -> bool:
+        # False when new work would wait too long for a slot, and is shed
+        return self.limiter is None or self.limiter.admit()
+
+    def admitted(self):
+        # holds the admitted work in the limiter's backlog
+        return self.limiter.admitted() if self.limiter is not None else nullcontext()
+
+    def hedge_delay(self, size: float):
+        # None until there are enough calls of this size to know what slow is
+        latencies = self._latencies.get(int(size).bit_length())
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        return percentile(latencies, self.hedge_quantile)
+
+    def _observe(self, size: float, latency: float):
+        bucket = int(size).bit_length()
+        latencies = self._latencies.setdefault(bucket, deque(maxlen=self.window))
+        latencies.append(latency)
+
+    async def _hedged(self, request: Callable[[], Awaitable[T]], size: float) -> T:
+        start = time.perf_counter()
+        self._hedge_credit = min(self._hedge_credit + self.hedge_ratio, 10.0)
+        delay = self.hedge_delay(size)
+
+        primary = asyncio.ensure_future(request())
+        tasks = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._hedge_credit >= 1:
+                    self._hedge_credit -= 1
+                    OPENAI_HEDGES.labels(self.name).inc()
+                    logger.debug("Hedging a %s call after %.2fs", self.name, delay)
+                    tasks.add(asyncio.ensure_future(request()))
+
+            # the first success wins, a failure only counts once both failed
+            while True:
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self._observe(size, time.perf_counter() - start)
+                        return task.result()
+                if not pending:
+                    raise done.pop().exception()
+                tasks = pending
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(self, request: Callable[[], Awaitable[T]], size: float = 1) -> T:
+        """
+        Runs `request()`, a function making one api call, under the guard. Raises
+        CircuitOpenError while the api is failing, OverloadedError when the limiter
+        sheds it, asyncio.TimeoutError past the deadline and the last error once the
+        retries are used up.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+
+        if self.limiter is None:
+            return await self._attempts(request, size, deadline)
+        # fail fast before queueing, the trial call is taken by the first attempt
+        if not self.available():
+            raise CircuitOpenError(f"the {self.name} api is failing, try again later")
+        # the wait for a slot counts towards the deadline
+        await asyncio.wait_for(self.limiter.acquire(), self.deadline)
+        start = loop.time()
+        try:
+            return await self._attempts(request, size, deadline)
+        finally:
+            self.limiter.release(loop.time() - start)
+
+    async def _attempts(
+        self, request: Callable[[], Awaitable[T]], size: float, deadline: float
+    ) -> T:
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.retries + 1):
+            trial = self.breaker.check()
+            start = loop.time()
+            try:
+                result = await asyncio.wait_for(
+                    self._hedged(request, size), deadline - loop.time()
+                )
+            except Exception as e:
+                if self.limiter is not None and is_overload(e):
+                    self.limiter.record_overload()
+                if not is_retryable(e):
+                    # the api answered, a bad request is no sign it's unhealthy
+                    self.breaker.record_success()
+                    raise
+                # a 429 is the api answering that it's busy, not that it's down
+                if getattr(e, "status_code", None) != 429:
+                    self.breaker.record_failure()
+
+                pause = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2**attempt)
+                )
+                if attempt == self.retries or loop.time() + pause >= deadline:
+                    raise
+                OPENAI_RETRIES.labels(self.name).inc()
+                logger.warning(
+                    f"{self.name} call failed ({type(e).__name__}), retrying in "
+                    f"{pause:.2f}s"
+                )
+                await asyncio.sleep(pause)
+            else:
+                self.breaker.record_success()
+                if self.limiter is not None:
+                    self.limiter.record(loop.time() - start, size)
+                return result
+            finally:
+                if trial:
+                    self.breaker.end_trial()
+
+
+class ApiGuards:
+    # one guard per api, shared by every lane since they call the same service
+    def __init__(self, tts: ApiGuard, stt: ApiGuard):
+        self.tts = tts
+        self.stt = stt
+
+
+async def guarded(guard: ApiGuard, request: Callable[[], Awaitable[T]], size=1) -> T:
+    # calls straight through when there is no guard
+    if guard is None:
+        return await request()
+    return await guard.call(request, size)
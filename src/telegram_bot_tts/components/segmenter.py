@@ -0,0 +1,65 @@
+import re
+
+from telegram_bot_tts.constants import TTS_MAX_CHARS
+
+
+SENTENCE_END = re.compile(r"(?<=[.!?。！？…])\s+")
+
+
+def _pieces(text: str, limit: int) -> list[str]:
+    # break a block into pieces under the limit, trying the coarsest boundary first
+    if len(text) <= limit:
+        return [text]
+
+    for pattern in (r"\n\s*\n", SENTENCE_END, r"\n", r"\s+"):
+        parts = [part for part in re.split(pattern, text) if part.strip()]
+        if len(parts) > 1:
+            return [piece for part in parts for piece in _pieces(part, limit)]
+
+    # a single run without any whitespace, cut it hard
+    return [text[i : i + limit] for i in range(0, len(text), limit)]
+
+
+def split_text(text: str, limit: int = TTS_MAX_CHARS) -> list[str]:
+    """
+    Splits text into segments of at most `limit` characters at paragraph, sentence
+    and word boundaries, packing as many whole pieces as fit into every segment.
+    """
+    text = text.strip()
+    if len(text) <= limit:
+        return [text]
+
+    segments = []
+    current = ""
+    for piece in _pieces(text, limit):
+        piece = piece.strip()
+        candidate = f"{current} {piece}" if current else piece
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            segments.append(current)
+            current = piece
+
+    if current:
+        segments.append(current)
+    return segments
+
+
+def group_audio(parts: list[bytes], max_bytes: int) -> list[bytes]:
+    """
+    Joins audio segments in order without decoding them, starting a new group
+    whenever the next segment would push a group over `max_bytes`.
+
+    Ogg/Opus segments join into a chained ogg stream, mp3 frames concatenate as is.
+    """
+    groups = []
+    current = b""
+    for part in parts:
+        if current and len(current) + len(part) > max_bytes:
+            groups.append(current)
+            current = b""
+        current += part
+
+    if current:
+        groups.append(current)
+    return groups
@@ -1,3 +1,4 @@
+import threading
 from pathlib import Path
 
 from telegram_bot_tts.constants import AUDIO_FOLDER
@@ -7,3 +8,26 @@ def create_audio_folder():
     audio_folder = Path(AUDIO_FOLDER)
     audio_folder.mkdir(exist_ok=True, parents=True)
     return audio_folder
+
+
+class LazyClient:
+    """
+    Stands in for a client that is slow to import or build, and builds it with
+    `factory` on first use. `load()` builds it ahead of time, e.g. from a thread
+    once the bot is up.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
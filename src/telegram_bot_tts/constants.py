@@ -1,16 +1,214 @@
 from os import environ
 from typing import Final
-from openai import AsyncOpenAI
 
 
 TOKEN: Final = environ.get("TELEGRAM_BOT_TOKEN")
 BOT_USERNAME: Final = "@openaitts_bot"
 ENV: Final = environ.get("ENV", "dev")
-OPENAI_CLIENT: AsyncOpenAI = AsyncOpenAI()
 AUDIO_FOLDER: Final = "/tts_bot_audio" if ENV == "prod" else "/tmp/tts_bot_audio"
+TTS_MODEL: Final = environ.get("TTS_MODEL", "tts-1")
+TTS_VOICE: Final = environ.get("TTS_VOICE", "nova")
+
+# opus in an ogg container is telegram's native voice format, no transcoding needed
+TTS_RESPONSE_FORMAT: Final = environ.get("TTS_RESPONSE_FORMAT", "opus")
+TTS_FILE_EXTENSION: Final = (
+    "ogg" if TTS_RESPONSE_FORMAT == "opus" else TTS_RESPONSE_FORMAT
+)
+
+# stream tts audio into memory instead of a file under AUDIO_FOLDER, spilling to a
+# temp file only above TTS_SPOOL_MAX_BYTES. That bounds memory while the audio is
+# synthesized, the upload still holds the whole clip in memory
+TTS_STREAMING: Final = environ.get("TTS_STREAMING", "true").lower() == "true"
+TTS_SPOOL_MAX_BYTES: Final = int(environ.get("TTS_SPOOL_MAX_BYTES", 1024 * 1024))
+
+# the tts endpoint rejects input over 4096 characters, longer texts are split into
+# segments that are synthesized concurrently and joined into voice messages
+TTS_MAX_CHARS: Final = 4096
+TTS_SEGMENT_CONCURRENCY: Final = int(environ.get("TTS_SEGMENT_CONCURRENCY", 4))
+TTS_MAX_VOICE_BYTES: Final = int(environ.get("TTS_MAX_VOICE_BYTES", 20 * 1024 * 1024))
+
+# messages are admitted by the dispatcher from ALLOWED_CHAT_TYPES only, up to
+# MAX_INPUT_CHARS of text (a whole telegram message by default) and voice notes up
+# to MAX_VOICE_BYTES, the largest file the Bot API lets bots download
+ALLOWED_CHAT_TYPES: Final = tuple(
+    environ.get("ALLOWED_CHAT_TYPES", "private,group,supergroup").split(",")
+)
+MAX_INPUT_CHARS: Final = int(environ.get("MAX_INPUT_CHARS", 4096))
+MAX_VOICE_BYTES: Final = int(environ.get("MAX_VOICE_BYTES", 20 * 1024 * 1024))
+
+# long or large voice notes are split at silences with ffmpeg and the segments are
+# transcribed concurrently, whisper takes at most 25 MB per request
+FFMPEG_BINARY: Final = environ.get("FFMPEG_BINARY", "ffmpeg")
+STT_MAX_FILE_BYTES: Final = int(environ.get("STT_MAX_FILE_BYTES", 25 * 1024 * 1024))
+STT_SEGMENT_SECONDS: Final = float(environ.get("STT_SEGMENT_SECONDS", 120))
+STT_SEGMENT_CONCURRENCY: Final = int(environ.get("STT_SEGMENT_CONCURRENCY", 4))
+STT_SILENCE_THRESHOLD_DB: Final = float(environ.get("STT_SILENCE_THRESHOLD_DB", -35))
+STT_MIN_SILENCE: Final = float(environ.get("STT_MIN_SILENCE", 0.5))
+
+# before upload the silent spans are cut and the audio is re-encoded as mono 16 kHz
+# low bitrate opus, whisper bills the trimmed seconds
+STT_TRIM_SILENCE: Final = environ.get("STT_TRIM_SILENCE", "true").lower() == "true"
+STT_KEEP_SILENCE: Final = float(environ.get("STT_KEEP_SILENCE", 0.25))
+STT_UPLOAD_BITRATE: Final = environ.get("STT_UPLOAD_BITRATE", "16k")
 
 user_id_list = environ.get("VIP_USER_ID_LIST")
 user_id_list = user_id_list.split(",") if user_id_list else []
 VIP_USER_ID_LIST: Final = [
     int(user_id) if user_id.isdigit() else None for user_id in user_id_list
 ]
+
+# admins may run /profile
+admin_id_list = environ.get("ADMIN_USER_ID_LIST")
+admin_id_list = admin_id_list.split(",") if admin_id_list else []
+ADMIN_USER_ID_LIST: Final = [
+    int(user_id) for user_id in admin_id_list if user_id.strip().isdigit()
+]
+
+# database connection pool, sized for concurrent handlers sharing one asyncio engine
+DB_POOL_SIZE: Final = int(environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW: Final = int(environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT: Final = float(environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE: Final = int(environ.get("DB_POOL_RECYCLE", 1800))
+
+# bot api connections, sends, uploads and downloads share TELEGRAM_POOL_SIZE of them
+# and the long poll has a pool of its own. A request waits up to TELEGRAM_POOL_TIMEOUT
+# seconds for a free connection, HTTP/2 needs the http2 extra (httpx[http2])
+TELEGRAM_POOL_SIZE: Final = int(environ.get("TELEGRAM_POOL_SIZE", 64))
+TELEGRAM_UPDATES_POOL_SIZE: Final = int(environ.get("TELEGRAM_UPDATES_POOL_SIZE", 1))
+TELEGRAM_POOL_TIMEOUT: Final = float(environ.get("TELEGRAM_POOL_TIMEOUT", 30))
+TELEGRAM_KEEPALIVE_EXPIRY: Final = float(environ.get("TELEGRAM_KEEPALIVE_EXPIRY", 60))
+TELEGRAM_HTTP2: Final = environ.get("TELEGRAM_HTTP2", "false").lower() == "true"
+TELEGRAM_WARM_CONNECTIONS: Final = int(environ.get("TELEGRAM_WARM_CONNECTIONS", 4))
+
+# openai api connections, at most OPENAI_MAX_CONNECTIONS open of which
+# OPENAI_MAX_KEEPALIVE are kept idle for OPENAI_KEEPALIVE_EXPIRY seconds
+OPENAI_MAX_CONNECTIONS: Final = int(environ.get("OPENAI_MAX_CONNECTIONS", 64))
+OPENAI_MAX_KEEPALIVE: Final = int(environ.get("OPENAI_MAX_KEEPALIVE", 32))
+OPENAI_KEEPALIVE_EXPIRY: Final = float(environ.get("OPENAI_KEEPALIVE_EXPIRY", 60))
+OPENAI_HTTP2: Final = environ.get("OPENAI_HTTP2", "false").lower() == "true"
+OPENAI_WARM_CONNECTIONS: Final = int(environ.get("OPENAI_WARM_CONNECTIONS", 4))
+
+# every openai call has a deadline, retryable failures are retried OPENAI_RETRIES
+# times with jittered backoff and calls slower than the OPENAI_HEDGE_QUANTILE of
+# recent ones are sent twice, for at most OPENAI_HEDGE_RATIO of the calls. After
+# OPENAI_CIRCUIT_FAILURES failures in a row calls fail fast for OPENAI_CIRCUIT_RESET
+# seconds
+OPENAI_TTS_DEADLINE: Final = float(environ.get("OPENAI_TTS_DEADLINE", 60))
+OPENAI_STT_DEADLINE: Final = float(environ.get("OPENAI_STT_DEADLINE", 120))
+OPENAI_RETRIES: Final = int(environ.get("OPENAI_RETRIES", 2))
+OPENAI_RETRY_BACKOFF: Final = float(environ.get("OPENAI_RETRY_BACKOFF", 0.5))
+OPENAI_HEDGE_RATIO: Final = float(environ.get("OPENAI_HEDGE_RATIO", 0.05))
+OPENAI_HEDGE_QUANTILE: Final = float(environ.get("OPENAI_HEDGE_QUANTILE", 0.95))
+OPENAI_CIRCUIT_FAILURES: Final = int(environ.get("OPENAI_CIRCUIT_FAILURES", 5))
+OPENAI_CIRCUIT_RESET: Final = float(environ.get("OPENAI_CIRCUIT_RESET", 30))
+
+# the calls in flight to each api are limited adaptively, from OPENAI_INITIAL_LIMIT
+# up to the caps of both lanes together, backing off to OPENAI_LIMIT_BACKOFF of the
+# limit on a 429, a timeout or a call OPENAI_LATENCY_TOLERANCE times slower than
+# usual. work that would wait more than OPENAI_MAX_QUEUE_WAIT seconds is turned away
+OPENAI_INITIAL_LIMIT: Final = int(environ.get("OPENAI_INITIAL_LIMIT", 8))
+OPENAI_LIMIT_BACKOFF: Final = float(environ.get("OPENAI_LIMIT_BACKOFF", 0.7))
+OPENAI_LATENCY_TOLERANCE: Final = float(environ.get("OPENAI_LATENCY_TOLERANCE", 2))
+OPENAI_MAX_QUEUE_WAIT: Final = float(environ.get("OPENAI_MAX_QUEUE_WAIT", 10))
+
+# registered-user cache in front of DBManager.is_user_registered, unknown users are
+# cached for a shorter time so a registration from another instance shows up quickly
+USER_CACHE_SIZE: Final = int(environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL: Final = float(environ.get("USER_CACHE_TTL", 3600))
+USER_CACHE_NEGATIVE_TTL: Final = float(environ.get("USER_CACHE_NEGATIVE_TTL", 60))
+
+# disk budget for the content-addressed tts audio cache
+TTS_CACHE_MAX_BYTES: Final = int(environ.get("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# "polling" long-polls getUpdates, "webhook" receives updates on the local server
+BOT_MODE: Final = environ.get("BOT_MODE", "polling")
+POLL_INTERVAL: Final = float(environ.get("POLL_INTERVAL", 3))
+
+# local http server for health checks and the webhook, docker-compose publishes 8080
+SERVER_HOST: Final = environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT: Final = int(environ.get("SERVER_PORT", 8080))
+WEBHOOK_URL: Final = environ.get("WEBHOOK_URL")
+WEBHOOK_PATH: Final = environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN: Final = environ.get("WEBHOOK_SECRET_TOKEN")
+
+# updates from different chats run concurrently within a global budget, in-flight
+# openai calls are capped separately for tts and stt
+MAX_CONCURRENT_UPDATES: Final = int(environ.get("MAX_CONCURRENT_UPDATES", 64))
+MAX_PENDING_UPDATES: Final = int(environ.get("MAX_PENDING_UPDATES", 1024))
+MAX_CONCURRENT_TTS: Final = int(environ.get("MAX_CONCURRENT_TTS", 16))
+MAX_CONCURRENT_STT: Final = int(environ.get("MAX_CONCURRENT_STT", 8))
+
+# every user gets a token bucket per kind of work, tts is weighted in characters and
+# stt in seconds of audio, the admitted jobs are served round-robin across users
+MAX_CONCURRENT_JOBS: Final = int(environ.get("MAX_CONCURRENT_JOBS", 16))
+
+# vip users queue in a lane of their own that goes first, with VIP_RESERVED_JOBS of
+# the slots kept for it and its own caps on openai calls. while both lanes wait,
+# every FREE_LANE_SHARE-th slot goes to the free lane
+VIP_RESERVED_JOBS: Final = int(environ.get("VIP_RESERVED_JOBS", 4))
+VIP_MAX_CONCURRENT_TTS: Final = int(environ.get("VIP_MAX_CONCURRENT_TTS", 4))
+VIP_MAX_CONCURRENT_STT: Final = int(environ.get("VIP_MAX_CONCURRENT_STT", 4))
+FREE_LANE_SHARE: Final = int(environ.get("FREE_LANE_SHARE", 4))
+RATE_LIMITS: Final = {
+    "tts": (
+        float(environ.get("TTS_CHARS_PER_MINUTE", 2000)),
+        float(environ.get("TTS_BURST_CHARS", 8000)),
+    ),
+    "stt": (
+        float(environ.get("STT_SECONDS_PER_MINUTE", 120)),
+        float(environ.get("STT_BURST_SECONDS", 600)),
+    ),
+}
+VIP_RATE_LIMITS: Final = {
+    "tts": (
+        float(environ.get("VIP_TTS_CHARS_PER_MINUTE", 20000)),
+        float(environ.get("VIP_TTS_BURST_CHARS", 40000)),
+    ),
+    "stt": (
+        float(environ.get("VIP_STT_SECONDS_PER_MINUTE", 1200)),
+        float(environ.get("VIP_STT_BURST_SECONDS", 3600)),
+    ),
+}
+
+# all free users share this many dollars a month, the running total is resynced from
+# the monthly_spend table every SPEND_RESYNC_INTERVAL seconds
+FREE_MONTHLY_QUOTA: Final = float(environ.get("FREE_MONTHLY_QUOTA", 3))
+SPEND_RESYNC_INTERVAL: Final = float(environ.get("SPEND_RESYNC_INTERVAL", 300))
+
+# activities are queued and written in bulk every ACTIVITY_BATCH_SIZE rows or
+# ACTIVITY_FLUSH_INTERVAL seconds, holding at most ACTIVITY_MAX_PENDING rows
+ACTIVITY_WRITE_BEHIND: Final = (
+    environ.get("ACTIVITY_WRITE_BEHIND", "true").lower() == "true"
+)
+ACTIVITY_BATCH_SIZE: Final = int(environ.get("ACTIVITY_BATCH_SIZE", 100))
+ACTIVITY_FLUSH_INTERVAL: Final = float(environ.get("ACTIVITY_FLUSH_INTERVAL", 0.5))
+ACTIVITY_MAX_PENDING: Final = int(environ.get("ACTIVITY_MAX_PENDING", 10000))
+
+# transcripts of forwarded voice notes are reused, keyed on telegram's file_unique_id
+TRANSCRIPT_CACHE_SIZE: Final = int(environ.get("TRANSCRIPT_CACHE_SIZE", 2000))
+TRANSCRIPT_CACHE_TTL: Final = float(environ.get("TRANSCRIPT_CACHE_TTL", 24 * 3600))
+TRANSCRIPT_CACHE_PERSIST: Final = (
+    environ.get("TRANSCRIPT_CACHE_PERSIST", "true").lower() == "true"
+)
+
+# the event loop is sampled every LOOP_LAG_INTERVAL seconds, a loop blocked for more
+# than LOOP_STALL_THRESHOLD seconds is logged with the stack that blocked it
+LOOP_LAG_INTERVAL: Final = float(environ.get("LOOP_LAG_INTERVAL", 0.5))
+LOOP_STALL_THRESHOLD: Final = float(environ.get("LOOP_STALL_THRESHOLD", 0.25))
+
+# /profile samples the event loop thread and dumps collapsed stacks here, next to the
+# audio so they land on the same volume
+PROFILE_FOLDER: Final = environ.get("PROFILE_FOLDER", f"{AUDIO_FOLDER}/profiles")
+PROFILE_MAX_SECONDS: Final = float(environ.get("PROFILE_MAX_SECONDS", 60))
+PROFILE_SAMPLE_INTERVAL: Final = float(environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+
+# logs are written from a background thread, as json lines with LOG_JSON, and only
+# LOG_DEBUG_SAMPLE_RATE of the updates keep their debug lines
+LOG_JSON: Final = environ.get("LOG_JSON", "false").lower() == "true"
+LOG_DEBUG_SAMPLE_RATE: Final = float(environ.get("LOG_DEBUG_SAMPLE_RATE", 1))
+
+# with RECORD_UPDATES_PATH set, incoming updates are appended there anonymized, for
+# replaying in load tests. A fixed RECORD_UPDATES_SALT keeps the ids stable across
+# restarts, a random one is used otherwise
+RECORD_UPDATES_PATH: Final = environ.get("RECORD_UPDATES_PATH")
+RECORD_UPDATES_SALT: Final = environ.get("RECORD_UPDATES_SALT")
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import random
+import time
+
+from sqlalchemy.exc import DBAPIError, DataError, IntegrityError, StatementError
+
+logger = logging.getLogger(__name__)
+
+
+def is_serialization_error(e: Exception) -> bool:
+    # cockroachdb asks the client to retry contended transactions with SQLSTATE 40001
+    if not isinstance(e, DBAPIError):
+        return False
+    sqlstate = getattr(e.orig, "sqlstate", None) or getattr(e.orig, "pgcode", None)
+    return sqlstate == "40001" or "restart transaction" in str(e.orig)
+
+
+def is_data_error(e: Exception) -> bool:
+    # the rows themselves are rejected, a retry fails the same way. A bare
+    # StatementError means a value couldn't be bound before reaching the database
+    if isinstance(e, (IntegrityError, DataError)):
+        return True
+    return isinstance(e, StatementError) and not isinstance(e, DBAPIError)
+
+
+class ActivityBuffer:
+    """
+    Write-behind buffer for activity rows. Rows are queued by the handlers and
+    written in bulk by a background task every `max_batch` rows or `flush_interval`
+    seconds, whichever comes first, so the request path never waits on a commit.
+
+    Overflow policy: at most `max_pending` rows are held in memory. Once full, `put`
+    waits up to `put_timeout` seconds for the flusher to make room, then drops the
+    row and counts it in `dropped`. Data errors (integrity or value errors) mean a
+    bad row: the batch is split until the rows that fail are alone, and those are
+    logged and dropped. Anything else, a serialization conflict, a lost connection
+    or a pool timeout, is retried with jittered backoff, and a batch that still
+    fails after `max_retries` attempts is dropped.
+    """
+
+    def __init__(
+        self,
+        write_batch,
+        max_batch: int = 100,
+        flush_interval: float = 0.5,
+        max_pending: int = 10000,
+        put_timeout: float = 1.0,
+        max_retries: int = 5,
+    ):
+        # write_batch(rows) inserts a list of (model, row) in one transaction
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.written = 0
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._batch = []
+        self._task = None
+        self._flushing = None
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def put(self, model, row: dict) -> bool:
+        # the flusher starts with the first row, on the running loop
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        try:
+            self._queue.put_nowait((model, row))
+        except asyncio.QueueFull:
+            try:
+                async with asyncio.timeout(self.put_timeout):
+                    await self._queue.put((model, row))
+            except TimeoutError:
+                self.dropped += 1
+                logger.error(
+                    f"Activity buffer full, dropped a {model.__tablename__} row"
+                )
+                return False
+        return True
+
+    async def _run(self):
+        while True:
+            # rows taken off the queue live in self._batch, so drain can't lose them
+            self._batch.append(await self._queue.get())
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(self._batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                # asyncio.timeout, unlike wait_for, never swallows a cancel from drain
+                try:
+                    async with asyncio.timeout(timeout):
+                        self._batch.append(await self._queue.get())
+                except TimeoutError:
+                    break
+
+            batch, self._batch = self._batch, []
+
+            # shielded, so cancelling the flusher never interrupts a commit
+            self._flushing = asyncio.ensure_future(self._flush(batch))
+            await asyncio.shield(self._flushing)
+
+    async def _flush(self, batch: list):
+        for attempt in range(self.max_retries):
+            try:
+                await self.write_batch(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                if is_data_error(e):
+                    await self._isolate(batch, e)
+                    return
+                kind = "Serialization" if is_serialization_error(e) else "Transient"
+                logger.warning(
+                    f"{kind} error flushing {len(batch)} activities "
+                    f"(attempt {attempt + 1}): {str(e)}"
+                )
+
+            # exponential backoff with full jitter
+            await asyncio.sleep(random.uniform(0, 0.1 * 2**attempt))
+
+        self.dropped += len(batch)
+        logger.error(
+            f"Dropped {len(batch)} activities after {self.max_retries} attempts"
+        )
+
+    async def _isolate(self, batch: list, error: Exception):
+        # a retry won't fix the batch, halves are written on their own until the
+        # failing rows are found, the rest still go in
+        if len(batch) == 1:
+            model, row = batch[0]
+            self.dropped += 1
+            logger.error(f"Dropped a {model.__tablename__} row {row}: {str(error)}")
+            return
+        middle = len(batch) // 2
+        await self._flush(batch[:middle])
+        await self._flush(batch[middle:])
+
+    async def drain(self):
+        """Stops the flusher and writes whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._flushing is not None:
+            await self._flushing
+            self._flushing = None
+
+        rows, self._batch = self._batch, []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+
+        for i in range(0, len(rows), self.max_batch):
+            await self._flush(rows[i : i + self.max_batch])
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
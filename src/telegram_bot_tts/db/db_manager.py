@@ -1,6 +1,6 @@
+import asyncio
 import logging
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
@@ -9,18 +9,44 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import make_url
 from sqlalchemy.sql import func
-from sqlalchemy import text
-from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy import select, insert
+from sqlalchemy.dialects.postgresql import ENUM, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import os
 from datetime import date, timedelta, datetime
 
-from telegram_bot_tts.constants import VIP_USER_ID_LIST
+from telegram_bot_tts.constants import (
+    VIP_USER_ID_LIST,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    USER_CACHE_NEGATIVE_TTL,
+    FREE_MONTHLY_QUOTA,
+    ACTIVITY_WRITE_BEHIND,
+    ACTIVITY_BATCH_SIZE,
+    ACTIVITY_FLUSH_INTERVAL,
+    ACTIVITY_MAX_PENDING,
+)
+from telegram_bot_tts.components.cache import TTLCache
+from telegram_bot_tts.metrics import (
+    DB_LATENCY,
+    OPENAI_COST,
+    STT_SECONDS,
+    TTS_CHARACTERS,
+    observe,
+    timed,
+)
+from telegram_bot_tts.db.activity_buffer import ActivityBuffer
 
 Base = declarative_base()
 
@@ -47,6 +73,8 @@ class FreeTrial(Base):
     amount = Column(Float, nullable=False)
 
 
+# the month-range spend queries are served by these indexes, which also store the
+# cost so the sums never touch the table rows
 class TextToSpeechActivity(Base):
     __tablename__ = "text_to_speech_activity"
     activity_id = Column(Integer, primary_key=True)
@@ -55,80 +83,342 @@ class TextToSpeechActivity(Base):
     cost = Column(Float, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index(
+            "ix_tts_activity_user_timestamp",
+            "user_id",
+            "timestamp",
+            postgresql_include=["cost"],
+        ),
+        Index("ix_tts_activity_timestamp", "timestamp", postgresql_include=["cost"]),
+    )
+
 
 class SpeechToTextActivity(Base):
     __tablename__ = "speech_to_text_activity"
     activity_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
     used_seconds = Column(Integer, nullable=False)
+    # length of the voice note before the silences were trimmed
+    original_seconds = Column(Integer)
     cost = Column(Float, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index(
+            "ix_stt_activity_user_timestamp",
+            "user_id",
+            "timestamp",
+            postgresql_include=["cost"],
+        ),
+        Index("ix_stt_activity_timestamp", "timestamp", postgresql_include=["cost"]),
+    )
+
+
+# transcripts of voice notes, reused when the same note is forwarded again
+class Transcript(Base):
+    __tablename__ = "transcripts"
+    file_unique_id = Column(String, primary_key=True)
+    content_hash = Column(String, nullable=False, index=True)
+    text = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# pre-aggregated spend per month, incremented in the same transaction as the activity
+class MonthlySpend(Base):
+    __tablename__ = "monthly_spend"
+    month = Column(Date, primary_key=True)
+    cost = Column(Float, nullable=False, default=0)
+
+
+def tts_cost(used_chars: float) -> float:
+    # TTS $15.000 / 1M characters
+    return (used_chars / 1000000) * 15 * 1
+
+
+def stt_cost(used_seconds: float) -> float:
+    # Whisper $0.006 / minute (rounded to the nearest second)
+    return (used_seconds / 60) * 0.006 * 1
+
+
+def month_start(timestamp: datetime) -> date:
+    return date(timestamp.year, timestamp.month, 1)
+
+
+def next_month_start(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class SpendLedger:
+    """
+    Running total of the current month's spend shared by the free users, so a quota
+    check is a comparison instead of a scan over the month's activities.
+    """
+
+    def __init__(self, quota: float):
+        self.quota = quota
+        self.month = None
+        self.total = 0.0
+
+    def set(self, month: date, total: float):
+        self.month = month
+        self.total = total
+
+    def add(self, timestamp: datetime, cost: float):
+        month = month_start(timestamp)
+        if self.month is None or month > self.month:
+            self.set(month, 0.0)
+        if month == self.month:
+            self.total += cost
+
+    def is_within_quota(self) -> bool:
+        # a new month starts with an empty ledger
+        if self.month != month_start(datetime.now()):
+            return True
+        return self.total <= self.quota
+
+
+# sync drivers in DATABASE_URL are swapped for their asyncio counterpart, psycopg (v3)
+# keeps libpq url options such as sslmode and sslrootcert working as before
+ASYNC_DRIVERS = {
+    "cockroachdb": "cockroachdb+psycopg",
+    "cockroachdb+psycopg2": "cockroachdb+psycopg",
+    "postgresql": "postgresql+psycopg",
+    "postgres": "postgresql+psycopg",
+    "postgresql+psycopg2": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def to_async_url(db_url: str):
+    url = make_url(db_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
 
 class DBManager:
-    def __init__(self, db_url=None):
+    def __init__(
+        self,
+        db_url=None,
+        pool_size: int = DB_POOL_SIZE,
+        max_overflow: int = DB_MAX_OVERFLOW,
+        pool_timeout: float = DB_POOL_TIMEOUT,
+        pool_recycle: int = DB_POOL_RECYCLE,
+        write_behind: bool = ACTIVITY_WRITE_BEHIND,
+    ):
         if db_url is None:
             db_url = os.environ["DATABASE_URL"]
 
-        self.engine = create_engine(db_url)
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+        url = to_async_url(db_url)
+
+        # sqlite (used by the tests) runs on a static/null pool without sizing options
+        pool_options = (
+            {}
+            if url.get_backend_name() == "sqlite"
+            else dict(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=True,
+            )
+        )
+
+        self.engine = create_async_engine(url, **pool_options)
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+        # registration only happens once in /start, so almost every lookup is a hit
+        self.user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+        # loaded by load_monthly_spend, then kept current as activities are added
+        self.spend_ledger = SpendLedger(FREE_MONTHLY_QUOTA)
+        self._resync_task = None
+
+        # activities are written in batches off the request path
+        self.activity_buffer = (
+            ActivityBuffer(
+                self.insert_activities,
+                max_batch=ACTIVITY_BATCH_SIZE,
+                flush_interval=ACTIVITY_FLUSH_INTERVAL,
+                max_pending=ACTIVITY_MAX_PENDING,
+            )
+            if write_behind
+            else None
+        )
+
+    async def close(self):
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+        if self.activity_buffer is not None:
+            await self.activity_buffer.drain()
+        await self.engine.dispose()
+
+    def _insert(self, table):
+        # postgres, cockroachdb and sqlite all support ON CONFLICT, each with its own construct
+        if self.engine.dialect.name == "sqlite":
+            return sqlite_insert(table)
+        return pg_insert(table)
+
+    def _add_monthly_spend(self, month: date, cost: float):
+        stmt = self._insert(MonthlySpend).values(month=month, cost=cost)
+        return stmt.on_conflict_do_update(
+            index_elements=[MonthlySpend.month],
+            set_={"cost": MonthlySpend.cost + stmt.excluded.cost},
+        )
+
+    async def _sum_month_cost(self, session, month: date, user_id: int = None):
+        # sargable month range, so the (user_id, timestamp) and timestamp indexes apply
+        next_month = next_month_start(month)
+        total = 0.0
+        for activity in (TextToSpeechActivity, SpeechToTextActivity):
+            query = select(func.coalesce(func.sum(activity.cost), 0)).where(
+                activity.timestamp >= month,
+                activity.timestamp < next_month,
+            )
+            if user_id is not None:
+                query = query.where(activity.user_id == user_id)
+            total += await session.scalar(query)
+        return total
+
+    @timed(DB_LATENCY)
+    async def load_monthly_spend(self):
+        month = month_start(datetime.now())
 
-    def create_tables(self):
         try:
-            session = self.Session()
-            Base.metadata.create_all(self.engine)
+            async with self.Session() as session:
+                total = await session.scalar(
+                    select(MonthlySpend.cost).where(MonthlySpend.month == month)
+                )
+
+                if total is None:
+                    # first load this month, backfill the totals from the activities
+                    total = await self._sum_month_cost(session, month)
+                    await session.execute(
+                        self._insert(MonthlySpend)
+                        .values(month=month, cost=total)
+                        .on_conflict_do_nothing(index_elements=[MonthlySpend.month])
+                    )
+                    await session.commit()
+
+            self.spend_ledger.set(month, total)
             return True
         except Exception as e:
-            logger.error(f"Error creating tables: {str(e)}")
+            logger.error(f"Error loading monthly spend: {str(e)}")
             return False
-        finally:
-            session.close()
 
-    def register_user(self, user_id, first_name, last_name, username):
+    @timed(DB_LATENCY)
+    async def get_balance(self, user_id: int):
+        """
+        Month-to-date spend of the user and of all users combined, in dollars.
+        Returns None on error.
+        """
+        month = month_start(datetime.now())
 
         try:
-            # create session
-            session = self.Session()
-            # create new user
-            user = User(
-                user_id=user_id,
-                first_name=first_name,
-                last_name=last_name,
-                username=username,
-                is_vip=user_id in VIP_USER_ID_LIST,
-            )
-            session.add(user)
-            session.commit()
-
-            # create free trial, for 7 days
-            free_trial = FreeTrial(
-                user_id=user_id,
-                start_date=date.today(),
-                end_date=date.today() + timedelta(days=7),
-                amount=1,
-            )
-            session.add(free_trial)
-            session.commit()
+            async with self.Session() as session:
+                user_spend = await self._sum_month_cost(session, month, user_id)
+                total_spend = await self._sum_month_cost(session, month)
+            return {"user": user_spend, "total": total_spend}
+        except Exception as e:
+            logger.error(f"Error getting balance: {str(e)}")
+            return None
+
+    def start_monthly_spend_resync(self, interval: float):
+        # picks up spend recorded by other instances and corrects any drift
+        async def resync():
+            while True:
+                await asyncio.sleep(interval)
+                await self.load_monthly_spend()
+
+        self._resync_task = asyncio.create_task(resync())
+
+    @timed(DB_LATENCY)
+    async def register_user(self, user_id, first_name, last_name, username):
+
+        try:
+            async with self.Session() as session:
+                # create new user
+                user = User(
+                    user_id=user_id,
+                    first_name=first_name,
+                    last_name=last_name,
+                    username=username,
+                    is_vip=user_id in VIP_USER_ID_LIST,
+                )
+                session.add(user)
+                await session.flush()
+
+                # create free trial, for 7 days
+                free_trial = FreeTrial(
+                    user_id=user_id,
+                    start_date=date.today(),
+                    end_date=date.today() + timedelta(days=7),
+                    amount=1,
+                )
+                session.add(free_trial)
+                await session.commit()
+
+            self.user_cache.set(user_id, True)
             return True
         except Exception as e:
             logger.error(f"Error registering user: {str(e)}")
             return False
-        finally:
-            session.close()
 
-    def is_user_registered(self, user_id):
+    async def is_user_registered(self, user_id):
+        is_registered = self.user_cache.get(user_id)
+        if is_registered is not None:
+            return is_registered
+
+        # only the misses are timed, the hits would hide the query latency
         try:
-            session = self.Session()
-            user = session.query(User).filter(User.user_id == user_id).first()
-            return user is not None
+            with observe(DB_LATENCY, "is_user_registered"):
+                async with self.Session() as session:
+                    registered_id = await session.scalar(
+                        select(User.user_id).where(User.user_id == user_id).limit(1)
+                    )
         except Exception as e:
             logger.error(f"Error checking if user is registered: {str(e)}")
             return False
-        finally:
-            session.close()
 
-    def add_text_to_speech_activity(
+        # negative entries expire sooner, errors above are never cached
+        is_registered = registered_id is not None
+        self.user_cache.set(
+            user_id,
+            is_registered,
+            ttl=None if is_registered else USER_CACHE_NEGATIVE_TTL,
+        )
+        return is_registered
+
+    @timed(DB_LATENCY)
+    async def insert_activities(self, rows: list):
+        """
+        Bulk inserts (model, row) pairs and adds their cost to monthly_spend, all in
+        one transaction. Raises on failure, the callers decide whether to retry.
+        """
+        by_model = {}
+        by_month = {}
+        for model, row in rows:
+            by_model.setdefault(model, []).append(row)
+            month = month_start(row["timestamp"])
+            by_month[month] = by_month.get(month, 0.0) + row["cost"]
+
+        async with self.Session() as session:
+            for model, model_rows in by_model.items():
+                await session.execute(insert(model), model_rows)
+            for month, cost in by_month.items():
+                await session.execute(self._add_monthly_spend(month, cost))
+            await session.commit()
+
+    async def _add_activity(self, model, row: dict) -> bool:
+        # the ledger counts the spend right away, even while the row is buffered
+        self.spend_ledger.add(row["timestamp"], row["cost"])
+
+        if self.activity_buffer is not None:
+            return await self.activity_buffer.put(model, row)
+
+        await self.insert_activities([(model, row)])
+        return True
+
+    async def add_text_to_speech_activity(
         self, user_id: int, used_chars: float, timestamp: datetime
     ):
         """
@@ -137,136 +427,100 @@ class DBManager:
         """
 
         try:
-            session = self.Session()
             # calculate cost
             # todo: make it parametric
-            cost = (used_chars / 1000000) * 15 * 1
-            tts_activity = TextToSpeechActivity(
-                user_id=user_id, used_chars=used_chars, cost=cost, timestamp=timestamp
+            cost = tts_cost(used_chars)
+            TTS_CHARACTERS.inc(used_chars)
+            OPENAI_COST.labels("tts").inc(cost)
+            return await self._add_activity(
+                TextToSpeechActivity,
+                dict(
+                    user_id=user_id,
+                    used_chars=used_chars,
+                    cost=cost,
+                    timestamp=timestamp,
+                ),
             )
-            session.add(tts_activity)
-            session.commit()
-            return True
         except Exception as e:
             logger.error(f"Error adding tts activity: {str(e)}")
             return False
-        finally:
-            session.close()
 
-    def add_speech_to_text_activity(
-        self, user_id: int, used_seconds: float, timestamp: datetime
+    async def add_speech_to_text_activity(
+        self,
+        user_id: int,
+        used_seconds: float,
+        timestamp: datetime,
+        original_seconds: float = None,
     ):
         """
         Whisper $0.006 / minute (rounded to the nearest second)
         TTS $15.000 / 1M characters
+
+        used_seconds is the audio sent to whisper, original_seconds the voice note
+        before its silences were trimmed.
         """
 
         try:
-            session = self.Session()
             # calculate cost
             # todo: make it parametric
-            cost = (used_seconds / 60) * 0.006 * 1
-            stt_activity = SpeechToTextActivity(
-                user_id=user_id,
-                used_seconds=used_seconds,
-                cost=cost,
-                timestamp=timestamp,
+            cost = stt_cost(used_seconds)
+            STT_SECONDS.inc(used_seconds)
+            OPENAI_COST.labels("stt").inc(cost)
+            return await self._add_activity(
+                SpeechToTextActivity,
+                dict(
+                    user_id=user_id,
+                    used_seconds=used_seconds,
+                    original_seconds=(
+                        used_seconds if original_seconds is None else original_seconds
+                    ),
+                    cost=cost,
+                    timestamp=timestamp,
+                ),
             )
-            session.add(stt_activity)
-            session.commit()
-            return True
         except Exception as e:
             logger.error(f"Error adding stt activity: {str(e)}")
             return False
-        finally:
-            session.close()
-
-    def drop_tables(self):
 
+    @timed(DB_LATENCY)
+    async def get_transcript(
+        self, file_unique_id: str = None, content_hash: str = None
+    ) -> str:
         try:
-            session = self.Session()
-            # drop all the view first
-            session.execute(text("DROP VIEW IF EXISTS user_eligibility CASCADE;"))
-            session.commit()
-
-            # drop all the tables
-            Base.metadata.drop_all(self.engine)
-            return True
+            async with self.Session() as session:
+                query = select(Transcript.text)
+                if file_unique_id is not None:
+                    query = query.where(Transcript.file_unique_id == file_unique_id)
+                else:
+                    query = query.where(Transcript.content_hash == content_hash)
+                return await session.scalar(query.limit(1))
         except Exception as e:
-            logger.error(f"Error dropping tables: {str(e)}")
-            return False
-        finally:
-            session.close()
+            logger.error(f"Error getting transcript: {str(e)}")
+            return None
 
-    def create_eligibility_view(self):
-        # create view for user eligibility, all users combined will share the same quota of 3 dollars in total on a monthly basis with TTS and STT
+    @timed(DB_LATENCY)
+    async def save_transcript(self, file_unique_id: str, content_hash: str, text: str):
         try:
-            session = self.Session()
-            session.execute(
-                text(
-                    """
-                    CREATE OR REPLACE VIEW user_eligibility AS
-                    SELECT
-                        CASE
-                            WHEN COALESCE(SUM(cost), 0) <= 3 THEN TRUE
-                            ELSE FALSE
-                        END AS is_eligible
-                    FROM (
-                        SELECT
-                            cost
-                        FROM text_to_speech_activity
-                        WHERE DATE_TRUNC('month', timestamp) = DATE_TRUNC('month', CURRENT_DATE)
-                        UNION ALL
-                        SELECT
-                            cost
-                        FROM speech_to_text_activity
-                        WHERE DATE_TRUNC('month', timestamp) = DATE_TRUNC('month', CURRENT_DATE)
-                    ) AS combined_costs;
-                    """
+            async with self.Session() as session:
+                await session.execute(
+                    self._insert(Transcript)
+                    .values(
+                        file_unique_id=file_unique_id,
+                        content_hash=content_hash,
+                        text=text,
+                    )
+                    .on_conflict_do_nothing(index_elements=[Transcript.file_unique_id])
                 )
-            )
-            session.commit()
+                await session.commit()
             return True
         except Exception as e:
-            logger.error(f"Error creating eligibility view: {str(e)}")
+            logger.error(f"Error saving transcript: {str(e)}")
             return False
-        finally:
-            session.close()
 
-    def check_user_eligibility(self, user_id: int) -> bool:
-        # check view user_eligibility, it is a view just have one column is_eligible and one row of true or false, if true the user is eligible
-        try:
-            if user_id in VIP_USER_ID_LIST:
-                return True
-
-            session = self.Session()
-            user_eligibility = session.execute(
-                text("SELECT * FROM user_eligibility")
-            ).scalar()
-            return user_eligibility == True
-        except Exception as e:
-            logger.error(f"Error checking user eligibility: {str(e)}")
-            return False
-        finally:
-            session.close()
-
-
-if __name__ == "__main__":
-
-    # Create a DBManager instance
-    db_manager = DBManager()
-
-    if True:
-        # drop tables
-        db_manager.drop_tables()
-
-        # init tables
-        db_manager.create_tables()
-
-    if True:
-        # todo create view for user cost calculation
-        db_manager.create_eligibility_view()
+    async def check_user_eligibility(self, user_id: int) -> bool:
+        # all free users share FREE_MONTHLY_QUOTA dollars a month, checked against the
+        # in-memory ledger instead of the user_eligibility view
+        if user_id in VIP_USER_ID_LIST:
+            return True
 
-    if False:
-        # check user eligibility
-        print(db_manager.check_user_eligibility(1))
+        return self.spend_ledger.is_within_quota()
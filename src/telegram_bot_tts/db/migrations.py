@@ -0,0 +1,239 @@
+"""
+Versioned schema migrations, run as a separate step before the bot is (re)deployed
+instead of on every boot:
+
+    uv run python -m telegram_bot_tts.db.migrations upgrade
+    uv run python -m telegram_bot_tts.db.migrations status
+
+The applied versions are kept in the schema_migrations table. To change the schema,
+append a migration to MIGRATIONS with the next version, never edit an applied one.
+Each migration carries its own DDL and never reads the models, which keep changing
+after it was written. The first migrations are idempotent so databases created
+before this table existed are brought under it by a plain upgrade.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql import func
+
+from telegram_bot_tts.db.db_manager import Base, to_async_url
+
+logger = logging.getLogger(__name__)
+
+# kept out of Base so create_all and drop_all of the models never touch it
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+def create_tables(conn):
+    # the schema as of version 1, a snapshot of the models at the time
+    metadata = MetaData()
+    Table(
+        "users",
+        metadata,
+        Column("user_id", Integer, primary_key=True),
+        Column("first_name", String, nullable=True),
+        Column("last_name", String, nullable=True),
+        Column("username", String, nullable=True),
+        Column("is_vip", Boolean),
+        Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    )
+    Table(
+        "free_trials",
+        metadata,
+        Column("free_trial_id", Integer, primary_key=True),
+        Column("user_id", Integer, ForeignKey("users.user_id")),
+        Column("start_date", Date, nullable=False),
+        Column("end_date", Date),
+        Column("amount", Float, nullable=False),
+    )
+    for table, prefix, usage in (
+        ("text_to_speech_activity", "tts", "used_chars"),
+        ("speech_to_text_activity", "stt", "used_seconds"),
+    ):
+        Table(
+            table,
+            metadata,
+            Column("activity_id", Integer, primary_key=True),
+            Column("user_id", Integer, ForeignKey("users.user_id")),
+            Column(usage, Integer, nullable=False),
+            Column("cost", Float, nullable=False),
+            Column("timestamp", DateTime(timezone=True), server_default=func.now()),
+            Index(
+                f"ix_{prefix}_activity_user_timestamp",
+                "user_id",
+                "timestamp",
+                postgresql_include=["cost"],
+            ),
+            Index(
+                f"ix_{prefix}_activity_timestamp",
+                "timestamp",
+                postgresql_include=["cost"],
+            ),
+        )
+    Table(
+        "transcripts",
+        metadata,
+        Column("file_unique_id", String, primary_key=True),
+        Column("content_hash", String, nullable=False, index=True),
+        Column("text", String, nullable=False),
+        Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    )
+    Table(
+        "monthly_spend",
+        metadata,
+        Column("month", Date, primary_key=True),
+        Column("cost", Float, nullable=False),
+    )
+    metadata.create_all(conn)
+
+    # create_all skips the indexes of tables that already exist
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def add_original_seconds(conn):
+    # databases created from the models after the column was added already have it
+    columns = inspect(conn).get_columns("speech_to_text_activity")
+    if any(column["name"] == "original_seconds" for column in columns):
+        return
+    conn.execute(
+        text("ALTER TABLE speech_to_text_activity ADD COLUMN original_seconds INTEGER")
+    )
+
+
+def create_eligibility_view(conn):
+    # all users combined share the same quota of 3 dollars a month with TTS and STT.
+    # The bot checks an in-memory ledger, the view is kept for ad hoc queries
+    if conn.dialect.name == "sqlite":
+        return
+    conn.execute(
+        text(
+            """
+            CREATE OR REPLACE VIEW user_eligibility AS
+            SELECT
+                CASE
+                    WHEN COALESCE(SUM(cost), 0) <= 3 THEN TRUE
+                    ELSE FALSE
+                END AS is_eligible
+            FROM (
+                SELECT
+                    cost
+                FROM text_to_speech_activity
+                WHERE timestamp >= DATE_TRUNC('month', CURRENT_DATE)
+                AND timestamp < DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
+                UNION ALL
+                SELECT
+                    cost
+                FROM speech_to_text_activity
+                WHERE timestamp >= DATE_TRUNC('month', CURRENT_DATE)
+                AND timestamp < DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
+            ) AS combined_costs;
+            """
+        )
+    )
+
+
+# (version, name, function run with a sync connection inside the transaction)
+MIGRATIONS = [
+    (1, "create tables and indexes", create_tables),
+    (2, "add speech_to_text_activity.original_seconds", add_original_seconds),
+    (3, "create the user_eligibility view", create_eligibility_view),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version(engine: AsyncEngine) -> int:
+    # 0 for a database that was never migrated
+    async with engine.connect() as conn:
+        has_table = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table("schema_migrations")
+        )
+        if not has_table:
+            return 0
+        version = await conn.scalar(select(func.max(schema_migrations.c.version)))
+        return version or 0
+
+
+async def upgrade(engine: AsyncEngine, target: int = LATEST_VERSION) -> list[int]:
+    """
+    Applies the migrations above the current version up to `target`, each in its
+    own transaction. Returns the versions applied.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(schema_migrations.create, checkfirst=True)
+
+    version = await current_version(engine)
+    applied = []
+    for number, name, migration in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        logger.info(f"Applying migration {number}: {name}")
+        async with engine.begin() as conn:
+            await conn.run_sync(migration)
+            await conn.execute(
+                insert(schema_migrations).values(version=number, name=name)
+            )
+        applied.append(number)
+    return applied
+
+
+async def reset(engine: AsyncEngine):
+    # drops everything, for local development only
+    async with engine.begin() as conn:
+        if conn.dialect.name != "sqlite":
+            await conn.execute(text("DROP VIEW IF EXISTS user_eligibility CASCADE;"))
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(schema_migrations.drop, checkfirst=True)
+
+
+async def main(args):
+    engine = create_async_engine(
+        to_async_url(args.db_url or os.environ["DATABASE_URL"])
+    )
+    try:
+        if args.command == "reset":
+            await reset(engine)
+        if args.command in ("upgrade", "reset"):
+            applied = await upgrade(engine, args.target)
+            print(f"applied {applied}" if applied else "nothing to apply")
+        print(f"schema version {await current_version(engine)} of {LATEST_VERSION}")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="migrate the bot's database")
+    parser.add_argument("command", choices=["upgrade", "status", "reset"])
+    parser.add_argument("--target", type=int, default=LATEST_VERSION)
+    parser.add_argument("--db-url", help="defaults to DATABASE_URL")
+    asyncio.run(main(parser.parse_args()))
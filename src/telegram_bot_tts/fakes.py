@@ -0,0 +1,348 @@
+"""
+In-process stand-ins for Telegram and OpenAI used by the tests and the benchmarks,
+so nothing reaches the network or costs money.
+"""
+
+import asyncio
+import itertools
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Optional
+
+import httpx
+from aiohttp import web
+from openai import APIStatusError, InternalServerError, RateLimitError
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "tts bot",
+    "username": "openaitts_bot",
+}
+
+
+MENTION = re.compile(r"(?<!\w)@\w+")
+COMMAND = re.compile(r"/\w+(@\w+)?")
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user {user_id}"}
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def text_entities(text: str) -> list[dict]:
+    # the entities telegram marks in a text, a leading /command and the @mentions,
+    # offsets and lengths in utf-16 code units
+    entities = [
+        {
+            "type": "mention",
+            "offset": utf16_len(text[: match.start()]),
+            "length": utf16_len(match.group()),
+        }
+        for match in MENTION.finditer(text)
+    ]
+    if match := COMMAND.match(text):
+        entities.insert(0, {"type": "bot_command", "offset": 0, "length": match.end()})
+    return entities
+
+
+def make_text_update(
+    update_id: int,
+    user_id: int,
+    text: str,
+    chat_type: str = "private",
+    reply_to_bot: bool = False,
+) -> dict:
+    chat_id = user_id if chat_type == "private" else -1000 - user_id % 10
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": make_user(user_id),
+        "text": text,
+    }
+    if entities := text_entities(text):
+        message["entities"] = entities
+    if reply_to_bot:
+        message["reply_to_message"] = {
+            "message_id": update_id - 1,
+            "date": message["date"],
+            "chat": message["chat"],
+            "from": BOT_USER,
+            "voice": {"file_id": "sent", "file_unique_id": "sent", "duration": 1},
+        }
+    return {"update_id": update_id, "message": message}
+
+
+def make_voice_update(
+    update_id: int, user_id: int, duration: int, chat_type: str = "private"
+) -> dict:
+    chat_id = user_id if chat_type == "private" else -1000 - user_id % 10
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": make_user(user_id),
+            "voice": {
+                "file_id": f"voice-{update_id}",
+                "file_unique_id": f"unique-{update_id}",
+                "duration": duration,
+            },
+        },
+    }
+
+
+class FakeTelegramServer:
+    """
+    Minimal Bot API answering every method with a plausible result, point
+    `Application.builder().base_url(server.base_url)` at it.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8081,
+        latency: float = 0.0,
+        voice_bytes: int = 1024,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.voice_bytes = voice_bytes
+        self.calls = {}
+        # bot api requests answered so far, and an event to hold the answers on
+        self.answered = 0
+        self.hold: Optional[asyncio.Event] = None
+        # (method, text fields) of every send and edit, uploads are left out
+        self.sent = []
+        # (method, filename, bytes) of every file uploaded
+        self.uploads = []
+        # handed out by the next getUpdates, for bots that poll the fake
+        self.updates = []
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+        # bot api uploads go up to 50 MB
+        self.web_app = web.Application(client_max_size=50 * 2**20)
+        self.web_app.router.add_post("/bot{token}/{method}", self.handle)
+        self.web_app.router.add_get("/bot{token}/{method}", self.handle)
+        self.web_app.router.add_get("/file/bot{token}/{path:.*}", self.download)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://{self.host}:{self.port}/file/bot"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.hold is not None:
+            await self.hold.wait()
+
+        form = await request.post()
+        fields = {key: value for key, value in form.items() if isinstance(value, str)}
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                self.uploads.append((method, value.filename, len(value.file.read())))
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result, self.updates = self.updates, []
+        elif method == "getFile":
+            file_id = fields.get("file_id", "file")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": self.voice_bytes,
+                "file_path": f"voice/{file_id}.oga",
+            }
+        elif method.startswith("send") or method.startswith("edit"):
+            self.sent.append((method, fields))
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+                "text": fields.get("text"),
+                "voice": {
+                    "file_id": f"sent-{method}",
+                    "file_unique_id": f"sent-{method}",
+                    "duration": 1,
+                },
+            }
+        else:
+            result = True
+
+        self.answered += 1
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request: web.Request) -> web.Response:
+        self.calls["download"] = self.calls.get("download", 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # every file has its own content, so voice notes don't share a content hash
+        path = request.match_info["path"].encode()
+        return web.Response(body=(b"OggS" + path).ljust(self.voice_bytes, b"\0"))
+
+
+class FakeOpenAI:
+    """
+    Stands in for AsyncOpenAI's audio endpoints. Every call sleeps for the
+    configured latency plus up to `jitter` seconds, takes `slow_latency` seconds
+    instead at `slow_rate`, and fails with `error_status` at `error_rate`. Speech
+    is `audio_bytes` long, transcription takes `stt_seconds_per_mb` longer per MB
+    uploaded. Set `error_rate` to 1 for an outage.
+
+    With a `capacity`, calls beyond that many in flight to an api are answered with
+    a 429 right away, the way a rate limited account is.
+    """
+
+    def __init__(
+        self,
+        tts_latency: float = 0.5,
+        stt_latency: float = 2.0,
+        audio_bytes: int = 16000,
+        stt_seconds_per_mb: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        transcript: str = "hello, how are you?",
+        seed: int = None,
+        slow_rate: float = 0.0,
+        slow_latency: float = 30.0,
+        error_status: int = 500,
+        capacity: int = None,
+    ):
+        self.tts_latency = tts_latency
+        self.stt_latency = stt_latency
+        self.audio_bytes = audio_bytes
+        self.stt_seconds_per_mb = stt_seconds_per_mb
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.transcript = transcript
+        self.rng = random.Random(seed)
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_status = error_status
+        self.capacity = capacity
+        self.calls = {"tts": 0, "stt": 0}
+        self.in_flight = {"tts": 0, "stt": 0}
+        self.errors = 0
+        self.rate_limited = 0
+
+        self.audio = SimpleNamespace(
+            speech=SimpleNamespace(
+                create=self._speech_create,
+                with_streaming_response=SimpleNamespace(create=self._speech_stream),
+            ),
+            transcriptions=SimpleNamespace(create=self._transcriptions_create),
+        )
+
+    def _audio(self) -> bytes:
+        return b"OggS" + b"\0" * (self.audio_bytes - 4)
+
+    def _error(self, api: str, status: int) -> APIStatusError:
+        request = httpx.Request("POST", f"https://api.openai.com/v1/audio/{api}")
+        response = httpx.Response(status, request=request)
+        if status == 429:
+            return RateLimitError("fake rate limit", response=response, body=None)
+        if status >= 500:
+            return InternalServerError(
+                "fake server error", response=response, body=None
+            )
+        return APIStatusError("fake error", response=response, body=None)
+
+    async def _respond(self, api: str, latency: float):
+        self.calls[api] += 1
+        if self.capacity is not None and self.in_flight[api] >= self.capacity:
+            self.rate_limited += 1
+            raise self._error(api, 429)
+
+        if self.rng.random() < self.slow_rate:
+            latency = self.slow_latency
+        self.in_flight[api] += 1
+        try:
+            await asyncio.sleep(latency + self.rng.uniform(0, self.jitter))
+        finally:
+            self.in_flight[api] -= 1
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise self._error(api, self.error_status)
+
+    async def _speech_create(self, **kwargs):
+        await self._respond("tts", self.tts_latency)
+        audio = self._audio()
+        return SimpleNamespace(
+            content=audio,
+            iter_bytes=lambda: iter([audio]),
+            write_to_file=lambda path: open(path, "wb").write(audio),
+        )
+
+    @asynccontextmanager
+    async def _speech_stream(self, **kwargs):
+        await self._respond("tts", self.tts_latency)
+        audio = self._audio()
+
+        async def iter_bytes(chunk_size: int = 4096):
+            for i in range(0, len(audio), chunk_size):
+                yield audio[i : i + chunk_size]
+
+        yield SimpleNamespace(iter_bytes=iter_bytes)
+
+    async def _transcriptions_create(self, **kwargs):
+        # longer audio takes longer to transcribe
+        file = kwargs.get("file")
+        if isinstance(file, tuple):
+            size = len(file[1])
+        else:
+            size = len(file.getbuffer()) if hasattr(file, "getbuffer") else 0
+        await self._respond(
+            "stt", self.stt_latency + self.stt_seconds_per_mb * size / (1024 * 1024)
+        )
+        return SimpleNamespace(text=self.transcript)
+
+
+class FakeDBManager:
+    """In-memory stand-in for DBManager, every user counts as registered."""
+
+    def __init__(self):
+        self.activities = []
+
+    async def is_user_registered(self, user_id):
+        return True
+
+    async def register_user(self, user_id, first_name, last_name, username):
+        return True
+
+    async def check_user_eligibility(self, user_id):
+        return True
+
+    async def add_text_to_speech_activity(self, user_id, used_chars, timestamp):
+        self.activities.append(("tts", user_id, used_chars, timestamp))
+        return True
+
+    async def add_speech_to_text_activity(
+        self, user_id, used_seconds, timestamp, original_seconds=None
+    ):
+        self.activities.append(("stt", user_id, used_seconds, timestamp))
+        return True
@@ -1,12 +1,86 @@
+import atexit
+import contextvars
+import json
 import logging
+import queue
+import random
+import zlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
+# the update being handled, set once per update and read by every log record
+correlation_id: contextvars.ContextVar = contextvars.ContextVar(
+    "correlation_id", default=None
+)
 
-def setup_logger(app_name: str, env: str) -> logging.Logger:
+
+class CorrelationFilter(logging.Filter):
+    """
+    Stamps records with the correlation id of the update being handled, and keeps
+    only `debug_sample_rate` of the DEBUG records. Updates are sampled as a whole,
+    so a kept update keeps all of its debug lines.
+    """
+
+    def __init__(self, debug_sample_rate: float = 1.0):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+
+        if record.levelno > logging.DEBUG or self.debug_sample_rate >= 1:
+            return True
+        if record.correlation_id is None:
+            return random.random() < self.debug_sample_rate
+        bucket = zlib.crc32(str(record.correlation_id).encode()) % 10000
+        return bucket < self.debug_sample_rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object a line, the way log collectors pick them up
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None) is not None:
+            entry["correlation_id"] = record.correlation_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Puts records on the queue as they are. The stock QueueHandler formats the
+    message in the calling thread, here the listener thread does it, so a logging
+    call on the event loop costs a filter and a queue put.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # render the traceback now, the frames may be gone by the time it's read
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logger(
+    app_name: str,
+    env: str,
+    json_output: bool = False,
+    debug_sample_rate: float = 1.0,
+    stream=None,
+) -> logging.Logger:
     # Create a logger
     logger = logging.getLogger(app_name)
 
-    # Create a console handler
-    ch = logging.StreamHandler()
+    # Create a console handler, written from a background thread
+    ch = logging.StreamHandler(stream)
 
     # Set log level based on the environment
     if env.lower() == "dev":
@@ -17,12 +91,24 @@ def setup_logger(app_name: str, env: str) -> logging.Logger:
         ch.setLevel(logging.INFO)
 
     # Create a formatter and set it for the handler
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+    if json_output:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(correlation_id)s - %(message)s"
+        )
     ch.setFormatter(formatter)
 
+    # the event loop only enqueues records, the listener thread formats and writes
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, ch, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    qh = LazyQueueHandler(log_queue)
+    qh.addFilter(CorrelationFilter(debug_sample_rate))
+
     # Add the handler to the logger
-    logger.addHandler(ch)
+    logger.addHandler(qh)
 
     return logger
@@ -0,0 +1,166 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+# api calls take seconds to minutes, db queries and cache hits milliseconds
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+OPENAI_LATENCY = Histogram(
+    "openai_request_seconds",
+    "OpenAI api request latency, without the wait for a slot",
+    ["api"],
+    buckets=SLOW_BUCKETS,
+)
+OPENAI_IN_FLIGHT = Gauge(
+    "openai_requests_in_flight", "OpenAI api requests in flight", ["api"]
+)
+TELEGRAM_LATENCY = Histogram(
+    "telegram_transfer_seconds",
+    "Time to download voice notes from and upload voice messages to Telegram",
+    ["operation"],
+    buckets=SLOW_BUCKETS,
+)
+DB_LATENCY = Histogram(
+    "db_method_seconds",
+    "DBManager method latency",
+    ["method"],
+    buckets=FAST_BUCKETS,
+)
+HANDLER_LATENCY = Histogram(
+    "handler_seconds",
+    "End to end message handler latency",
+    ["handler"],
+    buckets=SLOW_BUCKETS,
+)
+HANDLERS_IN_FLIGHT = Gauge(
+    "handlers_in_flight", "Message handlers in progress", ["handler"]
+)
+HTTP_POOL_WAIT = Histogram(
+    "http_pool_wait_seconds",
+    "Time a request waits for a connection from its client's pool",
+    ["client"],
+    buckets=FAST_BUCKETS,
+)
+HTTP_CONNECTIONS = Counter(
+    "http_connections_opened", "New connections opened by a client", ["client"]
+)
+OPENAI_RETRIES = Counter("openai_retries", "OpenAI api calls retried", ["api"])
+OPENAI_HEDGES = Counter(
+    "openai_hedges", "Duplicate OpenAI api calls sent for slow ones", ["api"]
+)
+CIRCUIT_OPEN = Gauge(
+    "openai_circuit_open", "1 while calls to the api fail fast", ["api"]
+)
+OPENAI_CONCURRENCY_LIMIT = Gauge(
+    "openai_concurrency_limit", "Adaptive limit on calls in flight to the api", ["api"]
+)
+ADMISSION_DROPPED = Counter(
+    "admission_dropped",
+    "Messages dropped before any work, by the admission stage that dropped them",
+    ["kind", "stage"],
+)
+OPENAI_SHED = Counter(
+    "openai_shed", "Work turned away as the api would keep it waiting", ["api"]
+)
+
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop wakes a sleeping coroutine",
+    buckets=FAST_BUCKETS,
+)
+LOOP_STALLS = Counter("event_loop_stalls", "Times the event loop was blocked")
+
+TTS_CHARACTERS = Counter("tts_characters", "Characters synthesized")
+STT_SECONDS = Counter("stt_audio_seconds", "Seconds of audio transcribed")
+OPENAI_COST = Counter("openai_cost_dollars", "Recorded OpenAI spend", ["api"])
+
+
+@contextmanager
+def observe(histogram: Histogram, *labels: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+def timed(histogram: Histogram, label: str = None, in_flight: Gauge = None):
+    """
+    Records the latency of an async function in `histogram`, labelled with
+    `label` or the function's name, and counts it in `in_flight` while it runs.
+    """
+
+    def decorator(func):
+        name = label or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with observe(histogram, name):
+                if in_flight is None:
+                    return await func(*args, **kwargs)
+                with in_flight.labels(name).track_inprogress():
+                    return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class StatsCollector(Collector):
+    """
+    Exposes the `stats()` of the scheduler, the caches and the activity buffer as
+    gauges, read when prometheus scrapes so nothing is updated on the hot path.
+    """
+
+    def __init__(self, scheduler=None, db_manager=None, **caches):
+        self.scheduler = scheduler
+        self.db_manager = db_manager
+        self.caches = caches
+
+    def collect(self):
+        if self.scheduler is not None:
+            stats = self.scheduler.stats()
+            for name, documentation, key in (
+                ("scheduler_active_jobs", "Jobs running", "active"),
+                ("scheduler_queued_jobs", "Jobs waiting for a slot", "waiting"),
+                ("scheduler_wait_p95_seconds", "p95 wait of recent jobs", "wait_p95"),
+            ):
+                gauge = GaugeMetricFamily(name, documentation, labels=["lane"])
+                for lane in self.scheduler.LANES:
+                    gauge.add_metric([lane], stats[lane][key])
+                yield gauge
+            yield GaugeMetricFamily(
+                "scheduler_rejected",
+                "Jobs turned away by the rate limits",
+                value=stats["rejected"],
+            )
+
+        if self.db_manager is not None:
+            ledger = self.db_manager.spend_ledger
+            yield GaugeMetricFamily(
+                "monthly_spend_dollars",
+                "Spend of the current month shared by the free users",
+                value=ledger.total,
+            )
+            buffer = self.db_manager.activity_buffer
+            if buffer is not None:
+                gauge = GaugeMetricFamily(
+                    "activity_buffer", "Activity write-behind buffer", labels=["stat"]
+                )
+                for key, value in buffer.stats().items():
+                    gauge.add_metric([key], value)
+                yield gauge
+
+        for cache_name, cache in self.caches.items():
+            gauge = GaugeMetricFamily(
+                f"{cache_name}_cache", f"{cache_name} cache stats", labels=["stat"]
+            )
+            for key, value in cache.stats().items():
+                if isinstance(value, (int, float)):
+                    gauge.add_metric([key], value)
+            yield gauge
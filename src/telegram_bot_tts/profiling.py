@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from telegram_bot_tts.metrics import LOOP_LAG, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+
+def format_task(loop: asyncio.AbstractEventLoop) -> str:
+    # the task running on the loop, read from another thread so only best effort
+    try:
+        task = asyncio.tasks._current_tasks.get(loop)
+    except Exception:
+        task = None
+    if task is None:
+        return "no task (a plain callback)"
+    return f"{task.get_name()} {task.get_coro().__qualname__}"
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes a sleeping coroutine, every `interval`
+    seconds, into the loop lag histogram.
+
+    A watchdog thread checks the heartbeat, and when the loop has not come round
+    for `threshold` seconds it logs the task and the stack that are blocking it.
+    Off the stall path it costs one timer a loop tick and a thread that sleeps.
+    """
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._reported = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-lag-monitor")
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            LOOP_LAG.observe(max(self._beat - start - self.interval, 0.0))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            self.check(time.monotonic())
+
+    def check(self, now: float) -> bool:
+        """
+        Reports a stall when the loop has not come round for `threshold` seconds
+        at `now`, once per stall. Returns whether it reported.
+        """
+        beat = self._beat
+        stalled = now - beat - self.interval
+        if stalled < self.threshold or self._reported == beat:
+            return False
+
+        # report every stall once, with what the loop thread is doing right now
+        self._reported = beat
+        self.stalls += 1
+        LOOP_STALLS.inc()
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        logger.warning(
+            f"Event loop blocked for {stalled:.2f}s in "
+            f"{format_task(self._loop)}:\n{stack}"
+        )
+        return True
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread every `sample_interval` seconds for
+    a given duration, and writes the stacks in collapsed format (one
+    `frame;frame;frame count` line each, as flamegraph.pl and speedscope read
+    them) to `folder`. Nothing runs while no profile is being taken.
+    """
+
+    def __init__(self, folder: str, sample_interval: float = 0.005):
+        self.folder = Path(folder)
+        self.sample_interval = sample_interval
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, seconds: float) -> tuple[Path, Counter]:
+        """
+        Profiles the event loop thread for `seconds` and returns the path of the
+        dump and the sample count of every stack.
+        """
+        async with self._lock:
+            thread_id = threading.get_ident()
+            stacks = await asyncio.to_thread(self._sample, thread_id, seconds)
+
+            self.folder.mkdir(parents=True, exist_ok=True)
+            path = self.folder / f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt"
+            lines = "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+            await asyncio.to_thread(path.write_text, lines)
+            return path, stacks
+
+    def _sample(self, thread_id: int, seconds: float) -> Counter:
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[self._collapse(frame)] += 1
+            time.sleep(self.sample_interval)
+        return stacks
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_qualname} ({Path(code.co_filename).name})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+def top_functions(stacks: Counter, limit: int = 10) -> list[tuple[str, float]]:
+    """
+    The functions on top of the most samples, as (function, share of samples).
+    The idle loop waiting in select counts too, so the rest is the busy time.
+    """
+    total = sum(stacks.values())
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [(name, count / total) for name, count in leaves.most_common(limit)]
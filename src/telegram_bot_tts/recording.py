@@ -0,0 +1,200 @@
+"""
+Records the incoming updates to a local file and plays them back, so load tests can
+run on the shape of the real traffic instead of a synthetic mix.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Optional
+
+from telegram import Message, Update
+from telegram.ext import Application
+
+from telegram_bot_tts.constants import BOT_USERNAME
+
+logger = logging.getLogger(__name__)
+
+# what routes an update has to survive the placeholder: a leading /command and the
+# bot mention that wakes the bot up in groups, in any case as admission accepts it
+KEPT_TEXT = re.compile(rf"^/\w+(@\w+)?|{re.escape(BOT_USERNAME)}|\s+", re.IGNORECASE)
+KEPT_ENTITIES = re.compile(rf"^/\w+(@\w+)?|{re.escape(BOT_USERNAME)}", re.IGNORECASE)
+
+
+def placeholder(text: str) -> str:
+    """
+    Replaces the text with x's of the same length, keeping the whitespace, a
+    leading command and the bot mention so the replayed update is routed the same
+    way and costs the same characters.
+    """
+    parts = []
+    cursor = 0
+    for match in KEPT_TEXT.finditer(text):
+        parts.append("x" * (match.start() - cursor))
+        parts.append(match.group())
+        cursor = match.end()
+    parts.append("x" * (len(text) - cursor))
+    return "".join(parts)
+
+
+class UpdateRecorder:
+    """
+    Appends every incoming message update to `path` as one compact json line of
+    `{"t": arrival time, "u": update}`.
+
+    Only what the handlers look at is kept. User and chat ids are replaced by a
+    keyed hash, stable within a recording so the per-user mix survives, file ids
+    likewise so repeated forwards of a voice note still match, and the text by a
+    placeholder of the same length. Names, usernames and captions are dropped.
+    """
+
+    def __init__(self, path: str, salt: Optional[str] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # a random salt unless a fixed one is given to join several recordings
+        self._salt = salt.encode() if salt else os.urandom(16)
+        # buffered, the write on the loop is a copy into memory most of the time
+        self._file = open(self.path, "a", encoding="utf-8")
+        self.recorded = 0
+
+    def _hash(self, value) -> int:
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], "big") % 2**31 + 1
+
+    def _anonymize_id(self, value: int) -> int:
+        # a private chat has the id of its user, group ids stay negative
+        return self._hash(abs(value)) * (-1 if value < 0 else 1)
+
+    def _anonymize_message(self, message: Message) -> dict:
+        data = {
+            "message_id": message.message_id,
+            "date": int(message.date.timestamp()),
+            "chat": {
+                "id": self._anonymize_id(message.chat.id),
+                "type": message.chat.type,
+            },
+        }
+        if message.from_user is not None:
+            user_id = self._anonymize_id(message.from_user.id)
+            data["from"] = {
+                "id": user_id,
+                "is_bot": message.from_user.is_bot,
+                "first_name": f"user {user_id}",
+            }
+        if message.forward_origin is not None:
+            data["forward_origin"] = {
+                "type": "hidden_user",
+                "sender_user_name": "forwarded",
+                "date": int(message.forward_origin.date.timestamp()),
+            }
+        if message.text is not None:
+            data["text"] = placeholder(message.text)
+            # admission needs the command and the bot mention, found again in the
+            # placeholder as telegram counts offsets in utf-16
+            types = {entity.type for entity in message.entities}
+            entities = [
+                {
+                    "type": "bot_command" if match.group()[0] == "/" else "mention",
+                    "offset": match.start(),
+                    "length": len(match.group()),
+                }
+                for match in KEPT_ENTITIES.finditer(data["text"])
+            ]
+            if entities := [e for e in entities if e["type"] in types]:
+                data["entities"] = entities
+        replied = message.reply_to_message
+        if replied is not None and replied.from_user is not None:
+            # only whether it replied to the bot, the bot's own user is no secret
+            sender = replied.from_user
+            data["reply_to_message"] = {
+                "message_id": replied.message_id,
+                "date": int(replied.date.timestamp()),
+                "chat": data["chat"],
+                "from": (
+                    sender.to_dict()
+                    if sender.is_bot
+                    else {"id": 1, "is_bot": False, "first_name": "user"}
+                ),
+            }
+        if message.voice is not None:
+            file_hash = self._hash(message.voice.file_unique_id)
+            data["voice"] = {
+                "file_id": f"voice-{file_hash}",
+                "file_unique_id": f"unique-{file_hash}",
+                "duration": message.voice.duration,
+                "file_size": message.voice.file_size,
+                "mime_type": message.voice.mime_type,
+            }
+            data["voice"] = {k: v for k, v in data["voice"].items() if v is not None}
+        return data
+
+    def record(self, update: object):
+        if not isinstance(update, Update) or update.message is None:
+            return
+        try:
+            entry = {
+                "t": round(time.time(), 3),
+                "u": {
+                    "update_id": update.update_id,
+                    "message": self._anonymize_message(update.message),
+                },
+            }
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self.recorded += 1
+        except Exception as e:
+            # recording must never get in the way of serving the update
+            logger.error(f"Failed to record update {update.update_id}: {e}")
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            logger.info(f"recorded {self.recorded} updates to {self.path}")
+
+
+def read_recording(path: str) -> list[tuple[float, dict]]:
+    # (arrival time, update data) pairs, a torn last line from a crash is skipped
+    records = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records.append((entry["t"], entry["u"]))
+    return records
+
+
+async def replay(
+    app: Application,
+    records: list[tuple[float, dict]],
+    speed: float = 1.0,
+    on_put=None,
+) -> int:
+    """
+    Puts the recorded updates on the application's update queue with the recorded
+    gaps between them divided by `speed`, or as fast as possible when `speed` is 0.
+    `on_put(update)` is called as each one is queued. Returns the number of updates.
+    """
+    if not records:
+        return 0
+
+    loop = asyncio.get_running_loop()
+    first = records[0][0]
+    start = loop.time()
+    for recorded_at, data in records:
+        if speed > 0:
+            # sleep to the recorded offset, so a slow put does not add up over a run
+            delay = start + (recorded_at - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(data, app.bot)
+        if on_put is not None:
+            on_put(update)
+        await app.update_queue.put(update)
+    return len(records)
@@ -0,0 +1,120 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class BotServer:
+    """
+    Local http server next to the bot, serving health and readiness endpoints, the
+    prometheus metrics and, in webhook mode, feeding Telegram's POSTed updates into
+    `application.update_queue`.
+    """
+
+    def __init__(
+        self,
+        application: Application,
+        host: str,
+        port: int,
+        webhook_path: str = None,
+        secret_token: str = None,
+    ):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.secret_token = secret_token
+        self._runner = None
+
+        self.web_app = web.Application()
+        self.web_app.router.add_get("/healthz", self.healthz)
+        self.web_app.router.add_get("/readyz", self.readyz)
+        self.web_app.router.add_get("/metrics", self.metrics)
+        if webhook_path is not None:
+            self.web_app.router.add_post(webhook_path, self.webhook)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving http on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        # the process is up and the event loop is answering
+        return web.json_response({"status": "ok"})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        # ready once the application has started processing updates
+        ready = self.application.running
+        return web.json_response({"ready": ready}, status=200 if ready else 503)
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=generate_latest(REGISTRY),
+            headers={"Content-Type": CONTENT_TYPE_LATEST},
+        )
+
+    async def webhook(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and not hmac.compare_digest(
+            request.headers.get(SECRET_TOKEN_HEADER, ""), self.secret_token
+        ):
+            logger.warning("Rejected webhook request with an invalid secret token")
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception as e:
+            logger.error(f"Error parsing webhook update: {str(e)}")
+            return web.Response(status=400)
+
+        await self.application.update_queue.put(update)
+        return web.Response(status=200)
+
+
+async def run_webhook(
+    application: Application,
+    webhook_url: str,
+    secret_token: str = None,
+):
+    """
+    Runs the application fed by the webhook route of the BotServer that post_init
+    starts, as run_polling would, until SIGINT or SIGTERM.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        logger.info(f"Webhook set to {webhook_url}")
+
+        await stop_event.wait()
+
+        await application.stop()
+        if application.post_stop is not None:
+            await application.post_stop(application)
+
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
@@ -0,0 +1,92 @@
+# test the admission filters in front of the message handlers
+import pytest
+from prometheus_client import REGISTRY
+from telegram import Update
+
+from telegram_bot_tts.components.admission import (
+    spoken_text,
+    text_admission,
+    voice_admission,
+)
+from telegram_bot_tts.fakes import make_text_update, make_voice_update
+
+
+def dropped(kind: str, stage: str) -> float:
+    labels = {"kind": kind, "stage": stage}
+    return REGISTRY.get_sample_value("admission_dropped_total", labels) or 0.0
+
+
+@pytest.mark.parametrize(
+    "text, chat_type, reply_to_bot, stage",
+    [
+        ("read this", "private", False, None),
+        ("@openaitts_bot read this", "group", False, None),
+        ("read this @OpenaiTTS_bot", "supergroup", False, None),
+        ("read this", "group", True, None),
+        ("read this", "group", False, "not_addressed"),
+        ("mail me at me@openaitts_bot.com", "group", False, "not_addressed"),
+        ("@someone_else read this", "group", False, "not_addressed"),
+        ("/unknown", "private", False, "command"),
+        ("/start@other_bot", "group", False, "command"),
+        ("@openaitts_bot  ", "group", False, "empty"),
+        ("x" * 5000, "private", False, "oversized"),
+        ("read this", "channel", False, "chat_type"),
+    ],
+)
+def test_text_admission(text, chat_type, reply_to_bot, stage):
+
+    update = Update.de_json(
+        make_text_update(1, 7, text, chat_type, reply_to_bot=reply_to_bot), None
+    )
+    before = {name: dropped("text", name) for name in (stage, "not_addressed")}
+
+    assert text_admission().check_update(update) == (stage is None)
+    if stage is not None:
+        # counted once, by the stage that dropped it
+        assert dropped("text", stage) == before[stage] + 1
+        if stage != "not_addressed":
+            assert dropped("text", "not_addressed") == before["not_addressed"]
+
+
+@pytest.mark.parametrize(
+    "text, chat_type, spoken",
+    [
+        ("@openaitts_bot read this", "group", "read this"),
+        ("read @OpenAITTS_bot this", "supergroup", "read  this"),
+        ("🎉 @OPENAITTS_BOT read this 🎉", "group", "🎉  read this 🎉"),
+        (
+            "write @openaitts_bot at me@openaitts_bot.com",
+            "group",
+            "write  at me@openaitts_bot.com",
+        ),
+        ("@openaitts_botany is a word", "group", "@openaitts_botany is a word"),
+        ("  @openaitts_bot read this ", "private", "@openaitts_bot read this"),
+    ],
+)
+def test_spoken_text_drops_the_mentions_of_the_bot(text, chat_type, spoken):
+
+    update = Update.de_json(make_text_update(1, 7, text, chat_type), None)
+    assert spoken_text(update.message) == spoken
+
+
+def test_edits_and_other_kinds_are_not_admitted():
+
+    data = make_text_update(1, 7, "read this")
+    data["edited_message"] = data.pop("message")
+    before = dropped("text", "update_type")
+    assert not text_admission().check_update(Update.de_json(data, None))
+    assert dropped("text", "update_type") == before + 1
+
+    # a voice note is not text, and is not counted as dropped by the text stages
+    voice = Update.de_json(make_voice_update(2, 7, 10), None)
+    assert not text_admission().check_update(voice)
+    assert voice_admission().check_update(voice)
+
+
+def test_voice_admission_drops_what_cant_be_downloaded():
+
+    data = make_voice_update(1, 7, 10)
+    data["message"]["voice"]["file_size"] = 21 * 1024 * 1024
+    before = dropped("voice", "oversized")
+    assert not voice_admission().check_update(Update.de_json(data, None))
+    assert dropped("voice", "oversized") == before + 1
@@ -0,0 +1,46 @@
+# test splitting long voice notes at silences
+from telegram_bot_tts.components.audio import (
+    parse_duration,
+    parse_silences,
+    plan_segments,
+)
+
+
+def test_parse_silences():
+
+    log = """
+[silencedetect @ 0x1] silence_start: -0.01
+[silencedetect @ 0x1] silence_end: 1.5 | silence_duration: 1.51
+[silencedetect @ 0x1] silence_start: 10
+[silencedetect @ 0x1] silence_end: 11 | silence_duration: 1
+[silencedetect @ 0x1] silence_start: 58.2
+"""
+    assert parse_silences(log) == [(0.0, 1.5), (10.0, 11.0)]
+
+
+def test_plan_segments_at_silences():
+
+    silences = [(9, 11), (18, 20), (29, 31)]
+    segments = plan_segments(silences, duration=40, max_seconds=15)
+
+    # the last silence that fits is used for every cut
+    assert segments == [(0, 10), (10, 19), (19, 30), (30, 40)]
+
+
+def test_plan_segments_without_silence():
+
+    assert plan_segments([], duration=50, max_seconds=20) == [
+        (0, 20),
+        (20, 40),
+        (40, 50),
+    ]
+    assert plan_segments([(5, 6)], duration=15, max_seconds=20) == [(0, 15)]
+
+
+def test_parse_duration():
+
+    log = (
+        "size=      15KiB time=00:00:08.39 bitrate=  14.2kbits/s speed=16.8x\r"
+        "size=      42KiB time=00:01:21.53 bitrate=  15.8kbits/s speed=15.4x\n"
+    )
+    assert parse_duration(log) == 81.53
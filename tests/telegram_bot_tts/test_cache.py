@@ -0,0 +1,157 @@
+# test the in-memory caches
+import asyncio
+import time
+
+import pytest
+
+from telegram_bot_tts.components.cache import TTLCache, AudioCache, TranscriptCache
+
+
+def test_ttl_cache_lru_eviction():
+
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, True)
+    cache.set(2, True)
+
+    # touching 1 makes 2 the least recently used entry
+    assert cache.get(1)
+    cache.set(3, False)
+
+    assert cache.get(2) is None
+    assert cache.get(3) is False
+    assert len(cache) == 2
+
+    # peeking counts nothing and leaves the order alone
+    assert cache.peek(1) and cache.peek(2) is None
+    cache.set(4, True)
+    assert cache.get(1) is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_ttl_cache_expiry():
+
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("short", True, ttl=0.01)
+    cache.set("long", True)
+    time.sleep(0.02)
+
+    assert cache.get("short") is None
+    assert cache.get("long")
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_audio_cache(tmp_path):
+
+    cache = AudioCache(tmp_path, max_bytes=20)
+    key = cache.key("good morning", "tts-1", "nova")
+
+    assert key != cache.key("good morning", "tts-1", "alloy")
+    assert cache.get(key) is None
+
+    cache.path(key).write_bytes(b"0" * 10)
+    cache.add(key)
+    cache.set_file_id(key, "file-id")
+
+    assert cache.get(key) == (cache.path(key), "file-id")
+    assert cache.stats()["bytes_saved"] == 10
+
+    # going over max_bytes evicts the least recently used audio from disk
+    other = cache.key("good night", "tts-1", "nova")
+    cache.path(other).write_bytes(b"0" * 15)
+    cache.add(other)
+
+    assert cache.get(key) is None
+    assert not cache.path(key).exists()
+    assert cache.stats()["bytes"] == 15
+
+
+def test_audio_cache_reloads_folder(tmp_path):
+
+    cache = AudioCache(tmp_path, max_bytes=100)
+    key = cache.key("hello", "tts-1", "nova")
+    cache.path(key).write_bytes(b"0" * 10)
+    cache.add(key)
+
+    assert AudioCache(tmp_path, max_bytes=100).get(key) == (cache.path(key), None)
+
+
+def test_audio_cache_stores_whole_files(tmp_path):
+
+    cache = AudioCache(tmp_path, max_bytes=100)
+    key = cache.key("hello", "tts-1", "nova")
+
+    temp = cache.temp_path()
+    temp.write_bytes(b"0" * 10)
+    cache.path(key).write_bytes(b"old")
+    with open(cache.path(key), "rb") as uploading:
+        cache.store(key, temp)
+        # a reader of the replaced file still sees all of it
+        assert uploading.read() == b"old"
+
+    assert cache.path(key).read_bytes() == b"0" * 10
+    assert cache.stats()["bytes"] == 10
+
+    # files left half written by a previous run are removed
+    cache.temp_path().write_bytes(b"0")
+    AudioCache(tmp_path, max_bytes=100)
+    assert not list(tmp_path.glob("*.part"))
+
+
+@pytest.mark.asyncio
+async def test_transcript_cache():
+
+    cache = TranscriptCache(maxsize=10, ttl=60)
+    calls = []
+
+    async def download():
+        return b"voice"
+
+    async def transcribe(audio):
+        calls.append(audio)
+        await asyncio.sleep(0.01)
+        return "hello"
+
+    # concurrent requests for the same file share one transcription
+    results = await asyncio.gather(
+        *(cache.get_or_transcribe("a", download, transcribe) for _ in range(3))
+    )
+    assert sorted(results) == [("hello", False), ("hello", False), ("hello", True)]
+    assert len(calls) == 1
+    assert cache.get("a") == "hello"
+
+    # the same audio under a new file id is matched on its hash
+    assert await cache.get_or_transcribe("b", download, transcribe) == (
+        "hello",
+        False,
+    )
+    assert len(calls) == 1
+    assert cache.stats()["shared"] == 2
+
+
+@pytest.mark.asyncio
+async def test_transcript_cache_outlives_a_cancelled_owner():
+
+    cache = TranscriptCache(maxsize=10, ttl=60)
+    started = asyncio.Event()
+    calls = []
+
+    async def download():
+        return b"voice"
+
+    async def transcribe(audio):
+        calls.append(audio)
+        started.set()
+        await asyncio.sleep(0 if len(calls) > 1 else 60)
+        return "hello"
+
+    owner = asyncio.create_task(cache.get_or_transcribe("a", download, transcribe))
+    await started.wait()
+    waiter = asyncio.create_task(cache.get_or_transcribe("a", download, transcribe))
+    await asyncio.sleep(0)
+
+    # the update that started the transcription goes away, the other one takes over
+    owner.cancel()
+    assert await waiter == ("hello", True)
+    assert owner.cancelled()
+    assert len(calls) == 2
+    assert cache.stats()["shared"] == 0
@@ -0,0 +1,81 @@
+# test the instrumented http pools and the warm-up
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from prometheus_client import REGISTRY
+from telegram import Bot
+
+from telegram_bot_tts import clients
+from telegram_bot_tts.clients import InstrumentedHTTPXRequest, warm_up
+from telegram_bot_tts.fakes import FakeTelegramServer
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest_asyncio.fixture
+async def telegram():
+    server = FakeTelegramServer(port=0)
+    await server.start()
+    server.port = server._runner.addresses[0][1]
+    yield server
+    await server.stop()
+
+
+def sample(name: str, client: str) -> float:
+    return REGISTRY.get_sample_value(name, {"client": client}) or 0.0
+
+
+@pytest.fixture
+def answers_clock(telegram, monkeypatch):
+    # the pool wait is measured in requests answered meanwhile instead of seconds
+    clock = SimpleNamespace(perf_counter=lambda: telegram.answered)
+    monkeypatch.setattr(clients, "time", clock)
+
+
+@pytest.mark.asyncio
+async def test_pool_wait_is_recorded(telegram, answers_clock):
+
+    request = InstrumentedHTTPXRequest("test_pool_wait", connection_pool_size=1)
+    bot = Bot("123:test", base_url=telegram.base_url, request=request)
+    await request.initialize()
+
+    # one connection, the second and third request queue behind the first
+    await asyncio.gather(*(bot.get_me() for _ in range(3)))
+    await request.shutdown()
+
+    # each waits for the answers to the ones before it
+    assert sample("http_pool_wait_seconds_count", "test_pool_wait") == 3
+    assert sample("http_pool_wait_seconds_sum", "test_pool_wait") == 0 + 1 + 2
+    assert sample("http_connections_opened_total", "test_pool_wait") == 1
+
+
+async def held(telegram, calls: int, requests):
+    # the server answers none of the requests until `calls` getMe came in
+    telegram.hold = asyncio.Event()
+    task = asyncio.ensure_future(requests)
+    async with asyncio.timeout(10):
+        while telegram.calls.get("getMe", 0) < calls:
+            await asyncio.sleep(0)
+    telegram.hold.set()
+    return await task
+
+
+@pytest.mark.asyncio
+async def test_warm_up_opens_connections(telegram, answers_clock):
+
+    request = InstrumentedHTTPXRequest("test_warm_up", connection_pool_size=8)
+    bot = Bot("123:test", base_url=telegram.base_url, request=request)
+    await request.initialize()
+
+    assert await held(telegram, 4, warm_up("telegram", bot.get_me, 4)) == 4
+    assert sample("http_connections_opened_total", "test_warm_up") == 4
+
+    # the next requests find an open connection each, none waits for an answer
+    await held(telegram, 8, asyncio.gather(*(bot.get_me() for _ in range(4))))
+    assert sample("http_connections_opened_total", "test_warm_up") == 4
+    assert sample("http_pool_wait_seconds_count", "test_warm_up") == 8
+    assert sample("http_pool_wait_seconds_sum", "test_warm_up") == 0
+    await request.shutdown()
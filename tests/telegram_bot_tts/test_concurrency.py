@@ -0,0 +1,220 @@
+# test concurrent update processing
+import asyncio
+import pytest
+from telegram import Update
+
+from telegram_bot_tts.components.concurrency import (
+    AdaptiveLimit,
+    ChatOrderedUpdateProcessor,
+    OverloadedError,
+    FairScheduler,
+    TokenBucket,
+)
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "hello",
+            },
+        },
+        None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_ordered_update_processor():
+
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2)
+    running = set()
+    max_running = 0
+    finished = []
+
+    async def handle(update: Update, delay: float):
+        nonlocal max_running
+        chat_id = update.effective_chat.id
+        assert chat_id not in running
+        running.add(chat_id)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(delay)
+        running.remove(chat_id)
+        finished.append(update.update_id)
+
+    # the slow first update of chat 1 must not let chat 1's second update overtake it
+    updates = [
+        (make_update(1, 1), 0.05),
+        (make_update(2, 1), 0),
+        (make_update(3, 2), 0),
+    ]
+    await asyncio.gather(
+        *(
+            processor.process_update(update, handle(update, delay))
+            for update, delay in updates
+        )
+    )
+
+    assert finished == [3, 1, 2]
+    assert max_running == 2
+    assert processor._chat_locks == {}
+
+
+def test_token_bucket():
+
+    bucket = TokenBucket(rate=10, capacity=100)
+
+    assert bucket.take(60, now=bucket.updated) == 0
+    # 40 left, 60 more need another 2 seconds of refill
+    assert bucket.take(60, now=bucket.updated) == pytest.approx(2)
+    assert bucket.take(60, now=bucket.updated + 2) == 0
+
+    # a request over the capacity passes on a full bucket and leaves it in debt
+    assert bucket.take(250, now=bucket.updated + 100) == 0
+    assert bucket.tokens == -150
+
+
+def test_fair_scheduler_vip_limits():
+
+    scheduler = FairScheduler(
+        1, {"tts": (60, 100)}, {"tts": (600, 1000)}, vip_user_ids=[2]
+    )
+
+    assert scheduler.admit(1, "tts", 100) == 0
+    assert scheduler.admit(1, "tts", 100) > 0
+    assert scheduler.admit(2, "tts", 500) == 0
+    assert scheduler.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler_round_robin():
+
+    scheduler = FairScheduler(1, {}, {}, vip_user_ids=[])
+    served = []
+
+    async def job(user_id: int):
+        async with scheduler.turn(user_id):
+            served.append(user_id)
+            await asyncio.sleep(0)
+
+    # user 1 queues a burst before users 2 and 3 show up
+    async with scheduler.turn(0):
+        tasks = [asyncio.create_task(job(1)) for _ in range(3)]
+        tasks += [asyncio.create_task(job(user_id)) for user_id in (2, 3)]
+        await asyncio.sleep(0)
+        assert scheduler.stats()["free"]["waiting"] == 5
+
+    await asyncio.gather(*tasks)
+    assert served == [1, 2, 3, 1, 1]
+    assert scheduler.stats()["free"]["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler_lanes():
+
+    scheduler = FairScheduler(2, {}, {}, vip_user_ids=[9], vip_reserved=1, free_share=3)
+    served = []
+
+    async def job(user_id: int):
+        async with scheduler.turn(user_id):
+            served.append(user_id)
+            await asyncio.sleep(0)
+
+    # the free lane can't take the reserved slot
+    async with scheduler.turn(1):
+        free = [asyncio.create_task(job(user_id)) for user_id in (2, 3, 4)]
+        await asyncio.sleep(0)
+        assert scheduler.stats()["free"]["waiting"] == 3
+
+        async with scheduler.turn(9):
+            # the vip lane jumps the queue, every third slot still goes to the free lane
+            vip = [asyncio.create_task(job(9)) for _ in range(4)]
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*free, *vip)
+    assert served == [9, 9, 2, 9, 9, 3, 4]
+    assert scheduler.stats()["vip"]["served"] == 5
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limit():
+
+    limit = AdaptiveLimit("test", initial=2, max_limit=4, max_wait=1.0)
+
+    # queued calls run in order as the slots free up
+    await limit.acquire()
+    await limit.acquire()
+    order = []
+
+    async def queued(i):
+        await limit.acquire()
+        order.append(i)
+
+    tasks = [asyncio.create_task(queued(i)) for i in range(2)]
+    await asyncio.sleep(0)
+    assert limit.stats()["waiting"] == 2
+    limit.release()
+    limit.release()
+    await asyncio.gather(*tasks)
+    assert order == [0, 1]
+
+    # a waiter cancelled and passed over by a release before it ran again
+    cancelled = asyncio.create_task(limit.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    limit.release()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert limit.stats()["waiting"] == 0 and limit.in_flight == 1
+    await limit.acquire()
+
+    # fast calls while the limit is in use raise it about one per round trip
+    for _ in range(5):
+        limit.record(0.1)
+    assert 2 < limit.limit <= 4
+
+    # an overload cuts it once, the calls in flight with it don't cut it again
+    before = limit.limit
+    limit.record_overload(now=100)
+    limit.record_overload(now=100.05)
+    assert limit.limit == pytest.approx(before * 0.7)
+    limit.record_overload(now=101)
+    assert limit.limit == pytest.approx(before * 0.49)
+
+    # a call much slower than the fastest of its size is an overload too
+    limit._decreased_at = float("-inf")
+    before = limit.limit
+    limit.record(1.0)
+    assert limit.limit == pytest.approx(max(1, before * 0.7))
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limit_sheds():
+
+    limit = AdaptiveLimit("shed", initial=1, max_wait=1.0)
+    await limit.acquire()
+    limit.latency = 0.5
+
+    # one call ahead at 0.5s a call, waiting is fine
+    waiter = asyncio.create_task(limit.acquire())
+    await asyncio.sleep(0)
+    # two ahead, still 1s
+    assert limit.estimated_wait() == pytest.approx(1.0)
+    second = asyncio.create_task(limit.acquire())
+    await asyncio.sleep(0)
+
+    # three ahead is more than the max wait
+    with pytest.raises(OverloadedError):
+        await limit.acquire()
+    assert limit.shed == 1
+
+    for task in (waiter, second):
+        task.cancel()
+    await asyncio.gather(waiter, second, return_exceptions=True)
+    assert limit.stats()["waiting"] == 0
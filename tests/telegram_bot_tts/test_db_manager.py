@@ -0,0 +1,306 @@
+# test DBManager against a throwaway sqlite database
+from datetime import datetime
+import pytest
+import pytest_asyncio
+from prometheus_client import REGISTRY
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from telegram_bot_tts.db.db_manager import (
+    Base,
+    DBManager,
+    MonthlySpend,
+    SpeechToTextActivity,
+    TextToSpeechActivity,
+    to_async_url,
+)
+from telegram_bot_tts.db.activity_buffer import ActivityBuffer
+from telegram_bot_tts.db.migrations import LATEST_VERSION, current_version, upgrade
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest_asyncio.fixture
+async def db_manager(tmp_path):
+    db_manager = DBManager(f"sqlite:///{tmp_path / 'test.db'}", write_behind=False)
+    await upgrade(db_manager.engine)
+    yield db_manager
+    await db_manager.close()
+
+
+def test_to_async_url():
+
+    url = to_async_url("cockroachdb://root@localhost:26257/defaultdb?sslmode=disable")
+
+    assert url.drivername == "cockroachdb+psycopg"
+    assert url.query["sslmode"] == "disable"
+
+
+@pytest.mark.asyncio
+async def test_register_user(db_manager):
+
+    assert not await db_manager.is_user_registered(1)
+    assert await db_manager.register_user(1, "first", "last", "username")
+    assert await db_manager.is_user_registered(1)
+
+    # registering twice fails on the primary key
+    assert not await db_manager.register_user(1, "first", "last", "username")
+
+
+@pytest.mark.asyncio
+async def test_add_activities(db_manager):
+
+    await db_manager.register_user(1, "first", "last", "username")
+
+    assert await db_manager.add_text_to_speech_activity(1, 100, datetime.now())
+    assert await db_manager.add_speech_to_text_activity(1, 60, datetime.now())
+
+
+@pytest.mark.asyncio
+async def test_is_user_registered_cache(db_manager):
+
+    # the unknown user is cached as a negative entry
+    assert not await db_manager.is_user_registered(2)
+    assert not await db_manager.is_user_registered(2)
+    assert db_manager.user_cache.hits == 1
+
+    # registering overwrites the negative entry
+    await db_manager.register_user(2, "first", "last", "username")
+    assert await db_manager.is_user_registered(2)
+    assert db_manager.user_cache.stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_db_latency_times_only_queries(db_manager):
+
+    def timed_calls(method):
+        return (
+            REGISTRY.get_sample_value("db_method_seconds_count", {"method": method})
+            or 0
+        )
+
+    before = {
+        method: timed_calls(method)
+        for method in ("is_user_registered", "check_user_eligibility")
+    }
+
+    # a miss, then two cache hits and a check against the ledger
+    for _ in range(3):
+        await db_manager.is_user_registered(1)
+    await db_manager.check_user_eligibility(1)
+
+    assert timed_calls("is_user_registered") == before["is_user_registered"] + 1
+    assert timed_calls("check_user_eligibility") == before["check_user_eligibility"]
+
+
+@pytest.mark.asyncio
+async def test_monthly_spend_ledger(db_manager):
+
+    await db_manager.register_user(1, "first", "last", "username")
+    await db_manager.add_speech_to_text_activity(1, 60, datetime.now())
+
+    # a fresh manager loads the pre-aggregated total
+    await db_manager.load_monthly_spend()
+    assert db_manager.spend_ledger.total == pytest.approx(0.006)
+    assert await db_manager.check_user_eligibility(1)
+
+    # 200k characters cost $3, going over the shared quota
+    await db_manager.add_text_to_speech_activity(1, 200000, datetime.now())
+    assert db_manager.spend_ledger.total == pytest.approx(3.006)
+    assert not await db_manager.check_user_eligibility(1)
+
+    db_manager.spend_ledger.set(None, 0.0)
+    await db_manager.load_monthly_spend()
+    assert db_manager.spend_ledger.total == pytest.approx(3.006)
+
+
+@pytest.mark.asyncio
+async def test_get_balance(db_manager):
+
+    await db_manager.register_user(1, "first", "last", "username")
+    await db_manager.register_user(2, "first", "last", "username")
+    await db_manager.add_text_to_speech_activity(1, 1000, datetime.now())
+    await db_manager.add_speech_to_text_activity(2, 600, datetime.now())
+
+    # activities from last month don't count
+    await db_manager.add_text_to_speech_activity(1, 1000, datetime(2020, 1, 31))
+
+    balance = await db_manager.get_balance(1)
+    assert balance["user"] == pytest.approx(0.015)
+    assert balance["total"] == pytest.approx(0.075)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_activities(tmp_path):
+
+    db_manager = DBManager(f"sqlite:///{tmp_path / 'test.db'}", write_behind=True)
+    await upgrade(db_manager.engine)
+    await db_manager.register_user(1, "first", "last", "username")
+
+    for _ in range(250):
+        assert await db_manager.add_text_to_speech_activity(1, 1000, datetime.now())
+
+    # the ledger counts the buffered spend right away
+    assert db_manager.spend_ledger.total == pytest.approx(250 * 0.015)
+
+    # closing drains the buffer
+    buffer = db_manager.activity_buffer
+    await db_manager.close()
+    assert buffer.stats() == {"pending": 0, "written": 250, "dropped": 0}
+
+    async with db_manager.Session() as session:
+        rows = await session.scalar(
+            select(func.count(TextToSpeechActivity.activity_id))
+        )
+        spend = await session.scalar(select(MonthlySpend.cost))
+    await db_manager.engine.dispose()
+
+    assert rows == 250
+    assert spend == pytest.approx(250 * 0.015)
+
+
+@pytest.mark.asyncio
+async def test_activity_buffer_retries_and_overflow():
+
+    attempts = []
+
+    async def flaky_write(rows):
+        attempts.append(len(rows))
+        if len(attempts) == 1:
+            raise OperationalError("INSERT", {}, Exception("restart transaction"))
+
+    buffer = ActivityBuffer(
+        flaky_write, max_batch=10, flush_interval=0.01, max_pending=2, put_timeout=0
+    )
+
+    assert await buffer.put(TextToSpeechActivity, {})
+    assert await buffer.put(TextToSpeechActivity, {})
+    # the queue is full and the flusher hasn't run yet, the third row is dropped
+    assert not await buffer.put(TextToSpeechActivity, {})
+
+    await buffer.drain()
+    assert attempts == [2, 2]
+    assert buffer.stats() == {"pending": 0, "written": 2, "dropped": 1}
+
+
+@pytest.mark.asyncio
+async def test_activity_buffer_drops_only_bad_rows(caplog):
+
+    attempts = []
+
+    async def write(rows):
+        attempts.append(len(rows))
+        if any(row.get("bad") for _, row in rows):
+            raise IntegrityError("INSERT", {}, Exception("NOT NULL constraint failed"))
+
+    buffer = ActivityBuffer(write, max_batch=8, flush_interval=60)
+    for i in range(8):
+        await buffer.put(TextToSpeechActivity, {"i": i, "bad": i == 5})
+    await buffer.drain()
+
+    # not retried, halved down to the bad row
+    assert attempts == [8, 4, 4, 2, 1, 1, 2]
+    assert buffer.stats() == {"pending": 0, "written": 7, "dropped": 1}
+    assert "{'i': 5, 'bad': True}" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_activity_buffer_retries_connection_errors():
+
+    attempts = []
+
+    async def write(rows):
+        attempts.append(len(rows))
+        if len(attempts) <= 2:
+            raise OperationalError("INSERT", {}, Exception("connection refused"))
+
+    buffer = ActivityBuffer(write, max_batch=8, flush_interval=60)
+    for i in range(8):
+        await buffer.put(TextToSpeechActivity, {"i": i})
+    await buffer.drain()
+
+    # a lost connection says nothing about the rows, the whole batch is retried
+    assert attempts == [8, 8, 8]
+    assert buffer.stats() == {"pending": 0, "written": 8, "dropped": 0}
+
+
+@pytest.mark.asyncio
+async def test_transcripts(db_manager):
+
+    assert await db_manager.get_transcript(file_unique_id="a") is None
+    assert await db_manager.save_transcript("a", "hash", "hello")
+
+    assert await db_manager.get_transcript(file_unique_id="a") == "hello"
+    assert await db_manager.get_transcript(content_hash="hash") == "hello"
+
+
+@pytest.mark.asyncio
+async def test_trimmed_stt_activity(tmp_path):
+
+    db_manager = DBManager(f"sqlite:///{tmp_path / 'test.db'}", write_behind=False)
+
+    # a table created before original_seconds existed gets the column added
+    async with db_manager.engine.begin() as conn:
+        await conn.execute(
+            text(
+                "CREATE TABLE speech_to_text_activity (activity_id INTEGER PRIMARY KEY,"
+                " user_id INTEGER, used_seconds INTEGER NOT NULL, cost FLOAT NOT NULL,"
+                " timestamp DATETIME)"
+            )
+        )
+    await upgrade(db_manager.engine)
+
+    await db_manager.register_user(1, "first", "last", "username")
+    await db_manager.add_speech_to_text_activity(
+        1, 40, datetime.now(), original_seconds=60
+    )
+    await db_manager.add_speech_to_text_activity(1, 30, datetime.now())
+
+    async with db_manager.Session() as session:
+        rows = await session.execute(
+            select(
+                SpeechToTextActivity.used_seconds, SpeechToTextActivity.original_seconds
+            ).order_by(SpeechToTextActivity.activity_id)
+        )
+        assert rows.all() == [(40, 60), (30, 30)]
+
+    await db_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_migrations(tmp_path):
+
+    db_manager = DBManager(f"sqlite:///{tmp_path / 'test.db'}", write_behind=False)
+    assert await current_version(db_manager.engine) == 0
+
+    assert await upgrade(db_manager.engine, target=1) == [1]
+    assert await upgrade(db_manager.engine) == list(range(2, LATEST_VERSION + 1))
+    # applied migrations are not run again
+    assert await upgrade(db_manager.engine) == []
+    assert await current_version(db_manager.engine) == LATEST_VERSION
+
+    # the migrations, which don't read the models, end on the schema of the models
+    def schema(conn):
+        inspector = inspect(conn)
+        return {
+            table: (
+                {column["name"] for column in inspector.get_columns(table)},
+                {index["name"] for index in inspector.get_indexes(table)},
+            )
+            for table in Base.metadata.tables
+        }
+
+    async with db_manager.engine.connect() as conn:
+        migrated = await conn.run_sync(schema)
+    assert migrated == {
+        table.name: (
+            {column.name for column in table.columns},
+            {index.name for index in table.indexes},
+        )
+        for table in Base.metadata.sorted_tables
+    }
+
+    assert await db_manager.register_user(1, "first", "last", "username")
+    await db_manager.close()
@@ -1,31 +1,56 @@
-# test stt_response
-from openai import AsyncOpenAI
+# test the handlers against the fake OpenAI and Telegram backends
+import asyncio
+import logging
 import os
 import pytest
+import pytest_asyncio
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
 
-from telegram_bot_tts.components.handlers import stt_response, tts_response
+from telegram_bot_tts.components import handlers
+from telegram_bot_tts.components.admission import text_admission, voice_admission
+from telegram_bot_tts.components.cache import AudioCache, TranscriptCache
+from telegram_bot_tts.components.concurrency import AdaptiveLimit
+from telegram_bot_tts.components.handlers import (
+    BUSY_MESSAGE,
+    SERVICE_UNAVAILABLE_MESSAGE,
+    handle_text_message,
+    handle_voice_message,
+    stt_response,
+    tts_response,
+)
+from telegram_bot_tts.components.resilience import (
+    ApiGuard,
+    ApiGuards,
+    CircuitBreaker,
+)
+from telegram_bot_tts.fakes import (
+    FakeDBManager,
+    FakeOpenAI,
+    FakeTelegramServer,
+    make_text_update,
+    make_voice_update,
+)
 
 
 pytest_plugins = ("pytest_asyncio",)
 
-
-audio_path = "tests/src/telegram_bot_tts/test_audio.wav"
+logger = logging.getLogger(__name__)
 
 
 @pytest.mark.asyncio
-async def test_tts_response():
+async def test_tts_response(tmp_path):
 
     text = "Hello, how are you?"
+    audio_path = tmp_path / "tts_test_audio.ogg"
 
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    audio_path = os.path.join(current_dir, "audio", "tts_test_audio.wav")
-
-    client = AsyncOpenAI()
+    client = FakeOpenAI(tts_latency=0, audio_bytes=1024)
 
-    response = await tts_response(text, client, audio_path)
+    response = await tts_response(text, client, logger, audio_path)
 
     assert os.path.exists(response)
     assert os.path.samefile(response, audio_path)
+    assert os.path.getsize(response) == 1024
 
 
 @pytest.mark.asyncio
@@ -34,7 +59,281 @@ async def test_stt_response():
     current_dir = os.path.dirname(os.path.abspath(__file__))
     audio_path = os.path.join(current_dir, "audio", "test_audio.wav")
 
-    client = AsyncOpenAI()
+    client = FakeOpenAI(stt_latency=0, transcript="Hello, how are you?")
 
-    response = await stt_response(audio_path, client)
+    response = await stt_response(audio_path, client, logger)
     assert response == "Hello, how are you?"
+
+
+@pytest.mark.asyncio
+async def test_fake_openai_errors():
+
+    client = FakeOpenAI(tts_latency=0, error_rate=1, seed=0)
+
+    with pytest.raises(Exception, match="fake server error"):
+        await tts_response("hello", client, logger)
+    assert client.errors == 1
+
+
+@pytest_asyncio.fixture
+async def telegram():
+    server = FakeTelegramServer(port=0)
+    await server.start()
+    # the os picked the port, read it back for the urls
+    server.port = server._runner.addresses[0][1]
+    yield server
+    await server.stop()
+
+
+@pytest.mark.asyncio
+async def test_handlers_end_to_end(telegram):
+
+    client = FakeOpenAI(tts_latency=0, stt_latency=0)
+    db_manager = FakeDBManager()
+
+    app = (
+        Application.builder()
+        .token("123:test")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            text_admission(),
+            lambda update, context: handle_text_message(
+                update, context, logger, client, db_manager
+            ),
+        )
+    )
+    app.add_handler(
+        MessageHandler(
+            voice_admission(),
+            lambda update, context: handle_voice_message(
+                update, context, logger, client, db_manager
+            ),
+        )
+    )
+
+    async with app:
+        for data in (
+            make_text_update(1, 7, "good morning"),
+            make_voice_update(2, 7, 5),
+            make_text_update(3, 7, "@openaitts_bot   hi", chat_type="group"),
+        ):
+            await app.process_update(Update.de_json(data, app.bot))
+
+    methods = [method for method, _ in telegram.sent]
+    assert methods == ["sendVoice", "sendMessage", "sendVoice"]
+    assert telegram.sent[1][1]["text"] == "hello, how are you?"
+    assert telegram.calls["download"] == 1
+    assert [activity[0] for activity in db_manager.activities] == ["tts", "stt", "tts"]
+    # the mention isn't spoken, so it isn't billed either
+    assert db_manager.activities[2][2] == len("hi")
+
+
+@pytest.mark.asyncio
+async def test_forwarded_voice_note_reuses_the_transcript(telegram):
+
+    client = FakeOpenAI(tts_latency=0, stt_latency=0)
+    db_manager = FakeDBManager()
+    transcript_cache = TranscriptCache(maxsize=10, ttl=60)
+
+    app = (
+        Application.builder()
+        .token("123:test")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            voice_admission(),
+            lambda update, context: handle_voice_message(
+                update,
+                context,
+                logger,
+                client,
+                db_manager,
+                transcript_cache=transcript_cache,
+            ),
+        )
+    )
+
+    # the same note, forwarded
+    updates = [make_voice_update(1, 7, 5), make_voice_update(2, 7, 5)]
+    updates[1]["message"]["voice"]["file_unique_id"] = "unique-1"
+    async with app:
+        for data in updates:
+            await app.process_update(Update.de_json(data, app.bot))
+
+    assert telegram.calls["download"] == 1
+    assert [activity[0] for activity in db_manager.activities] == ["stt"]
+    # one lookup each
+    stats = transcript_cache.stats()
+    assert (stats["file_misses"], stats["file_hits"]) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_long_voice_note_is_split_before_trimming(telegram, monkeypatch):
+
+    steps = []
+
+    async def split_on_silence(audio, duration, max_seconds):
+        steps.append("split")
+        return [(b"a", 60.0), (b"b", 60.0), (b"c", 60.0)]
+
+    async def trim_silence(audio):
+        steps.append(f"trim {audio.decode()}")
+        return audio, 40.0
+
+    # ffmpeg is faked, the order of the passes is what matters
+    monkeypatch.setattr(handlers, "ffmpeg_available", lambda: True)
+    monkeypatch.setattr(handlers, "STT_TRIM_SILENCE", True)
+    monkeypatch.setattr(handlers, "split_on_silence", split_on_silence)
+    monkeypatch.setattr(handlers, "trim_silence", trim_silence)
+    client = FakeOpenAI(stt_latency=0)
+    db_manager = FakeDBManager()
+
+    app = (
+        Application.builder()
+        .token("123:test")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            voice_admission(),
+            lambda update, context: handle_voice_message(
+                update, context, logger, client, db_manager
+            ),
+        )
+    )
+
+    async with app:
+        await app.process_update(Update.de_json(make_voice_update(1, 7, 180), app.bot))
+
+    # no pass over the whole note before the split, each segment trims on its own
+    assert steps == ["split", "trim a", "trim b", "trim c"]
+    assert client.calls["stt"] == 3
+    # billed for the trimmed segments
+    assert db_manager.activities[0][2] == 120
+
+
+def text_app(telegram, client, audio_cache=None) -> Application:
+    app = (
+        Application.builder()
+        .token("123:test")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            text_admission(),
+            lambda update, context: handle_text_message(
+                update, context, logger, client, FakeDBManager(), audio_cache
+            ),
+        )
+    )
+    return app
+
+
+@pytest.mark.asyncio
+async def test_tts_file_cache_under_concurrent_requests(
+    telegram, tmp_path, monkeypatch
+):
+
+    monkeypatch.setattr(handlers, "TTS_STREAMING", False)
+    client = FakeOpenAI(tts_latency=0.05, audio_bytes=4096)
+    audio_cache = AudioCache(tmp_path, 2**20, "ogg")
+    app = text_app(telegram, client, audio_cache)
+
+    async with app:
+        # the same text twice at once, neither upload sees the other's file
+        await asyncio.gather(
+            *(
+                app.process_update(
+                    Update.de_json(make_text_update(i, i, "hi"), app.bot)
+                )
+                for i in (1, 2)
+            )
+        )
+        assert [size for _, _, size in telegram.uploads] == [4096, 4096]
+        assert [path.stat().st_size for path in tmp_path.iterdir()] == [4096]
+
+        # a cached file evicted before it could be uploaded is synthesized again
+        audio_cache = AudioCache(tmp_path, 2**20, "ogg")
+        app.handlers[0][0].callback = lambda update, context: handle_text_message(
+            update, context, logger, client, FakeDBManager(), audio_cache
+        )
+        for path in tmp_path.iterdir():
+            path.unlink()
+        await app.process_update(Update.de_json(make_text_update(3, 3, "hi"), app.bot))
+
+    assert client.calls["tts"] == 3
+    assert telegram.uploads[-1][2] == 4096
+    assert not list(tmp_path.glob("*.part"))
+
+
+@pytest.mark.parametrize("audio_bytes", [4096, 2 * 2**20])
+@pytest.mark.asyncio
+async def test_tts_streaming_reply(telegram, tmp_path, monkeypatch, audio_bytes):
+
+    # synthesized in memory, and spilled to disk past TTS_SPOOL_MAX_BYTES
+    monkeypatch.setattr(handlers, "TTS_STREAMING", True)
+    client = FakeOpenAI(tts_latency=0, audio_bytes=audio_bytes)
+    audio_cache = AudioCache(tmp_path, 2**30, "ogg")
+    app = text_app(telegram, client, audio_cache)
+
+    async with app:
+        await app.process_update(Update.de_json(make_text_update(1, 1, "hi"), app.bot))
+
+    assert telegram.uploads == [("sendVoice", "voice.ogg", audio_bytes)]
+    key = audio_cache.key("hi", handlers.TTS_MODEL, handlers.TTS_VOICE)
+    assert audio_cache.path(key).stat().st_size == audio_bytes
+    assert audio_cache.get(key)[1] == "sent-sendVoice"
+
+
+@pytest.mark.parametrize("cause", ["circuit", "busy"])
+@pytest.mark.asyncio
+async def test_unavailable_api_replies_right_away(telegram, cause):
+
+    client = FakeOpenAI(tts_latency=0)
+    breaker = CircuitBreaker("tts", failure_threshold=1, reset_timeout=60)
+    limiter = AdaptiveLimit("tts", initial=1, max_wait=1)
+    if cause == "circuit":
+        breaker.record_failure()
+    else:
+        # a call in flight that takes longer than the max wait
+        limiter.in_flight, limiter.latency = 1, 5.0
+    guards = ApiGuards(
+        ApiGuard("tts", 5, breaker=breaker, limiter=limiter), ApiGuard("stt", 5)
+    )
+
+    app = (
+        Application.builder()
+        .token("123:test")
+        .base_url(telegram.base_url)
+        .base_file_url(telegram.base_file_url)
+        .build()
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.TEXT,
+            lambda update, context: handle_text_message(
+                update, context, logger, client, FakeDBManager(), guards=guards
+            ),
+        )
+    )
+
+    async with app:
+        update = Update.de_json(make_text_update(1, 7, "good morning"), app.bot)
+        await app.process_update(update)
+
+    assert telegram.sent == [("sendMessage", telegram.sent[0][1])]
+    assert telegram.sent[0][1]["text"] == (
+        SERVICE_UNAVAILABLE_MESSAGE if cause == "circuit" else BUSY_MESSAGE
+    )
+    assert client.calls["tts"] == 0
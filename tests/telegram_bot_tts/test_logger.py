@@ -0,0 +1,58 @@
+# test the queue based, structured logging
+import json
+import logging
+import queue
+
+from telegram_bot_tts.logger import (
+    CorrelationFilter,
+    JsonFormatter,
+    LazyQueueHandler,
+    correlation_id,
+)
+
+
+def make_record(level: int = logging.DEBUG) -> logging.LogRecord:
+    return logging.LogRecord("test", level, __file__, 1, "user %s: %s", (1, "hi"), None)
+
+
+def test_json_output_with_correlation_id():
+
+    token = correlation_id.set(42)
+    try:
+        record = make_record(logging.INFO)
+        assert CorrelationFilter().filter(record)
+    finally:
+        correlation_id.reset(token)
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "user 1: hi"
+    assert entry["correlation_id"] == 42
+    assert entry["level"] == "INFO"
+
+
+def test_debug_sampling_keeps_whole_updates():
+
+    sampler = CorrelationFilter(debug_sample_rate=0.5)
+    kept = []
+    for update_id in range(1000):
+        token = correlation_id.set(update_id)
+        try:
+            first, second = sampler.filter(make_record()), sampler.filter(make_record())
+        finally:
+            correlation_id.reset(token)
+        assert first == second
+        kept.append(first)
+
+    assert 400 < sum(kept) < 600
+    # warnings and above are never sampled out
+    assert all(sampler.filter(make_record(logging.WARNING)) for _ in range(100))
+
+
+def test_queue_handler_leaves_formatting_to_the_listener():
+
+    log_queue = queue.SimpleQueue()
+    LazyQueueHandler(log_queue).handle(make_record())
+
+    record = log_queue.get_nowait()
+    assert record.msg == "user %s: %s"
+    assert record.getMessage() == "user 1: hi"
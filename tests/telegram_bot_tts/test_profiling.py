@@ -0,0 +1,90 @@
+# test the event loop monitor and the sampling profiler
+import asyncio
+import threading
+
+import pytest
+
+from telegram_bot_tts import profiling
+from telegram_bot_tts.profiling import LoopLagMonitor, SamplingProfiler, top_functions
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def blocking_call(entered: threading.Event, release: threading.Event):
+    entered.set()
+    release.wait()
+
+
+def test_loop_lag_monitor_reports_the_blocking_stack(caplog):
+
+    monitor = LoopLagMonitor(interval=1, threshold=2)
+
+    # a thread held in blocking_call stands in for the blocked loop thread
+    entered, release = threading.Event(), threading.Event()
+    blocked = threading.Thread(target=blocking_call, args=(entered, release))
+    blocked.start()
+    entered.wait()
+    monitor._loop_thread_id = blocked.ident
+
+    # the watchdog checks at these times, the last heartbeat was at 100
+    monitor._beat = 100.0
+    assert not monitor.check(102.5)
+    assert monitor.check(103.5)
+    # one report a stall, then a new one after the next heartbeat
+    assert not monitor.check(104.5)
+    monitor._beat = 110.0
+    assert monitor.check(113.5)
+
+    release.set()
+    blocked.join()
+    assert monitor.stalls == 2
+    assert "blocking_call" in caplog.text
+
+
+class SamplerClock:
+    """
+    Time for the sampler thread, advanced by its sleeps. It starts sampling once
+    the loop thread is in blocking_call and lets that go after `hold` samples.
+    """
+
+    def __init__(self, hold: int):
+        self.now = 0.0
+        self.hold = hold
+        self.samples = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.entered.wait()
+        self.now += seconds
+        self.samples += 1
+        if self.samples == self.hold:
+            self.release.set()
+
+
+@pytest.mark.asyncio
+async def test_sampling_profiler(tmp_path, monkeypatch):
+
+    clock = SamplerClock(hold=3)
+    monkeypatch.setattr(profiling, "time", clock)
+    profiler = SamplingProfiler(tmp_path, sample_interval=0.001)
+
+    async def busy():
+        await asyncio.sleep(0)
+        blocking_call(clock.entered, clock.release)
+
+    task = asyncio.create_task(busy())
+    # ten samples by the sampler's clock
+    path, stacks = await profiler.profile(0.01)
+    await task
+
+    assert sum(stacks.values()) == 10
+    assert path.read_text().count("\n") == len(stacks)
+    # the samples taken while the loop was held
+    blocked = sum(n for stack, n in stacks.items() if "blocking_call" in stack)
+    assert blocked >= 2
+    assert sum(share for _, share in top_functions(stacks)) == pytest.approx(1)
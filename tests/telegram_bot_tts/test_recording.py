@@ -0,0 +1,128 @@
+# test the anonymized update recorder and the replayer
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+from telegram_bot_tts.components.admission import text_admission
+from telegram_bot_tts.fakes import make_text_update, make_voice_update
+from telegram_bot_tts.recording import (
+    UpdateRecorder,
+    placeholder,
+    read_recording,
+    replay,
+)
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def test_placeholder_keeps_length_mention_and_command():
+
+    text = "@openaitts_bot  read this, please!\nthanks"
+    hidden = placeholder(text)
+    assert len(hidden) == len(text)
+    assert hidden == "@openaitts_bot  xxxx xxxxx xxxxxxx\nxxxxxx"
+
+    assert placeholder("/start@openaitts_bot now") == "/start@openaitts_bot xxx"
+    assert placeholder("@OpenAITTS_bot hi") == "@OpenAITTS_bot xx"
+    assert placeholder("") == ""
+
+
+def test_recorder_anonymizes_updates(tmp_path):
+
+    path = tmp_path / "updates.jsonl"
+    recorder = UpdateRecorder(path, salt="test")
+    text = make_text_update(1, 12345, "@openaitts_bot secret words", "group")
+    voice = make_voice_update(2, 12345, 42)
+    forward = make_voice_update(3, 777, 42)
+    forward["message"]["voice"] = voice["message"]["voice"]
+
+    for data in (text, voice, forward):
+        recorder.record(Update.de_json(data, None))
+    recorder.record(object())
+    recorder.close()
+
+    raw = path.read_text()
+    assert "secret" not in raw and "12345" not in raw and "user 12345" not in raw
+    records = read_recording(path)
+    assert len(records) == 3
+
+    text_message = records[0][1]["message"]
+    voice_message = records[1][1]["message"]
+    assert text_message["text"] == "@openaitts_bot xxxxxx xxxxx"
+    assert text_message["chat"]["id"] < 0
+    # the same user keeps the same id, a private chat the id of its user
+    assert text_message["from"]["id"] == voice_message["from"]["id"]
+    assert voice_message["chat"]["id"] == voice_message["from"]["id"]
+    assert voice_message["voice"]["duration"] == 42
+    # a forward of the same note still has the same file
+    assert records[2][1]["message"]["voice"] == voice_message["voice"]
+
+    # and the records parse back into updates
+    update = Update.de_json(records[1][1], None)
+    assert update.message.voice.duration == 42
+
+    # admitted the same way, the mention of the bot is kept as an entity
+    update = Update.de_json(records[0][1], None)
+    assert text_admission().check_update(update)
+
+
+def test_recorder_keeps_a_mixed_case_mention(tmp_path):
+
+    path = tmp_path / "updates.jsonl"
+    recorder = UpdateRecorder(path, salt="test")
+    recorder.record(
+        Update.de_json(make_text_update(1, 1, "@OpenAITTS_bot hi", "group"), None)
+    )
+    recorder.close()
+
+    message = read_recording(path)[0][1]["message"]
+    assert message["text"] == "@OpenAITTS_bot xx"
+    assert message["entities"] == [{"type": "mention", "offset": 0, "length": 14}]
+    assert text_admission().check_update(
+        Update.de_json({"update_id": 1, "message": message}, None)
+    )
+
+
+def test_read_recording_skips_a_torn_line(tmp_path):
+
+    path = tmp_path / "updates.jsonl"
+    recorder = UpdateRecorder(path)
+    recorder.record(Update.de_json(make_text_update(1, 1, "hi"), None))
+    recorder.close()
+    with open(path, "a") as file:
+        file.write('{"t": 1, "u": {"upd')
+
+    assert len(read_recording(path)) == 1
+
+
+@pytest.mark.asyncio
+async def test_replay_keeps_the_recorded_pace():
+
+    app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    records = [
+        (100.0 + offset, make_text_update(i, 1, "hi"))
+        for i, offset in enumerate((0, 0.1, 0.2))
+    ]
+
+    # each update is put no earlier than its recorded offset at twice the speed
+    loop = asyncio.get_running_loop()
+    put_at = []
+
+    def on_put(update):
+        put_at.append(loop.time() - start)
+
+    start = loop.time()
+    assert await replay(app, records, speed=2, on_put=on_put) == 3
+    assert all(at >= offset / 2 for at, offset in zip(put_at, (0, 0.1, 0.2)))
+    assert app.update_queue.qsize() == 3
+
+    # at max speed there are no gaps, replay never gives the loop a turn
+    seen, turns = [], []
+    loop.call_soon(turns.append, True)
+    await replay(
+        app, records, speed=0, on_put=lambda u: seen.append((u.update_id, bool(turns)))
+    )
+    assert seen == [(0, False), (1, False), (2, False)]
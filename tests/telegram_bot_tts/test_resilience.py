@@ -0,0 +1,224 @@
+# test the deadlines, retries, hedging and circuit breaker around the openai calls
+import asyncio
+import logging
+import time
+
+import httpx
+import pytest
+from openai import APIStatusError, InternalServerError
+
+from telegram_bot_tts.components.concurrency import AdaptiveLimit
+from telegram_bot_tts.components.handlers import stt_response, tts_stream_response
+from telegram_bot_tts.components.resilience import (
+    ApiGuard,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+from telegram_bot_tts.fakes import FakeOpenAI
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+logger = logging.getLogger(__name__)
+
+
+def api_error(status: int) -> APIStatusError:
+    response = httpx.Response(status, request=httpx.Request("POST", "https://x"))
+    if status >= 500:
+        return InternalServerError("server error", response=response, body=None)
+    return APIStatusError("client error", response=response, body=None)
+
+
+def flaky(failures: list, result="ok", latency: float = 0.0):
+    # fails with the given errors in turn, then succeeds
+    calls = []
+
+    async def request():
+        calls.append(time.perf_counter())
+        await asyncio.sleep(latency)
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return result
+
+    return request, calls
+
+
+@pytest.mark.asyncio
+async def test_retries_retryable_errors_only():
+
+    guard = ApiGuard("test", deadline=5, retries=2, backoff=0.01)
+
+    request, calls = flaky([api_error(500), api_error(429)])
+    assert await guard.call(request) == "ok"
+    assert len(calls) == 3
+
+    # a bad request is not retried
+    request, calls = flaky([api_error(400)])
+    with pytest.raises(APIStatusError):
+        await guard.call(request)
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_deadline_covers_the_retries():
+
+    guard = ApiGuard("test", deadline=0.2, retries=5, backoff=0.01)
+    cancelled = []
+
+    async def hangs():
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    # cut at the deadline, the timed out call isn't retried
+    with pytest.raises(asyncio.TimeoutError):
+        await guard.call(hangs)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_against_an_outage():
+
+    breaker = CircuitBreaker("tts", failure_threshold=3, reset_timeout=0.1)
+    guard = ApiGuard("tts", deadline=5, retries=0, breaker=breaker)
+    client = FakeOpenAI(tts_latency=0, error_rate=1)
+
+    for _ in range(3):
+        with pytest.raises(InternalServerError):
+            await tts_stream_response("hello", client, logger, guard=guard)
+
+    # open, calls fail fast without reaching the api
+    assert not guard.available()
+    with pytest.raises(CircuitOpenError):
+        await tts_stream_response("hello", client, logger, guard=guard)
+    assert client.calls["tts"] == 3
+
+    # after the reset timeout a trial call goes through and closes it
+    await asyncio.sleep(0.1)
+    client.error_rate = 0
+    with await tts_stream_response("hello", client, logger, guard=guard) as audio:
+        assert audio.read().startswith(b"OggS")
+    assert guard.available() and breaker.failures == 0
+
+
+def test_failed_trial_opens_the_circuit_again():
+
+    breaker = CircuitBreaker("stt", failure_threshold=2, reset_timeout=10)
+    breaker.record_failure(now=0)
+    breaker.record_failure(now=0)
+    assert not breaker.available(now=5)
+
+    breaker.check(now=10)
+    # one trial at a time
+    assert not breaker.available(now=10)
+    breaker.record_failure(now=10)
+    assert not breaker.available(now=15)
+    assert breaker.available(now=20)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_lets_the_next_call_try():
+
+    breaker = CircuitBreaker("tts", failure_threshold=1, reset_timeout=0.05)
+    guard = ApiGuard("tts", deadline=5, retries=0, breaker=breaker)
+    with pytest.raises(InternalServerError):
+        await guard.call(flaky([api_error(500)])[0])
+    await asyncio.sleep(0.05)
+
+    # the trial is cancelled midway, as a sibling segment failing does
+    trial = asyncio.create_task(guard.call(flaky([], latency=10)[0]))
+    await asyncio.sleep(0.01)
+    assert not guard.available()
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    assert guard.available()
+
+    # and so does a trial answered with a 429
+    request, calls = flaky([api_error(429)])
+    with pytest.raises(APIStatusError):
+        await guard.call(request)
+    assert guard.available()
+    assert await guard.call(flaky([])[0]) == "ok"
+    assert breaker.opened_at is None
+
+
+@pytest.mark.asyncio
+async def test_hedges_slow_calls_within_the_budget():
+
+    guard = ApiGuard("hedge", deadline=5, hedge_ratio=0, min_samples=5)
+    for _ in range(5):
+        await guard.call(flaky([], latency=0.01)[0], size=10)
+    delay = guard.hedge_delay(10)
+    assert delay is not None
+    # other sizes have no history yet
+    assert guard.hedge_delay(1000) is None
+
+    calls = []
+    primary_done = asyncio.Event()
+
+    async def slow_first(go: asyncio.Event):
+        calls.append(1)
+        if len(calls) == 1:
+            try:
+                await go.wait()
+            finally:
+                primary_done.set()
+        return len(calls)
+
+    # the duplicate sent after the p95 wins, the first call is cancelled
+    assert await guard.call(lambda: slow_first(asyncio.Event()), size=10) == 2
+    await primary_done.wait()
+
+    # the one hedge in hand is spent and a ratio of 0 earns no more: past the
+    # hedge delay there is still only the first call
+    calls.clear()
+    go = asyncio.Event()
+    call = asyncio.create_task(guard.call(lambda: slow_first(go), size=10))
+    while not calls:
+        await asyncio.sleep(0)
+    await asyncio.sleep(2 * delay)
+    assert calls == [1]
+    go.set()
+    assert await call == 1
+
+
+@pytest.mark.asyncio
+async def test_stt_retries_upload_the_whole_file():
+
+    client = FakeOpenAI(stt_latency=0, error_rate=1, seed=0)
+    guard = ApiGuard("stt", deadline=5, retries=2, backoff=0.01)
+
+    with pytest.raises(InternalServerError):
+        await stt_response(b"OggS" + b"\0" * 100, client, logger, guard=guard)
+    assert client.calls["stt"] == 3
+
+    client.error_rate = 0
+    assert await stt_response(b"OggS", client, logger, guard=guard) == client.transcript
+
+
+@pytest.mark.asyncio
+async def test_limit_adapts_to_rate_limits():
+
+    # the account takes 4 calls at a time, the limit starts at 16. The limit is cut
+    # at most once a round trip, the retries last until it fits however slow the
+    # machine is
+    client = FakeOpenAI(tts_latency=0.05, capacity=4, seed=0)
+    limiter = AdaptiveLimit("tts", initial=16, max_limit=16, max_wait=60)
+    guard = ApiGuard(
+        "tts", deadline=60, retries=50, backoff=0.05, max_backoff=0.5, limiter=limiter
+    )
+
+    async def speak():
+        with await tts_stream_response("hello", client, logger, guard=guard):
+            pass
+
+    await asyncio.gather(*(speak() for _ in range(100)))
+
+    # every call went through in the end, with the limit brought down to fit
+    assert client.rate_limited > 0
+    assert limiter.limit < 8
+    assert limiter.in_flight == 0
+    assert guard.available()
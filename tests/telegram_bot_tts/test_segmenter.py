@@ -0,0 +1,39 @@
+# test splitting long texts for tts
+from telegram_bot_tts.components.segmenter import split_text, group_audio
+
+
+def test_split_short_text():
+
+    assert split_text(" Hello, how are you? ") == ["Hello, how are you?"]
+
+
+def test_split_at_sentences():
+
+    text = "First sentence here. Second one follows! A third? " * 20
+    segments = split_text(text, limit=100)
+
+    assert all(len(segment) <= 100 for segment in segments)
+    assert all(segment[-1] in ".!?" for segment in segments)
+    assert " ".join(segments).split() == text.split()
+
+
+def test_split_prefers_paragraphs():
+
+    text = "a" * 40 + ". " + "b" * 40 + ".\n\n" + "c" * 60 + "."
+    assert split_text(text, limit=90) == [
+        "a" * 40 + ". " + "b" * 40 + ".",
+        "c" * 60 + ".",
+    ]
+
+
+def test_split_without_whitespace():
+
+    assert split_text("x" * 250, limit=100) == ["x" * 100, "x" * 100, "x" * 50]
+
+
+def test_group_audio():
+
+    parts = [b"1" * 4, b"2" * 4, b"3" * 4]
+
+    assert group_audio(parts, max_bytes=100) == [b"111122223333"]
+    assert group_audio(parts, max_bytes=8) == [b"11112222", b"3333"]
@@ -0,0 +1,94 @@
+# test the local http server
+from aiohttp.test_utils import TestClient, TestServer
+from prometheus_client import CollectorRegistry
+from telegram.ext import Application
+import pytest
+
+from telegram_bot_tts import app as bot_app
+from telegram_bot_tts.components.cache import TTLCache
+from telegram_bot_tts.components.concurrency import FairScheduler
+from telegram_bot_tts.metrics import OPENAI_LATENCY, StatsCollector, observe
+from telegram_bot_tts.server import BotServer, SECRET_TOKEN_HEADER
+
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "text": "hello",
+    },
+}
+
+
+@pytest.mark.asyncio
+async def test_webhook():
+
+    app = Application.builder().token("123:test").build()
+    server = BotServer(app, "127.0.0.1", 0, webhook_path="/telegram", secret_token="s")
+
+    async with TestClient(TestServer(server.web_app)) as client:
+        resp = await client.post("/telegram", json=UPDATE)
+        assert resp.status == 403
+
+        resp = await client.post(
+            "/telegram", json=UPDATE, headers={SECRET_TOKEN_HEADER: "s"}
+        )
+        assert resp.status == 200
+
+        resp = await client.get("/healthz")
+        assert resp.status == 200
+
+        # not ready until the application is running
+        resp = await client.get("/readyz")
+        assert resp.status == 503
+
+    update = app.update_queue.get_nowait()
+    assert update.message.text == "hello"
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+
+    app = Application.builder().token("123:test").build()
+    server = BotServer(app, "127.0.0.1", 0)
+
+    registry = CollectorRegistry()
+    registry.register(
+        StatsCollector(
+            FairScheduler(4, {}, {}, vip_user_ids=[]), cache=TTLCache(10, 60)
+        )
+    )
+    with observe(OPENAI_LATENCY, "tts"):
+        pass
+
+    async with TestClient(TestServer(server.web_app)) as client:
+        resp = await client.get("/metrics")
+        assert resp.status == 200
+        assert 'openai_request_seconds_count{api="tts"}' in await resp.text()
+
+    assert registry.get_sample_value("scheduler_queued_jobs", {"lane": "vip"}) == 0
+    assert registry.get_sample_value("cache_cache", {"stat": "size"}) == 0
+
+
+@pytest.mark.parametrize(
+    "url, token, errors",
+    [
+        ("https://bot.example.com", "s3cret_token-1", []),
+        (None, None, ["WEBHOOK_URL is not set", "WEBHOOK_SECRET_TOKEN is not set"]),
+        ("http://bot.example.com", "s3cret", ["is not an https url"]),
+        ("https://bot.example.com", "no spaces", ["must be 1-256 characters"]),
+    ],
+)
+def test_webhook_config_errors(monkeypatch, url, token, errors):
+
+    monkeypatch.setattr(bot_app, "WEBHOOK_URL", url)
+    monkeypatch.setattr(bot_app, "WEBHOOK_SECRET_TOKEN", token)
+
+    found = bot_app.webhook_config_errors()
+    assert len(found) == len(errors)
+    assert all(error in message for error, message in zip(errors, found))
@@ -0,0 +1,19 @@
+# test the lazily built clients
+from telegram_bot_tts.components.ults import LazyClient
+
+
+def test_lazy_client_is_built_once_on_first_use():
+
+    built = []
+
+    def factory():
+        built.append(1)
+        return complex(1, 2)
+
+    client = LazyClient(factory)
+    assert built == []
+
+    assert client.real == 1
+    assert client.imag == 2
+    assert client.load() == complex(1, 2)
+    assert built == [1]